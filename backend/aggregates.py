@@ -0,0 +1,224 @@
+"""
+Column aggregates computed by Mongo.
+
+An aggregate request ({"aggregates": [{"op": "sum", "column": "B"}, ...],
+"group_by": "A", "start_row", "end_row", "filters": [...]}) is compiled into
+one $match/$group pipeline over `rows`, so only the results leave the
+database. Numeric ops (sum, avg, min, max) only see numeric cell values, the
+way spreadsheet functions skip text; count counts non-empty cells.
+
+Results are cached per sheet in an LRU. Every entry remembers the columns it
+read; a write invalidates only the entries that touch a written column, and
+imports or structural changes drop the whole sheet. Like the row cache it only
+sees this process's writes, so with a shared broadcast bus entries expire after
+AGG_CACHE_TTL seconds by default.
+"""
+import os
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Set, Tuple
+
+from columns import COLUMN_INDEX
+from broadcast_bus import BROADCAST_BUS
+
+AGG_CACHE_SIZE = int(os.getenv("AGG_CACHE_SIZE", "1024"))
+# seconds, 0 = no expiry; other instances' writes are only picked up on expiry
+AGG_CACHE_TTL = float(os.getenv("AGG_CACHE_TTL", "0" if BROADCAST_BUS == "memory" else "2"))
+AGG_MAX_GROUPS = int(os.getenv("AGG_MAX_GROUPS", "1000"))
+
+OPS = ("sum", "avg", "min", "max", "count")
+FILTER_OPS = {"eq": "$eq", "ne": "$ne", "gt": "$gt", "gte": "$gte", "lt": "$lt", "lte": "$lte",
+              "in": "$in", "nin": "$nin"}
+
+
+def _column(col: Any) -> str:
+    if not isinstance(col, str) or col not in COLUMN_INDEX:
+        raise ValueError(f"bad column {col!r}")
+    return col
+
+
+def _numeric(col: str):
+    path = f"$cells.{col}.value"
+    return {"$cond": [{"$isNumber": path}, path, None]}
+
+
+def _accumulator(op: str, col: str):
+    if op == "sum":
+        return {"$sum": _numeric(col)}
+    if op == "avg":
+        return {"$avg": _numeric(col)}
+    if op == "min":
+        return {"$min": _numeric(col)}
+    if op == "max":
+        return {"$max": _numeric(col)}
+    # count: non-empty cells ($ifNull maps both missing and null to null)
+    return {"$sum": {"$cond": [{"$eq": [{"$ifNull": [f"$cells.{col}.value", None]}, None]}, 0, 1]}}
+
+
+def normalize(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """Validated, canonical form of a request (also the cache key); raises ValueError."""
+    aggregates = spec.get("aggregates") or []
+    if not aggregates:
+        raise ValueError("no aggregates")
+    out_aggs = []
+    for a in aggregates:
+        op = a.get("op")
+        if op not in OPS:
+            raise ValueError(f"bad op {op!r}")
+        out_aggs.append({"op": op, "column": _column(a.get("column"))})
+    filters = []
+    for f in spec.get("filters") or []:
+        op = f.get("op", "eq")
+        if op not in FILTER_OPS:
+            raise ValueError(f"bad filter op {op!r}")
+        value = f.get("value")
+        if op in ("in", "nin") and not isinstance(value, list):
+            raise ValueError(f"{op} needs a list")
+        filters.append({"column": _column(f.get("column")), "op": op, "value": value})
+    group_by = spec.get("group_by")
+    return {
+        "aggregates": out_aggs,
+        "group_by": _column(group_by) if group_by is not None else None,
+        "start_row": spec.get("start_row"),
+        "end_row": spec.get("end_row"),
+        "filters": filters,
+    }
+
+
+def columns_of(spec: Dict[str, Any]) -> Set[str]:
+    cols = {a["column"] for a in spec["aggregates"]}
+    cols.update(f["column"] for f in spec["filters"])
+    if spec["group_by"]:
+        cols.add(spec["group_by"])
+    return cols
+
+
+def result_name(agg: Dict[str, str]) -> str:
+    return f"{agg['op']}_{agg['column']}"
+
+
+def compile_pipeline(sheet_id: str, spec: Dict[str, Any]) -> List[Dict[str, Any]]:
+    match: Dict[str, Any] = {"spreadsheet_id": sheet_id}
+    rows = {}
+    if spec["start_row"] is not None:
+        rows["$gte"] = spec["start_row"]
+    if spec["end_row"] is not None:
+        rows["$lte"] = spec["end_row"]
+    if rows:
+        match["row_index"] = rows
+    for f in spec["filters"]:
+        cond = match.setdefault(f"cells.{f['column']}.value", {})
+        cond[FILTER_OPS[f["op"]]] = f["value"]
+    group: Dict[str, Any] = {"_id": f"$cells.{spec['group_by']}.value" if spec["group_by"] else None}
+    for agg in spec["aggregates"]:
+        group[result_name(agg)] = _accumulator(agg["op"], agg["column"])
+    pipeline = [{"$match": match}, {"$group": group}]
+    if spec["group_by"]:
+        pipeline += [{"$sort": {"_id": 1}}, {"$limit": AGG_MAX_GROUPS + 1}]
+    return pipeline
+
+
+def shape_result(spec: Dict[str, Any], docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    names = [result_name(a) for a in spec["aggregates"]]
+    if not spec["group_by"]:
+        doc = docs[0] if docs else {}
+        return {"result": {n: doc.get(n, 0 if n.startswith(("sum_", "count_")) else None) for n in names}}
+    groups = [dict({"key": d["_id"]}, **{n: d.get(n) for n in names}) for d in docs[:AGG_MAX_GROUPS]]
+    return {"groups": groups, "truncated": len(docs) > AGG_MAX_GROUPS}
+
+
+# (sheet_id, normalized spec as JSON)
+CacheKey = Tuple[str, str]
+
+
+class _Entry:
+    __slots__ = ("result", "columns", "stored_at")
+
+    def __init__(self, result, columns):
+        self.result = result
+        self.columns = columns
+        self.stored_at = time.monotonic()
+
+
+class AggregateCache:
+    def __init__(self, max_entries: int = AGG_CACHE_SIZE, ttl: float = AGG_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        self._by_sheet: Dict[str, set] = {}
+        self._generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def generation(self, sheet_id: str) -> int:
+        return self._generations.get(sheet_id, 0)
+
+    def get(self, sheet_id: str, key: str):
+        entry = self._entries.get((sheet_id, key))
+        if entry is None or (self.ttl and time.monotonic() - entry.stored_at > self.ttl):
+            self.misses += 1
+            return None
+        self._entries.move_to_end((sheet_id, key))
+        self.hits += 1
+        return entry.result
+
+    def put(self, sheet_id: str, key: str, result, columns: Set[str], generation: int):
+        """Store unless the sheet was written since `generation` was read."""
+        if generation != self.generation(sheet_id):
+            return
+        self._entries[(sheet_id, key)] = _Entry(result, columns)
+        self._entries.move_to_end((sheet_id, key))
+        self._by_sheet.setdefault(sheet_id, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            (old_sheet, old_key), _ = self._entries.popitem(last=False)
+            self._forget(old_sheet, old_key)
+
+    def _forget(self, sheet_id: str, key: str):
+        keys = self._by_sheet.get(sheet_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                self._by_sheet.pop(sheet_id, None)
+
+    def invalidate_columns(self, sheet_id: str, columns):
+        self._generations[sheet_id] = self.generation(sheet_id) + 1
+        columns = set(columns)
+        for key in list(self._by_sheet.get(sheet_id, ())):
+            entry = self._entries.get((sheet_id, key))
+            if entry is not None and entry.columns & columns:
+                del self._entries[(sheet_id, key)]
+                self._forget(sheet_id, key)
+                self.invalidations += 1
+
+    def invalidate_sheet(self, sheet_id: str):
+        self._generations[sheet_id] = self.generation(sheet_id) + 1
+        for key in list(self._by_sheet.get(sheet_id, ())):
+            self._entries.pop((sheet_id, key), None)
+            self.invalidations += 1
+        self._by_sheet.pop(sheet_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else None,
+            "invalidations": self.invalidations,
+        }
+
+
+async def run(db, cache: AggregateCache, sheet_id: str, spec: Dict[str, Any]) -> Dict[str, Any]:
+    spec = normalize(spec)
+    key = json.dumps(spec, sort_keys=True, default=str)
+    cached = cache.get(sheet_id, key)
+    if cached is not None:
+        return dict(cached, cached=True)
+    generation = cache.generation(sheet_id)
+    docs = [d async for d in db.rows.aggregate(compile_pipeline(sheet_id, spec))]
+    result = shape_result(spec, docs)
+    cache.put(sheet_id, key, result, columns_of(spec), generation)
+    return dict(result, cached=False)
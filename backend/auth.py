@@ -0,0 +1,170 @@
+"""
+Off-loop password hashing, login throttling and signed session tokens.
+
+bcrypt costs tens of milliseconds of CPU per call. Calling it inside an async
+handler stalls every other request on the worker, so hashing and verification
+run on a ThreadPoolExecutor of AUTH_HASH_WORKERS threads (bcrypt releases the
+GIL). At most AUTH_HASH_MAX_PENDING calls may be running or queued; anything
+beyond that is refused with 503 instead of growing an unbounded backlog.
+
+Login attempts are throttled per username, in process:
+- only one verification per user runs at a time;
+- AUTH_MAX_FAILURES failures within AUTH_FAILURE_WINDOW seconds lock the name
+  for AUTH_LOCKOUT_SECONDS.
+A locked-out attempt is answered without touching bcrypt.
+
+A successful login returns a session token, base64url(payload).base64url(sig),
+where sig is HMAC-SHA256 over the payload with AUTH_SECRET. Checking one costs a
+single HMAC, so authenticated requests never repeat bcrypt. Set AUTH_SECRET (the
+same value on every instance); without it a random per-process secret is used
+and tokens stop working after a restart.
+"""
+import os
+import hmac
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+
+from fastapi import Header, HTTPException
+
+AUTH_HASH_WORKERS = int(os.getenv("AUTH_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+AUTH_HASH_MAX_PENDING = int(os.getenv("AUTH_HASH_MAX_PENDING", "64"))
+AUTH_MAX_FAILURES = int(os.getenv("AUTH_MAX_FAILURES", "5"))
+AUTH_FAILURE_WINDOW = float(os.getenv("AUTH_FAILURE_WINDOW", "300"))
+AUTH_LOCKOUT_SECONDS = float(os.getenv("AUTH_LOCKOUT_SECONDS", "60"))
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", "86400"))
+# usernames with recorded failures kept in memory; the oldest are forgotten first
+AUTH_THROTTLE_MAX_USERS = int(os.getenv("AUTH_THROTTLE_MAX_USERS", "100000"))
+
+logger = logging.getLogger(__name__)
+
+_secret = os.getenv("AUTH_SECRET", "").encode()
+if not _secret:
+    logger.warning("AUTH_SECRET is not set; session tokens are only valid for this process")
+    _secret = secrets.token_bytes(32)
+
+
+# ---------- hashing pool ----------
+_executor = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix="auth-hash")
+_pending = 0
+
+
+async def run_hashing(fn, *args):
+    """Run a password hash/verify callable on the bounded pool; 503 when the pool is saturated."""
+    global _pending
+    if _pending >= AUTH_HASH_MAX_PENDING:
+        raise HTTPException(status_code=503, detail="auth_busy", headers={"Retry-After": "1"})
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _pending -= 1
+
+
+def pending() -> int:
+    return _pending
+
+
+def shutdown():
+    _executor.shutdown(wait=False)
+
+
+# ---------- throttling ----------
+class LoginThrottle:
+    def __init__(self, max_failures: int = AUTH_MAX_FAILURES, window: float = AUTH_FAILURE_WINDOW,
+                 lockout: float = AUTH_LOCKOUT_SECONDS):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        self._failures: Dict[str, list] = {}
+        self._locked_until: Dict[str, float] = {}
+        self._inflight: set = set()
+
+    def retry_after(self, username: str) -> float:
+        """Seconds until username may try again (0 = now)."""
+        until = self._locked_until.get(username)
+        if until is None:
+            return 0
+        left = until - time.monotonic()
+        if left <= 0:
+            del self._locked_until[username]
+            return 0
+        return left
+
+    def begin(self, username: str):
+        """Admit one attempt for username or raise 429."""
+        wait = self.retry_after(username)
+        if wait:
+            raise HTTPException(status_code=429, detail="too_many_attempts",
+                                headers={"Retry-After": str(int(wait) + 1)})
+        if username in self._inflight:
+            raise HTTPException(status_code=429, detail="attempt_in_progress", headers={"Retry-After": "1"})
+        self._inflight.add(username)
+
+    def end(self, username: str, ok: Optional[bool]):
+        """Finish an attempt; ok=None (no verdict, e.g. the pool was busy) counts neither way."""
+        self._inflight.discard(username)
+        if ok is None:
+            return
+        if ok:
+            self._failures.pop(username, None)
+            return
+        now = time.monotonic()
+        recent = [t for t in self._failures.get(username, ()) if now - t < self.window]
+        recent.append(now)
+        if len(recent) >= self.max_failures:
+            self._locked_until[username] = now + self.lockout
+            self._failures.pop(username, None)
+        else:
+            self._failures.pop(username, None)
+            self._failures[username] = recent
+            while len(self._failures) > AUTH_THROTTLE_MAX_USERS:
+                self._failures.pop(next(iter(self._failures)))
+
+
+# ---------- session tokens ----------
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def issue_token(user_id: str, username: str, ttl: int = AUTH_TOKEN_TTL) -> str:
+    payload = _b64(json.dumps({"sub": user_id, "usr": username, "exp": int(time.time()) + ttl},
+                              separators=(",", ":")).encode())
+    sig = _b64(hmac.new(_secret, payload.encode(), hashlib.sha256).digest())
+    return f"{payload}.{sig}"
+
+
+def verify_token(token: str) -> Optional[Dict[str, Any]]:
+    """Payload of a valid, unexpired token; None otherwise."""
+    payload, _, sig = token.partition(".")
+    if not payload or not sig:
+        return None
+    expected = _b64(hmac.new(_secret, payload.encode(), hashlib.sha256).digest())
+    if not hmac.compare_digest(sig, expected):
+        return None
+    try:
+        claims = json.loads(_unb64(payload))
+    except ValueError:
+        return None
+    if not isinstance(claims, dict) or claims.get("exp", 0) < time.time():
+        return None
+    return claims
+
+
+async def current_user(authorization: Optional[str] = Header(None)) -> Dict[str, Any]:
+    """FastAPI dependency: claims of the bearer token in the Authorization header, else 401."""
+    scheme, _, token = (authorization or "").partition(" ")
+    claims = verify_token(token.strip()) if scheme.lower() == "bearer" else None
+    if claims is None:
+        raise HTTPException(status_code=401, detail="invalid_token", headers={"WWW-Authenticate": "Bearer"})
+    return claims
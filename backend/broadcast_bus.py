@@ -0,0 +1,163 @@
+"""
+Cross-instance broadcast bus under ConnectionManager.
+
+Each instance publishes a sheet event once; every instance that has local
+subscribers for that sheet receives it and fans it out to its own sockets.
+
+Backends:
+- InProcessBus: single process, delivers straight to the local manager (default);
+- RedisBus: Redis pub/sub with one channel per sheet. Needs the optional
+  `redis` package (redis.asyncio). Any client exposing the redis.asyncio
+  pub/sub API works, e.g. fakeredis for a local stand-in broker.
+
+Select with BROADCAST_BUS=memory|redis and REDIS_URL.
+"""
+import os
+import uuid
+import asyncio
+import logging
+from typing import Callable, Optional, Set
+
+BROADCAST_BUS = os.getenv("BROADCAST_BUS", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_CHANNEL_PREFIX = os.getenv("REDIS_CHANNEL_PREFIX", "noexcel:sheet:")
+
+logger = logging.getLogger(__name__)
+
+# deliver(sheet_id, frame): hand an encoded frame to local subscribers; must not block
+Deliver = Callable[[str, str], None]
+
+
+async def _aclose(obj):
+    # redis>=5 renamed close() to aclose()
+    close = getattr(obj, "aclose", None) or obj.close
+    await close()
+
+
+class BroadcastBus:
+    """Interface: start/close, publish, and subscribe/unsubscribe per sheet."""
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+        self.published = 0
+        self.received = 0
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def close(self):
+        pass
+
+    async def publish(self, sheet_id: str, frame: str):
+        raise NotImplementedError
+
+    async def subscribe(self, sheet_id: str):
+        pass
+
+    async def unsubscribe(self, sheet_id: str):
+        pass
+
+    def stats(self):
+        return {"backend": type(self).__name__, "published": self.published, "received": self.received}
+
+
+class InProcessBus(BroadcastBus):
+    async def publish(self, sheet_id: str, frame: str):
+        self.published += 1
+        self.received += 1
+        self.deliver(sheet_id, frame)
+
+
+class RedisBus(BroadcastBus):
+    """
+    Redis pub/sub backend. Messages are "<instance_id>|<frame>"; the publishing
+    instance delivers locally right away and skips its own echo from Redis.
+    """
+
+    def __init__(self, client=None, url: str = REDIS_URL, prefix: str = REDIS_CHANNEL_PREFIX):
+        super().__init__()
+        if client is None:
+            try:
+                import redis.asyncio as aioredis
+            except ImportError as e:
+                raise RuntimeError("BROADCAST_BUS=redis requires the 'redis' package") from e
+            client = aioredis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.instance_id = uuid.uuid4().hex
+        self.pubsub = None
+        self.channels: Set[str] = set()
+        self._reader: Optional[asyncio.Task] = None
+
+    def _channel(self, sheet_id: str) -> str:
+        return self.prefix + sheet_id
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self.pubsub = self.client.pubsub()
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+        if self.pubsub is not None:
+            await _aclose(self.pubsub)
+        await _aclose(self.client)
+
+    async def publish(self, sheet_id: str, frame: str):
+        self.published += 1
+        self.deliver(sheet_id, frame)
+        await self.client.publish(self._channel(sheet_id), f"{self.instance_id}|{frame}")
+
+    async def subscribe(self, sheet_id: str):
+        channel = self._channel(sheet_id)
+        if channel not in self.channels:
+            await self.pubsub.subscribe(channel)
+            self.channels.add(channel)
+
+    async def unsubscribe(self, sheet_id: str):
+        channel = self._channel(sheet_id)
+        if channel in self.channels:
+            self.channels.discard(channel)
+            await self.pubsub.unsubscribe(channel)
+
+    def _handle(self, message):
+        channel = message["channel"]
+        data = message["data"]
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        origin, _, frame = data.partition("|")
+        if origin == self.instance_id:
+            return
+        self.received += 1
+        self.deliver(channel[len(self.prefix):], frame)
+
+    async def _read_loop(self):
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("redis bus read failed")
+                await asyncio.sleep(1.0)
+                continue
+            if message is not None and message.get("type") == "message":
+                self._handle(message)
+
+
+def bus_from_env() -> BroadcastBus:
+    if BROADCAST_BUS == "redis":
+        return RedisBus()
+    if BROADCAST_BUS == "memory":
+        return InProcessBus()
+    raise ValueError(f"unknown BROADCAST_BUS: {BROADCAST_BUS}")
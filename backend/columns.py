@@ -0,0 +1,54 @@
+"""Precomputed column letter <-> index tables (A..XFD, the Excel column limit)."""
+from typing import Dict, List
+
+MAX_COLUMNS = 16384
+
+
+def _build_letters(count: int) -> List[str]:
+    letters = []
+    for i in range(1, count + 1):
+        s = ""
+        n = i
+        while n:
+            n, rem = divmod(n - 1, 26)
+            s = chr(65 + rem) + s
+        letters.append(s)
+    return letters
+
+
+# COLUMN_LETTERS[0] == "A"; COLUMN_INDEX["A"] == 1 (1-based like openpyxl)
+COLUMN_LETTERS: List[str] = _build_letters(MAX_COLUMNS)
+COLUMN_INDEX: Dict[str, int] = {letter: i for i, letter in enumerate(COLUMN_LETTERS, start=1)}
+
+
+def column_letter(idx: int) -> str:
+    """1-based column index -> letter."""
+    return COLUMN_LETTERS[idx - 1]
+
+
+def column_index(letter: str) -> int:
+    """Column letter -> 1-based index; raises KeyError for unknown letters."""
+    return COLUMN_INDEX[letter]
+
+
+def parse_column_spec(spec: str) -> List[str]:
+    """
+    "A,C,F:H" -> ["A", "C", "F", "G", "H"] (order kept, duplicates dropped).
+    Raises ValueError on unknown letters or reversed ranges.
+    """
+    out: List[str] = []
+    seen = set()
+    for part in spec.split(","):
+        part = part.strip().upper()
+        if not part:
+            continue
+        first, _, last = part.partition(":")
+        lo = COLUMN_INDEX.get(first)
+        hi = COLUMN_INDEX.get(last or first)
+        if lo is None or hi is None or hi < lo:
+            raise ValueError(f"invalid column spec: {part}")
+        for letter in COLUMN_LETTERS[lo - 1:hi]:
+            if letter not in seen:
+                seen.add(letter)
+                out.append(letter)
+    return out
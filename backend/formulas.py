@@ -0,0 +1,524 @@
+"""
+Formula language for "formula" cells.
+
+A formula cell is stored as {"type": "formula", "formula": "=SUM(A1:A3)*2",
+"value": <last result>} plus "error": "#DIV/0!" etc. when evaluation failed.
+This module only parses and evaluates; dependency tracking and recalculation
+live in recalc.py.
+
+Supported: numbers, "strings", TRUE/FALSE, A1 references (with optional $),
+A1:B9 ranges, + - * / ^ & = <> < > <= >=, unary minus, postfix %, and the
+functions in FUNCTIONS. References are to the same sheet only.
+"""
+import re
+import math
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from columns import COLUMN_INDEX
+
+FORMULA_CACHE_SIZE = 4096
+# rectangle (c1, r1, c2, r2), 1-based and inclusive
+Rect = Tuple[int, int, int, int]
+
+
+class FormulaSyntaxError(ValueError):
+    pass
+
+
+class FormulaError(str):
+    """An Excel-style error value (#DIV/0!, #VALUE!, ...); propagates through expressions."""
+
+
+DIV0 = FormulaError("#DIV/0!")
+VALUE = FormulaError("#VALUE!")
+NUM = FormulaError("#NUM!")
+CYCLE = FormulaError("#CYCLE!")
+
+
+def is_formula_text(value: Any) -> bool:
+    return isinstance(value, str) and len(value) > 1 and value.startswith("=")
+
+
+def formula_cell(text: str) -> Dict[str, Any]:
+    """Normalized cell for formula text; the value is filled in by recalculation."""
+    text = text.strip()
+    if not text.startswith("="):
+        text = "=" + text
+    parse(text)
+    return {"type": "formula", "formula": text, "value": None}
+
+
+# ---------- tokenizer ----------
+_TOKEN = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<str>"(?:[^"]|"")*")
+  | (?P<ref>\$?[A-Za-z]{1,3}\$?\d+(?::\$?[A-Za-z]{1,3}\$?\d+)?)(?![\w(])
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+  | (?P<op><=|>=|<>|[-+*/^&=<>(),%])
+""", re.VERBOSE)
+_CELL = re.compile(r"\$?([A-Za-z]{1,3})\$?(\d+)")
+
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN.match(text, pos)
+        if m is None:
+            raise FormulaSyntaxError(f"unexpected {text[pos]!r} at {pos}")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind != "ws":
+            tokens.append((kind, m.group()))
+    tokens.append(("end", ""))
+    return tokens
+
+
+def _cell(ref: str) -> Tuple[int, int]:
+    m = _CELL.fullmatch(ref)
+    col = COLUMN_INDEX.get(m.group(1).upper())
+    row = int(m.group(2))
+    if col is None or row < 1:
+        raise FormulaSyntaxError(f"bad reference {ref}")
+    return col, row
+
+
+# ---------- parser ----------
+# AST nodes are tuples: ("num", v) ("str", v) ("bool", v) ("ref", col, row)
+# ("range", c1, r1, c2, r2) ("neg", x) ("pct", x) ("bin", op, a, b) ("call", NAME, [args])
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i]
+
+    def take(self, value=None):
+        tok = self.tokens[self.i]
+        if value is not None and tok[1] != value:
+            raise FormulaSyntaxError(f"expected {value!r}, got {tok[1]!r}")
+        self.i += 1
+        return tok
+
+    def binary(self, ops, operand):
+        node = operand()
+        while self.peek()[0] == "op" and self.peek()[1] in ops:
+            op = self.take()[1]
+            node = ("bin", op, node, operand())
+        return node
+
+    def comparison(self):
+        return self.binary(("=", "<>", "<", ">", "<=", ">="), self.concat)
+
+    def concat(self):
+        return self.binary(("&",), self.additive)
+
+    def additive(self):
+        return self.binary(("+", "-"), self.term)
+
+    def term(self):
+        return self.binary(("*", "/"), self.power)
+
+    def power(self):
+        return self.binary(("^",), self.unary)
+
+    def unary(self):
+        if self.peek() == ("op", "-"):
+            self.take()
+            return ("neg", self.unary())
+        if self.peek() == ("op", "+"):
+            self.take()
+            return self.unary()
+        return self.postfix()
+
+    def postfix(self):
+        node = self.primary()
+        while self.peek() == ("op", "%"):
+            self.take()
+            node = ("pct", node)
+        return node
+
+    def primary(self):
+        kind, text = self.take()
+        if kind == "num":
+            value = float(text)
+            return ("num", int(value) if value.is_integer() and "." not in text and "e" not in text.lower() else value)
+        if kind == "str":
+            return ("str", text[1:-1].replace('""', '"'))
+        if kind == "ref":
+            if ":" in text:
+                a, b = text.split(":")
+                (c1, r1), (c2, r2) = _cell(a), _cell(b)
+                return ("range", min(c1, c2), min(r1, r2), max(c1, c2), max(r1, r2))
+            return ("ref",) + _cell(text)
+        if kind == "name":
+            name = text.upper()
+            if self.peek() == ("op", "("):
+                self.take()
+                args = []
+                if self.peek() != ("op", ")"):
+                    args.append(self.comparison())
+                    while self.peek() == ("op", ","):
+                        self.take()
+                        args.append(self.comparison())
+                self.take(")")
+                if name not in FUNCTIONS and name not in _LAZY:
+                    raise FormulaSyntaxError(f"unknown function {name}")
+                return ("call", name, args)
+            if name in ("TRUE", "FALSE"):
+                return ("bool", name == "TRUE")
+            raise FormulaSyntaxError(f"unknown name {text}")
+        if (kind, text) == ("op", "("):
+            node = self.comparison()
+            self.take(")")
+            return node
+        raise FormulaSyntaxError(f"unexpected {text or 'end of formula'!r}")
+
+
+@lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def parse(text: str):
+    """AST of a formula ("=..." or bare); raises FormulaSyntaxError."""
+    if text.startswith("="):
+        text = text[1:]
+    parser = _Parser(_tokenize(text))
+    node = parser.comparison()
+    if parser.peek()[0] != "end":
+        raise FormulaSyntaxError(f"unexpected {parser.peek()[1]!r}")
+    return node
+
+
+def references(node) -> List[Rect]:
+    """Every cell/range the expression reads, as rectangles."""
+    out: List[Rect] = []
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        tag = n[0]
+        if tag == "ref":
+            out.append((n[1], n[2], n[1], n[2]))
+        elif tag == "range":
+            out.append(n[1:])
+        elif tag in ("neg", "pct"):
+            stack.append(n[1])
+        elif tag == "bin":
+            stack.extend((n[2], n[3]))
+        elif tag == "call":
+            stack.extend(n[2])
+    return out
+
+
+# ---------- evaluation ----------
+def _error_in(values):
+    for v in values:
+        if isinstance(v, FormulaError):
+            return v
+    return None
+
+
+def to_number(v):
+    if isinstance(v, FormulaError):
+        return v
+    if v is None:
+        return 0
+    if isinstance(v, bool):
+        return int(v)
+    if isinstance(v, (int, float)):
+        return v
+    if isinstance(v, str):
+        try:
+            return float(v) if any(ch in v for ch in ".eE") else int(v)
+        except ValueError:
+            return VALUE
+    return VALUE
+
+
+def to_text(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return "TRUE" if v else "FALSE"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+
+def to_bool(v):
+    if isinstance(v, FormulaError):
+        return v
+    if isinstance(v, str):
+        upper = v.upper()
+        if upper in ("TRUE", "FALSE"):
+            return upper == "TRUE"
+        return VALUE
+    return bool(to_number(v))
+
+
+def _flatten(args) -> List[Tuple[Any, bool]]:
+    """(value, came_from_range) pairs; ranges are lists."""
+    out = []
+    for a in args:
+        if isinstance(a, list):
+            out.extend((v, True) for v in a)
+        else:
+            out.append((a, False))
+    return out
+
+
+def _numbers(args):
+    """Numbers for aggregate functions: ranges contribute only numeric cells, scalars are coerced."""
+    nums = []
+    for v, from_range in _flatten(args):
+        if isinstance(v, FormulaError):
+            return v
+        if from_range:
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                nums.append(v)
+        else:
+            n = to_number(v)
+            if isinstance(n, FormulaError):
+                return n
+            nums.append(n)
+    return nums
+
+
+def _aggregate(fn, empty=0):
+    def call(args):
+        nums = _numbers(args)
+        if isinstance(nums, FormulaError):
+            return nums
+        if not nums:
+            return empty
+        return fn(nums)
+    return call
+
+
+def _scalar(fn, *coerce):
+    def call(args):
+        if len(args) != len(coerce):
+            return VALUE
+        values = []
+        for a, conv in zip(args, coerce):
+            if isinstance(a, list):
+                return VALUE
+            v = conv(a)
+            if isinstance(v, FormulaError):
+                return v
+            values.append(v)
+        try:
+            return fn(*values)
+        except ZeroDivisionError:
+            return DIV0
+        except (ValueError, OverflowError):
+            return NUM
+    return call
+
+
+def _round(x, digits=0):
+    factor = 10 ** int(digits)
+    return math.floor(abs(x) * factor + 0.5) / factor * (1 if x >= 0 else -1)
+
+
+def _logical(fn):
+    def call(args):
+        flags = []
+        for v, _ in _flatten(args):
+            if v is None:
+                continue
+            b = to_bool(v)
+            if isinstance(b, FormulaError):
+                return b
+            flags.append(b)
+        return fn(flags) if flags else VALUE
+    return call
+
+
+def _concat(args):
+    values = [v for v, _ in _flatten(args)]
+    err = _error_in(values)
+    return err if err is not None else "".join(to_text(v) for v in values)
+
+
+def _optional_digits(fn):
+    def call(args):
+        if len(args) == 1:
+            args = args + [0]
+        return _scalar(fn, to_number, to_number)(args)
+    return call
+
+
+def _left(s, n):
+    n = int(n)
+    return VALUE if n < 0 else s[:n]
+
+
+def _right(s, n):
+    n = int(n)
+    return VALUE if n < 0 else (s[len(s) - n:] if n else "")
+
+
+def _text_slice(fn):
+    def call(args):
+        if len(args) == 1:
+            args = args + [1]
+        return _scalar(fn, to_text, to_number)(args)
+    return call
+
+
+FUNCTIONS: Dict[str, Callable[[list], Any]] = {
+    "SUM": _aggregate(sum),
+    "AVERAGE": _aggregate(lambda xs: sum(xs) / len(xs), empty=DIV0),
+    "MIN": _aggregate(min),
+    "MAX": _aggregate(max),
+    "PRODUCT": _aggregate(math.prod),
+    "COUNT": lambda args: sum(1 for v, _ in _flatten(args)
+                              if isinstance(v, (int, float)) and not isinstance(v, bool)),
+    "COUNTA": lambda args: sum(1 for v, _ in _flatten(args) if v is not None and v != ""),
+    "AND": _logical(all),
+    "OR": _logical(any),
+    "NOT": _scalar(lambda b: not b, to_bool),
+    "ABS": _scalar(abs, to_number),
+    "INT": _scalar(math.floor, to_number),
+    "SQRT": _scalar(math.sqrt, to_number),
+    "MOD": _scalar(lambda a, b: a - b * math.floor(a / b), to_number, to_number),
+    "POWER": _scalar(lambda a, b: a ** b, to_number, to_number),
+    "ROUND": _optional_digits(_round),
+    "CONCAT": _concat,
+    "CONCATENATE": _concat,
+    "LEN": _scalar(len, to_text),
+    "UPPER": _scalar(str.upper, to_text),
+    "LOWER": _scalar(str.lower, to_text),
+    "TRIM": _scalar(lambda s: " ".join(s.split()), to_text),
+    "LEFT": _text_slice(_left),
+    "RIGHT": _text_slice(_right),
+}
+# evaluated by the evaluator itself since they must not evaluate every argument
+_LAZY = ("IF", "IFERROR")
+
+_COMPARE = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def _compare_key(v):
+    # Excel orders numbers < text < booleans; text compares case-insensitively
+    if v is None:
+        return (0, 0)
+    if isinstance(v, bool):
+        return (2, v)
+    if isinstance(v, (int, float)):
+        return (0, v)
+    return (1, str(v).lower())
+
+
+def _arith(op, a, b):
+    a, b = to_number(a), to_number(b)
+    err = _error_in((a, b))
+    if err is not None:
+        return err
+    try:
+        if op == "+":
+            return a + b
+        if op == "-":
+            return a - b
+        if op == "*":
+            return a * b
+        if op == "/":
+            return a / b
+        return a ** b
+    except ZeroDivisionError:
+        return DIV0
+    except (OverflowError, ValueError):
+        return NUM
+
+
+def evaluate(node, cell: Callable[[int, int], Any], cells: Callable[[Rect], List[Any]]):
+    """
+    Evaluate an AST. cell(col, row) returns a referenced cell's value (None if
+    empty); cells(rect) returns the values of a range. Errors come back as
+    FormulaError values, never as exceptions.
+    """
+    tag = node[0]
+    if tag in ("num", "str", "bool"):
+        return node[1]
+    if tag == "ref":
+        return cell(node[1], node[2])
+    if tag == "range":
+        # a bare range outside a function: Excel would spill, we take the top-left cell
+        return cells(node[1:])
+    if tag == "neg":
+        v = to_number(_scalar_of(evaluate(node[1], cell, cells)))
+        return v if isinstance(v, FormulaError) else -v
+    if tag == "pct":
+        v = to_number(_scalar_of(evaluate(node[1], cell, cells)))
+        return v if isinstance(v, FormulaError) else v / 100
+    if tag == "bin":
+        op = node[1]
+        a = _scalar_of(evaluate(node[2], cell, cells))
+        b = _scalar_of(evaluate(node[3], cell, cells))
+        err = _error_in((a, b))
+        if err is not None:
+            return err
+        if op == "&":
+            return to_text(a) + to_text(b)
+        if op in _COMPARE:
+            return _COMPARE[op](_compare_key(a), _compare_key(b))
+        return _finite(_arith(op, a, b))
+    name, args = node[1], node[2]
+    if name == "IF":
+        if not 2 <= len(args) <= 3:
+            return VALUE
+        cond = to_bool(_scalar_of(evaluate(args[0], cell, cells)))
+        if isinstance(cond, FormulaError):
+            return cond
+        if cond:
+            return _scalar_of(evaluate(args[1], cell, cells))
+        return _scalar_of(evaluate(args[2], cell, cells)) if len(args) == 3 else False
+    if name == "IFERROR":
+        if len(args) != 2:
+            return VALUE
+        v = _scalar_of(evaluate(args[0], cell, cells))
+        return _scalar_of(evaluate(args[1], cell, cells)) if isinstance(v, FormulaError) else v
+    return _finite(FUNCTIONS[name]([evaluate(a, cell, cells) for a in args]))
+
+
+def _scalar_of(v):
+    if isinstance(v, list):
+        return v[0] if v else None
+    return v
+
+
+def _finite(v):
+    if isinstance(v, float) and not math.isfinite(v):
+        return NUM
+    return v
+
+
+def cell_value(cell: Optional[Dict[str, Any]]):
+    """The value a stored cell contributes to formulas."""
+    if not cell:
+        return None
+    if cell.get("type") == "formula":
+        error = cell.get("error")
+        return FormulaError(error) if error else cell.get("value")
+    value = cell.get("value")
+    if isinstance(value, (dict, list)):
+        return VALUE
+    return value
+
+
+def formula_result(value) -> Dict[str, Any]:
+    """The value/error fields to store on a formula cell for an evaluation result."""
+    if isinstance(value, FormulaError):
+        return {"value": None, "error": str(value)}
+    if isinstance(value, list):
+        value = value[0] if value else None
+    # like Excel, a formula that resolves to an empty cell shows 0
+    return {"value": 0 if value is None else value, "error": None}
@@ -0,0 +1,343 @@
+"""
+Row history: periodic snapshots, point-in-time reconstruction and compaction.
+
+The `changes` collection keeps one delta per edit ({"old", "new"} per cell).
+On top of that, `row_snapshots` holds the full cells of a row every
+HISTORY_SNAPSHOT_INTERVAL versions (taken by the write path at versions 2,
+2 + N, 2 + 2N, ...). The state of a row at time T is rebuilt from the nearest
+snapshot: forward through the deltas after a snapshot taken before T, or
+backward (undoing deltas with their "old" values) from the first snapshot
+after T / the current row. Either way at most ~N deltas are read.
+
+Compaction drops deltas older than the retention window once a snapshot at or
+before the cutoff covers them; history older than the cutoff is then kept at
+snapshot granularity only. Creation records stay, so a row still reads as not
+existing before it was created; a deleted row is rebuilt backwards from its
+delete record (which holds its last cells). Timestamps are stored and compared
+as naive UTC ISO strings; normalize_ts brings query timestamps into that form.
+
+Change records also carry the seq of the WebSocket event that announced them
+(and the row_index), so events_since() can rebuild missed events for a resuming
+client when the in-memory replay buffer (realtime.py) no longer has them. A
+rebuilt row_updated carries the full row like the original: it is undone from
+the current row through the later changes.
+"""
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional, List
+
+import tiles
+from columns import COLUMN_INDEX
+from wire import row_updated
+
+HISTORY_SNAPSHOT_INTERVAL = int(os.getenv("HISTORY_SNAPSHOT_INTERVAL", "50"))
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "30"))
+# seconds between background compaction passes, 0 = only on demand
+HISTORY_COMPACT_EVERY = float(os.getenv("HISTORY_COMPACT_EVERY", "0"))
+
+logger = logging.getLogger(__name__)
+
+
+def now_iso():
+    return datetime.utcnow().isoformat()
+
+
+def normalize_ts(value: str) -> str:
+    """
+    An ISO timestamp in the form created_at values are stored in (naive UTC,
+    datetime.isoformat), so they compare as strings; raises ValueError.
+    "2024-05-01T12:00:00+02:00" and "...Z" become "2024-05-01T10:00:00".
+    """
+    dt = datetime.fromisoformat(value.strip())
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt.isoformat()
+
+
+async def ensure_indexes(db):
+    await db.changes.create_index([("spreadsheet_id", 1), ("row_id", 1), ("created_at", 1)])
+    await db.changes.create_index([("spreadsheet_id", 1), ("created_at", 1)])
+    await db.changes.create_index([("spreadsheet_id", 1), ("seq", 1)])
+    await db.row_snapshots.create_index([("spreadsheet_id", 1), ("row_id", 1), ("created_at", 1)])
+
+
+def delta_version(change: Dict[str, Any]) -> int:
+    """Row version after the change (older docs only carry it inside the payload)."""
+    if "version" in change:
+        return change["version"]
+    if change.get("op_type") == "insert_row":
+        return 1
+    return (change.get("payload") or {}).get("new_version", 1)
+
+
+def is_creation(change: Dict[str, Any]) -> bool:
+    if change.get("op_type") == "insert_row":
+        return True
+    return (change.get("payload") or {}).get("prev_version") == 0
+
+
+def apply_forward(cells: Dict[str, Any], change: Dict[str, Any]):
+    payload = change.get("payload") or {}
+    if change.get("op_type") == "insert_row":
+        cells.clear()
+        cells.update(payload.get("cells") or {})
+        return
+    for col, diff in (payload.get("changes") or {}).items():
+        if diff.get("new") is None:
+            cells.pop(col, None)
+        else:
+            cells[col] = diff["new"]
+
+
+def apply_backward(cells: Dict[str, Any], change: Dict[str, Any]):
+    for col, diff in ((change.get("payload") or {}).get("changes") or {}).items():
+        if diff.get("old") is None:
+            cells.pop(col, None)
+        else:
+            cells[col] = diff["old"]
+
+
+def should_snapshot(version: int, interval: int = HISTORY_SNAPSHOT_INTERVAL) -> bool:
+    return interval > 0 and version >= 2 and (version - 2) % interval == 0
+
+
+async def take_snapshot(db, sheet_id: str, row_id: str):
+    """Store the row's current cells; whatever version it is at by now is the snapshot's version."""
+    row = await db.rows.find_one({"_id": row_id}, {"row_index": 1, "cells": 1, "version": 1, "updated_at": 1})
+    if not row:
+        return
+    await db.row_snapshots.insert_one({
+        "spreadsheet_id": sheet_id,
+        "row_id": row_id,
+        "row_index": row.get("row_index"),
+        "version": row.get("version", 1),
+        "cells": row.get("cells", {}),
+        "created_at": row.get("updated_at") or now_iso(),
+    })
+
+
+async def maybe_snapshot(db, sheet_id: str, row_id: str, new_version: int):
+    if should_snapshot(new_version):
+        await take_snapshot(db, sheet_id, row_id)
+
+
+# ---------- reconstruction ----------
+async def _deletion(db, sheet_id: str, row_id: str) -> Optional[Dict[str, Any]]:
+    return await db.changes.find_one({"spreadsheet_id": sheet_id, "row_id": row_id, "op_type": "delete_row"},
+                                     sort=[("created_at", -1)])
+
+
+async def row_state_at(db, sheet_id: str, row_id: str, at: str) -> Optional[Dict[str, Any]]:
+    """
+    {"cells", "version"} of the row as of ISO timestamp `at`, or None if it didn't
+    exist at the time (not created yet, or already deleted). Raises ValueError on
+    a malformed timestamp.
+    """
+    at = normalize_ts(at)
+    before = await db.row_snapshots.find_one(
+        {"spreadsheet_id": sheet_id, "row_id": row_id, "created_at": {"$lte": at}}, sort=[("created_at", -1)])
+    if before is not None:
+        cells = dict(before.get("cells", {}))
+        version = before["version"]
+        cursor = db.changes.find({"spreadsheet_id": sheet_id, "row_id": row_id,
+                                  "created_at": {"$gte": before["created_at"], "$lte": at}}).sort("created_at", 1)
+        async for change in cursor:
+            v = delta_version(change)
+            if v > version:
+                if change.get("op_type") == "delete_row":
+                    return None
+                apply_forward(cells, change)
+                version = v
+        return {"cells": cells, "version": version}
+
+    after = await db.row_snapshots.find_one(
+        {"spreadsheet_id": sheet_id, "row_id": row_id, "created_at": {"$gt": at}}, sort=[("created_at", 1)])
+    if after is None:
+        row = await db.rows.find_one({"_id": row_id}, {"cells": 1, "version": 1, "updated_at": 1})
+        if row is not None:
+            after = {"cells": row.get("cells", {}), "version": row.get("version", 1)}
+        else:
+            # a deleted row: undo from its state right before the deletion
+            deleted = await _deletion(db, sheet_id, row_id)
+            if deleted is None or deleted["created_at"] <= at:
+                return None
+            after = {"cells": (deleted.get("payload") or {}).get("cells") or {},
+                     "version": delta_version(deleted) - 1}
+    cells = dict(after.get("cells", {}))
+    version = after.get("version", 1)
+    cursor = db.changes.find({"spreadsheet_id": sheet_id, "row_id": row_id,
+                              "created_at": {"$gt": at}}).sort("created_at", -1)
+    async for change in cursor:
+        v = delta_version(change)
+        if v > version:
+            continue
+        if is_creation(change):
+            return None
+        apply_backward(cells, change)
+        version = v - 1
+    return {"cells": cells, "version": version}
+
+
+async def sheet_state_at(db, sheet_id: str, at: str, start: int, end: int) -> List[Dict[str, Any]]:
+    at = normalize_ts(at)
+    cursor = db.rows.find({"spreadsheet_id": sheet_id, "row_index": {"$gte": start, "$lte": end}},
+                          {"row_index": 1}).sort("row_index", 1)
+    rows = [r async for r in cursor]
+    states = await asyncio.gather(*(row_state_at(db, sheet_id, r["_id"], at) for r in rows))
+    return [{"row_index": r["row_index"], "cells": s["cells"], "version": s["version"]}
+            for r, s in zip(rows, states) if s is not None]
+
+
+# ---------- compaction ----------
+async def compact_row(db, sheet_id: str, row_id: str, cutoff: str) -> int:
+    """
+    Fold deltas older than cutoff into a snapshot at/before cutoff; returns deleted count.
+    The row's creation record is kept, so it still reads as not existing before it;
+    a row deleted before the cutoff gets its snapshot as of right before the deletion.
+    """
+    cutoff = normalize_ts(cutoff)
+    snap = await db.row_snapshots.find_one(
+        {"spreadsheet_id": sheet_id, "row_id": row_id, "created_at": {"$lte": cutoff}}, sort=[("created_at", -1)])
+    if snap is None:
+        state = await row_state_at(db, sheet_id, row_id, cutoff)
+        created_at = cutoff
+        if state is None:
+            deleted = await _deletion(db, sheet_id, row_id)
+            if deleted is None or deleted["created_at"] > cutoff:
+                return 0
+            state = {"cells": (deleted.get("payload") or {}).get("cells") or {},
+                     "version": delta_version(deleted) - 1}
+            created_at = deleted["created_at"]
+        snap = {
+            "spreadsheet_id": sheet_id,
+            "row_id": row_id,
+            "version": state["version"],
+            "cells": state["cells"],
+            "created_at": created_at,
+        }
+        await db.row_snapshots.insert_one(snap)
+    ids = []
+    cursor = db.changes.find({"spreadsheet_id": sheet_id, "row_id": row_id, "created_at": {"$lt": cutoff}},
+                             {"op_type": 1, "version": 1, "payload.new_version": 1, "payload.prev_version": 1})
+    async for change in cursor:
+        if delta_version(change) <= snap["version"] and not is_creation(change):
+            ids.append(change["_id"])
+    if ids:
+        await db.changes.delete_many({"_id": {"$in": ids}})
+    return len(ids)
+
+
+async def compact_sheet(db, sheet_id: str, retention_days: float = HISTORY_RETENTION_DAYS) -> Dict[str, Any]:
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+    row_ids = await db.changes.distinct("row_id", {"spreadsheet_id": sheet_id, "created_at": {"$lt": cutoff}})
+    deleted = 0
+    for row_id in row_ids:
+        deleted += await compact_row(db, sheet_id, row_id, cutoff)
+    return {"spreadsheet_id": sheet_id, "cutoff": cutoff, "rows": len(row_ids), "deleted_changes": deleted}
+
+
+async def compaction_loop(db, every: float = HISTORY_COMPACT_EVERY):
+    while True:
+        await asyncio.sleep(every)
+        async for sheet in db.spreadsheets.find({}, {"_id": 1}):
+            try:
+                await compact_sheet(db, sheet["_id"])
+            except Exception:
+                logger.exception("history compaction failed for %s", sheet["_id"])
+
+
+# ---------- resume ----------
+def _event(changes: List[Dict[str, Any]], cells_after: Dict[Any, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    The broadcast event that announced one seq's change records (see main.py).
+    cells_after: change _id -> the row's full cells right after it, for row_updated.
+    """
+    if any("row_index" not in c for c in changes):
+        return None
+    op = changes[0].get("op_type")
+    if op == "delete_row":
+        return {"type": "row_deleted", "row_index": changes[0]["row_index"]}
+    if op == "insert_row":
+        rows = [{"row_index": c["row_index"], "cells": (c.get("payload") or {}).get("cells") or {}, "version": 1}
+                for c in changes]
+        if len(changes) == 1 and "order_key" not in (changes[0].get("payload") or {}):
+            return {"type": "row_inserted", "row": rows[0]}
+        for row, c in zip(rows, changes):
+            row["order_key"] = c["payload"].get("order_key")
+        return {"type": "rows_inserted", "rows": rows}
+    rows = [{"row_index": c["row_index"], "version": delta_version(c),
+             "cells": {col: d.get("new") for col, d in ((c.get("payload") or {}).get("changes") or {}).items()}}
+            for c in changes]
+    if len(rows) == 1:
+        row = rows[0]
+        return row_updated(row["row_index"], cells_after[changes[0]["_id"]], row["cells"], row["version"])
+    cols = sorted({col for r in rows for col in r["cells"] if col in COLUMN_INDEX}, key=COLUMN_INDEX.get)
+    return {"type": "range_updated",
+            "range": {"start_row": min(r["row_index"] for r in rows), "start_col": cols[0] if cols else None,
+                      "end_row": max(r["row_index"] for r in rows), "end_col": cols[-1] if cols else None},
+            "rows": rows}
+
+
+async def _cells_after(db, sheet_id: str, changes: List[Dict[str, Any]], after: int) -> Dict[Any, Dict[str, Any]]:
+    """
+    Full cells of the row right after each of `changes` (change _id -> cells):
+    starting from the row as it is now, later changes are undone newest first.
+    """
+    row_ids = list({c["row_id"] for c in changes})
+    size = await tiles.layout(db, sheet_id)
+    current: Dict[Any, Dict[str, Any]] = {}
+    if size:
+        for c in changes:
+            if c["row_id"] not in current:
+                rows = await tiles.load_rows(db, sheet_id, size, c["row_index"], c["row_index"])
+                current[c["row_id"]] = rows[0]["cells"] if rows else {}
+    else:
+        async for row in db.rows.find({"_id": {"$in": row_ids}}, {"cells": 1}):
+            current[row["_id"]] = row.get("cells", {})
+    wanted = {c["_id"] for c in changes}
+    out = {}
+    cursor = db.changes.find({"spreadsheet_id": sheet_id, "row_id": {"$in": row_ids}, "seq": {"$gt": after}},
+                             {"row_id": 1, "op_type": 1, "payload": 1}).sort("seq", -1)
+    async for c in cursor:
+        cells = current.setdefault(c["row_id"], {})
+        if c["_id"] in wanted:
+            out[c["_id"]] = dict(cells)
+        if c.get("op_type") == "delete_row":
+            current[c["row_id"]] = dict((c.get("payload") or {}).get("cells") or {})
+        elif c.get("op_type") == "insert_row":
+            current[c["row_id"]] = {}
+        else:
+            apply_backward(cells, c)
+    return out
+
+
+async def events_since(db, sheet_id: str, after: int, upto: int, limit: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Events with seq after..upto rebuilt from the changes log, in seq order. None when
+    more than `limit` are missing or any of them has no change record: it was
+    compacted away, or the event isn't logged (recalculations, moves, rebalances).
+    """
+    if upto - after > limit:
+        return None
+    by_seq: Dict[int, List[Dict[str, Any]]] = {}
+    cursor = db.changes.find({"spreadsheet_id": sheet_id, "seq": {"$gt": after, "$lte": upto}},
+                             {"seq": 1, "row_id": 1, "row_index": 1, "op_type": 1, "payload": 1, "version": 1}
+                             ).sort("seq", 1)
+    async for c in cursor:
+        by_seq.setdefault(c["seq"], []).append(c)
+    if len(by_seq) != upto - after:
+        return None
+    updates = [cs[0] for cs in by_seq.values()
+               if len(cs) == 1 and cs[0].get("op_type") not in ("insert_row", "delete_row")]
+    cells_after = await _cells_after(db, sheet_id, updates, after) if updates else {}
+    events = []
+    for seq in range(after + 1, upto + 1):
+        event = _event(by_seq[seq], cells_after)
+        if event is None:
+            return None
+        out = {"seq": seq}
+        out.update(event)
+        events.append(out)
+    return events
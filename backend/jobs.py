@@ -0,0 +1,321 @@
+"""
+Background import/export jobs on a bounded process pool.
+
+openpyxl parsing and workbook serialization are CPU-bound pure Python. Run on
+the event loop (or in a thread, which still holds the GIL), one large workbook
+stalls every request and WebSocket on the worker. Here the CPU part runs in a
+ProcessPoolExecutor of JOB_WORKERS processes and the event loop only moves
+BSON bytes between the pool and Mongo:
+
+- import: the worker parses the upload and writes each batch of row (or tile)
+  documents to a spool file as BSON; the loop inserts the batches as they appear,
+  so rows land while the parse is still running;
+- export: the loop spools the sheet's rows to a BSON file, the worker builds the
+  .xlsx from it (xlsx_export.write_xlsx) into the job's directory.
+
+Workbook jobs (workbooks.py) do the same per worksheet, with all worksheets in
+flight at once, so with enough JOB_WORKERS a workbook takes about as long as its
+largest tab rather than the sum of its tabs.
+
+At most JOB_WORKERS jobs run at a time per instance; up to JOB_MAX_PENDING may
+be queued or running, anything beyond that is refused with 429. Job state is
+kept in process (like xlsx_import.ImportTracker), so status and downloads must
+be asked of the instance that accepted the job. Finished export files are
+removed when their job is evicted (FINISHED_JOBS_KEPT) or at shutdown.
+"""
+import os
+import uuid
+import shutil
+import asyncio
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Tuple, AsyncIterator, Callable, Awaitable
+
+import bson
+from fastapi import HTTPException
+
+import tiles
+import metrics
+import xlsx_import
+import xlsx_export
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(min(2, os.cpu_count() or 1))))
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "16"))
+# "spawn" keeps the workers free of the parent's event loop, threads and sockets
+JOB_START_METHOD = os.getenv("JOB_START_METHOD", "spawn")
+FINISHED_JOBS_KEPT = 100
+SPOOL_POLL_SECONDS = 0.05
+SPOOL_WRITE_BYTES = 1024 * 1024
+
+
+def now_iso():
+    return datetime.utcnow().isoformat()
+
+
+# ---------- worker process side ----------
+def parse_import(path: str, sheet_id: str, batch_size: int, tile_rows: Optional[int], spool_dir: str,
+                 worksheet: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Parse a worksheet (the active one by default) into spool_dir/000001.bson,
+    000002.bson, ... (one insert_many batch each, renamed into place when complete).
+    Returns the number of rows and the parse counts for the parent's metrics
+    (nobody scrapes the pool process's own).
+    """
+    cells, seconds = metrics.IMPORT_PARSE_CELLS.value(), metrics.IMPORT_PARSE_SECONDS.value()
+    rows = 0
+    for n, batch in enumerate(xlsx_import.iter_row_batches(path, sheet_id, batch_size, worksheet), start=1):
+        rows += len(batch)
+        docs = tiles.pack_rows(sheet_id, tile_rows, batch, batch[0]["updated_at"]) if tile_rows else batch
+        tmp = os.path.join(spool_dir, f"{n:06d}.tmp")
+        with open(tmp, "wb") as f:
+            for d in docs:
+                f.write(bson.encode(d))
+        os.replace(tmp, os.path.join(spool_dir, f"{n:06d}.bson"))
+    return {"rows": rows, "parse_cells": metrics.IMPORT_PARSE_CELLS.value() - cells,
+            "parse_seconds": metrics.IMPORT_PARSE_SECONDS.value() - seconds}
+
+
+def build_export(spool_path: str, out_path: str, title: str) -> int:
+    """Write an .xlsx from a spool of BSON row docs in sheet order; returns the number of rows."""
+    with open(spool_path, "rb") as f, open(out_path, "wb") as out:
+        return xlsx_export.write_xlsx(bson.decode_file_iter(f), out, title)
+
+
+def render_sheet(spool_path: str, xml_path: str) -> int:
+    """One worksheet part of a multi-sheet export (xlsx_export.write_sheet_xml); returns the number of rows."""
+    with open(spool_path, "rb") as f, open(xml_path, "wb") as out:
+        return xlsx_export.write_sheet_xml(bson.decode_file_iter(f), out)
+
+
+def build_workbook(sheets: List[Tuple[str, str]], out_path: str):
+    with open(out_path, "wb") as out:
+        xlsx_export.write_workbook(sheets, out)
+
+
+def _count_parse(done: "asyncio.Future"):
+    if not done.cancelled() and done.exception() is None:
+        report = done.result()
+        metrics.IMPORT_PARSE_CELLS.inc(amount=report["parse_cells"])
+        metrics.IMPORT_PARSE_SECONDS.inc(amount=report["parse_seconds"])
+
+
+def _read_batch(path: str) -> List[Dict[str, Any]]:
+    with open(path, "rb") as f:
+        docs = bson.decode_all(f.read())
+    os.unlink(path)
+    return docs
+
+
+def _append(path: str, data: bytes):
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+# ---------- event loop side ----------
+class JobRunner:
+    def __init__(self, workers: int = JOB_WORKERS, max_pending: int = JOB_MAX_PENDING,
+                 keep_finished: int = FINISHED_JOBS_KEPT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self.active: Dict[str, Dict[str, Any]] = {}
+        self.finished: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._workdir: Optional[str] = None
+
+    # resources are created on first use, inside the running loop
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(JOB_START_METHOD))
+        return self._executor
+
+    def job_dir(self, job_id: str) -> str:
+        if self._workdir is None:
+            self._workdir = tempfile.mkdtemp(prefix="noexcel-jobs-")
+        path = os.path.join(self._workdir, job_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    async def call(self, fn, *args):
+        """Run a module-level function in a pool process."""
+        return await asyncio.get_running_loop().run_in_executor(self._pool(), fn, *args)
+
+    # ---------- jobs ----------
+    def submit(self, kind: str, fn: Callable[[Dict[str, Any]], Awaitable[Any]], **info) -> Dict[str, Any]:
+        """
+        Queue fn(state) and return its state at once; 429 when JOB_MAX_PENDING jobs
+        are already queued or running. fn may update state["progress"].
+        """
+        if len(self.active) >= self.max_pending:
+            raise HTTPException(status_code=429, detail="too_many_jobs", headers={"Retry-After": "5"})
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        job_id = str(uuid.uuid4())
+        state = {"job_id": job_id, "kind": kind, "status": "queued", "progress": {"rows": 0},
+                 "result": None, "error": None, "created_at": now_iso(), "started_at": None, "finished_at": None}
+        state.update(info)
+        self.active[job_id] = state
+        self._tasks[job_id] = asyncio.create_task(self._run(state, fn))
+        return state
+
+    async def _run(self, state: Dict[str, Any], fn):
+        job_id = state["job_id"]
+        try:
+            async with self._slots:
+                state["status"] = "running"
+                state["started_at"] = now_iso()
+                state["result"] = await fn(state)
+                state["status"] = "done"
+        except asyncio.CancelledError:
+            state["status"], state["error"] = "failed", "cancelled"
+            raise
+        except Exception as e:
+            state["status"], state["error"] = "failed", str(e) or type(e).__name__
+        finally:
+            state["finished_at"] = now_iso()
+            self.active.pop(job_id, None)
+            self._tasks.pop(job_id, None)
+            self.finished[job_id] = state
+            while len(self.finished) > self.keep_finished:
+                old_id, _ = self.finished.popitem(last=False)
+                self._remove_files(old_id)
+
+    async def wait(self, job_id: str) -> Dict[str, Any]:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.shield(task)
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.active.get(job_id) or self.finished.get(job_id)
+
+    def list_active(self) -> List[Dict[str, Any]]:
+        return list(self.active.values())
+
+    def _remove_files(self, job_id: str):
+        if self._workdir is not None:
+            shutil.rmtree(os.path.join(self._workdir, job_id), ignore_errors=True)
+
+    def shutdown(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._workdir is not None:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+
+    # ---------- building blocks for job functions ----------
+    async def import_batches(self, job_id: str, path: str, sheet_id: str, batch_size: int,
+                             tile_rows: Optional[int] = None,
+                             worksheet: Optional[str] = None) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Documents to insert for a worksheet of an .xlsx, batch by batch, parsed in the
+        pool: row docs, or tile docs when tile_rows is set (batch_size must be
+        tile-aligned). Several worksheets of one job can be read concurrently.
+        """
+        spool_dir = os.path.join(self.job_dir(job_id), sheet_id)
+        os.makedirs(spool_dir, exist_ok=True)
+        parse = asyncio.ensure_future(self.call(parse_import, path, sheet_id, batch_size, tile_rows, spool_dir,
+                                                worksheet))
+        parse.add_done_callback(_count_parse)
+        n = 1
+        try:
+            while True:
+                batch_path = os.path.join(spool_dir, f"{n:06d}.bson")
+                if os.path.exists(batch_path):
+                    yield await asyncio.to_thread(_read_batch, batch_path)
+                    n += 1
+                elif parse.done():
+                    # re-raises a parse error; otherwise every batch file was written before it finished
+                    parse.result()
+                    if not os.path.exists(batch_path):
+                        return
+                else:
+                    await asyncio.wait([parse], timeout=SPOOL_POLL_SECONDS)
+        finally:
+            if parse.done():
+                shutil.rmtree(spool_dir, ignore_errors=True)
+            else:
+                # the worker can't be interrupted; its files go when the job is evicted
+                parse.cancel()
+
+    async def _spool_rows(self, rows: AsyncIterator[Dict[str, Any]], spool_path: str,
+                          progress: Optional[Dict[str, Any]]) -> int:
+        buf = bytearray()
+        count = counted = 0
+        async for r in rows:
+            buf += bson.encode({"position": r.get("position"), "cells": r.get("cells") or {}})
+            count += 1
+            if len(buf) >= SPOOL_WRITE_BYTES:
+                await asyncio.to_thread(_append, spool_path, bytes(buf))
+                buf.clear()
+                if progress is not None:
+                    progress["rows"] += count - counted
+                    counted = count
+        await asyncio.to_thread(_append, spool_path, bytes(buf))
+        if progress is not None:
+            progress["rows"] += count - counted
+        return count
+
+    async def export_file(self, job_id: str, rows: AsyncIterator[Dict[str, Any]], title: str,
+                          progress: Optional[Dict[str, Any]] = None) -> str:
+        """Spool rows to the job's directory and build the .xlsx in the pool; returns its path."""
+        job_dir = self.job_dir(job_id)
+        spool_path = os.path.join(job_dir, "rows.bson")
+        await self._spool_rows(rows, spool_path, progress)
+        if progress is not None:
+            progress["phase"] = "writing"
+        out_path = os.path.join(job_dir, "export.xlsx")
+        try:
+            await self.call(build_export, spool_path, out_path, title)
+        finally:
+            os.unlink(spool_path)
+        return out_path
+
+    async def export_workbook_file(self, job_id: str, sheets: List[Tuple[str, AsyncIterator[Dict[str, Any]]]],
+                                   progress: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Multi-sheet export from (title, rows) pairs. Every sheet's cursor is drained
+        concurrently and every sheet part is rendered in its own pool task; only the
+        final zip step (deflate, in C) handles the sheets one after another.
+        """
+        job_dir = self.job_dir(job_id)
+        titles = xlsx_export.unique_titles([title for title, _ in sheets])
+
+        async def render(i: int, rows) -> str:
+            spool_path = os.path.join(job_dir, f"sheet{i}.bson")
+            xml_path = os.path.join(job_dir, f"sheet{i}.xml")
+            await self._spool_rows(rows, spool_path, progress)
+            try:
+                await self.call(render_sheet, spool_path, xml_path)
+            finally:
+                os.unlink(spool_path)
+            if progress is not None:
+                progress["sheets_done"] = progress.get("sheets_done", 0) + 1
+            return xml_path
+
+        parts = await gather_all(*(render(i, rows) for i, (_, rows) in enumerate(sheets, start=1)))
+        if progress is not None:
+            progress["phase"] = "writing"
+        out_path = os.path.join(job_dir, "export.xlsx")
+        try:
+            await self.call(build_workbook, list(zip(titles, parts)), out_path)
+        finally:
+            for path in parts:
+                os.unlink(path)
+        return out_path
+
+
+async def gather_all(*aws) -> list:
+    """asyncio.gather that lets every awaitable finish before raising the first error."""
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+    return results
@@ -4,33 +4,58 @@ FastAPI + MongoDB (motor) backend for row-centric spreadsheet.
 
 Run:
     pip install fastapi uvicorn motor pydantic openpyxl python-multipart python-dateutil
-    MONGODB_URI=mongodb://localhost:27017 uvicorn backend_mongo:app --reload
+    # from the repository root, so the shared `database` package is importable
+    MONGODB_URI=mongodb://localhost:27017 python -m uvicorn main:app --app-dir backend --reload
 
 Notes:
-- For production, set MONGODB_URI env var, enable authentication, and use Redis pub/sub
-  if you run multiple backend instances (so real-time messages are delivered across instances).
+- For production, set MONGODB_URI env var and enable authentication.
+- The connection pool (size, timeouts, read preference) is shared with the other apps and
+  configured by MONGO_* env vars, see database/database.py.
+- With more than one worker/instance set BROADCAST_BUS=redis and REDIS_URL (pip install redis)
+  so real-time messages are delivered across instances (see broadcast_bus.py).
+- Prometheus metrics are served on /metrics (METRICS_ENABLED=0 turns the hooks off, see metrics.py).
+- xlsx parsing for imports and /api/jobs exports run in a pool of JOB_WORKERS processes (see jobs.py).
 """
 import os
-import io
+import time
 import uuid
 import json
 from datetime import datetime
 from typing import Dict, Any, Optional, List
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Body
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-import motor.motor_asyncio
-import openpyxl
-from dateutil import parser as dateparser
+from pydantic import BaseModel
+from pymongo import UpdateOne, ReturnDocument
 import asyncio
 
-MONGO_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
-DB_NAME = os.getenv("MONGODB_DB", "sheets_db")
+import xlsx_import
+import xlsx_export
+import typed_values
+from columns import COLUMN_LETTERS, COLUMN_INDEX, MAX_COLUMNS, parse_column_spec
+from realtime import ConnectionManager, encode as encode_frame
+from wire import negotiate, row_updated
+from broadcast_bus import bus_from_env
+from row_cache import RowCache
+import history
+import formulas
+import recalc
+import aggregates
+import queries
+import search
+import write_behind
+import row_order
+import tiles
+import jobs
+import workbooks
+import metrics
+from database import get_database
 
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
-db = client[DB_NAME]
+MAX_RANGE_CELLS = int(os.getenv("MAX_RANGE_CELLS", "100000"))
+
+database = get_database(event_listeners=metrics.mongo_listeners())
+db = database.db
 
 app = FastAPI(title="Row-centric spreadsheet (FastAPI + MongoDB)")
 
@@ -40,6 +65,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 # ---------- Pydantic models ----------
 class CellModel(BaseModel):
@@ -54,186 +80,925 @@ class RowModel(BaseModel):
 
 class CreateSpreadsheetReq(BaseModel):
     title: str
+    storage: Optional[str] = None  # "rows" (one document per row) or "tiled", see tiles.py
 
 class PatchRowReq(BaseModel):
     changes: Dict[str, Any]  # e.g. {"B": {"old": {...}, "new": {...}}}
     user_id: Optional[str] = None
     expected_version: Optional[int] = None
 
+class RangeWriteReq(BaseModel):
+    start_row: int
+    start_col: str = "A"
+    values: List[List[Any]]  # values[i][j] -> (start_row + i, start_col + j); None clears the cell
+    user_id: Optional[str] = None
+    expected_versions: Optional[Dict[int, int]] = None  # row_index -> version
+
+class AggregateSpec(BaseModel):
+    op: str  # sum | avg | min | max | count
+    column: str
+
+class AggregateFilter(BaseModel):
+    column: str
+    op: str = "eq"  # eq | ne | gt | gte | lt | lte | in | nin
+    value: Any = None
+
+class AggregateReq(BaseModel):
+    aggregates: List[AggregateSpec]
+    group_by: Optional[str] = None
+    start_row: Optional[int] = None
+    end_row: Optional[int] = None
+    filters: List[AggregateFilter] = []
+
+class QueryFilter(BaseModel):
+    column: str
+    op: str = "eq"  # eq | ne | gt | gte | lt | lte | in | nin | prefix | exists | type
+    value: Any = None
+
+class QueryReq(BaseModel):
+    where: List[QueryFilter] = []
+    sort: Optional[str] = None  # "E" ascending, "-E" descending; row_index order by default
+    limit: int = queries.QUERY_DEFAULT_LIMIT
+    cursor: Optional[str] = None  # next_cursor of the previous page
+    columns: Optional[str] = None  # e.g. "A,C,F:H", as in get_rows
+
+class WriteBehindReq(BaseModel):
+    enabled: bool = True
+    window_ms: Optional[int] = None  # flush a row after this long without edits
+    max_delay_ms: Optional[int] = None  # ... and at the latest this long after its first buffered edit
+
+class InsertRowsReq(BaseModel):
+    # where: exactly one of position (0-based display position), before_row_index, after_row_index
+    position: Optional[int] = None
+    before_row_index: Optional[int] = None
+    after_row_index: Optional[int] = None
+    count: int = 1
+    rows: Optional[List[Dict[str, Any]]] = None  # cells of the new rows; defaults to empty rows
+    user_id: Optional[str] = None
+
+class MoveRowsReq(BaseModel):
+    row_indexes: List[int]  # moved as a block, in their current display order
+    position: Optional[int] = None  # display position among the rows that are not moved
+    before_row_index: Optional[int] = None
+    after_row_index: Optional[int] = None
+    user_id: Optional[str] = None
+
 # ---------- Utilities ----------
 def now_iso():
     return datetime.utcnow().isoformat()
 
-def parse_typed_value(value):
-    """Try to detect number/date/datetime; otherwise return string type."""
-    if value is None:
-        return {"type": "string", "value": None}
-    if isinstance(value, (int, float, bool)):
-        return {"type": "number", "value": value}
-    if isinstance(value, dict):
-        return {"type": "json", "value": value}
-    s = str(value).strip()
-    # number
+parse_typed_value = metrics.timed_calls(metrics.PARSE_CALLS, metrics.PARSE_SECONDS)(typed_values.parse_typed_value)
+
+def normalize_cell(value):
+    """Stored cell for an incoming value: "=..." strings and {"type": "formula"} become formula cells."""
     try:
-        if '.' in s:
-            f = float(s)
-            return {"type": "number", "value": f}
-        else:
-            i = int(s)
-            return {"type": "number", "value": i}
-    except Exception:
-        pass
-    # datetime
+        if isinstance(value, dict):
+            if value.get("type") == "formula":
+                return formulas.formula_cell(str(value.get("formula") or value.get("value") or ""))
+            return value
+        if formulas.is_formula_text(value):
+            return formulas.formula_cell(value)
+    except formulas.FormulaSyntaxError as e:
+        raise HTTPException(status_code=400, detail={"error": "invalid_formula", "message": str(e)})
+    return parse_typed_value(value)
+
+def storage_fields(storage: Optional[str]) -> Dict[str, Any]:
     try:
-        dt = dateparser.parse(s)
-        # decide date vs datetime naive heuristic
-        if dt.hour == 0 and dt.minute == 0 and dt.second == 0 and ':' not in s:
-            return {"type": "date", "value": dt.date().isoformat()}
-        else:
-            return {"type": "datetime", "value": dt.isoformat()}
-    except Exception:
-        pass
-    return {"type": "string", "value": s}
-
-# ---------- Simple in-memory WebSocket connection manager ----------
-# Map: sheet_id -> set of WebSocket
-class ConnectionManager:
-    def __init__(self):
-        self._lock = asyncio.Lock()
-        self.connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, sheet_id: str, websocket: WebSocket):
-        await websocket.accept()
-        async with self._lock:
-            self.connections.setdefault(sheet_id, []).append(websocket)
-
-    async def disconnect(self, sheet_id: str, websocket: WebSocket):
-        async with self._lock:
-            conns = self.connections.get(sheet_id)
-            if not conns:
-                return
-            if websocket in conns:
-                conns.remove(websocket)
-            if len(conns) == 0:
-                self.connections.pop(sheet_id, None)
-
-    async def broadcast(self, sheet_id: str, message: Dict[str, Any]):
-        async with self._lock:
-            conns = list(self.connections.get(sheet_id, []))
-        coros = []
-        for ws in conns:
-            coros.append(ws.send_json(message))
-        if coros:
-            await asyncio.gather(*coros, return_exceptions=True)
-
-manager = ConnectionManager()
+        fields = tiles.sheet_fields(storage)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_storage")
+    if "tile_rows" not in fields:
+        # indexed for search from the first row on (see search.py)
+        fields["search_index"] = search.READY
+        fields["formula_cells"] = 0
+    return fields
+
+async def require_row_storage(sheet_id: str):
+    """409 for features that need one document per row (order keys, ranges, aggregates, formulas, history)."""
+    if await tiles.layout(db, sheet_id):
+        raise HTTPException(status_code=409, detail={"error": "unsupported_for_tiled_sheet"})
+
+# ---------- WebSocket fanout (see realtime.py) ----------
+WS_RESUME_MAX_EVENTS = int(os.getenv("WS_RESUME_MAX_EVENTS", "1000"))
+
+async def next_event_seq(sheet_id: str) -> int:
+    """Per-sheet event sequence, kept on the spreadsheet doc so every instance shares it."""
+    doc = await database.spreadsheets.next_event_seq(sheet_id, {"event_seq": 1, "formula_cells": 1})
+    if not doc:
+        return 0
+    # fresh for the recalc check that follows the write (see recalc.py)
+    recalc.remember(sheet_id, doc)
+    return doc["event_seq"]
+
+async def current_event_seq(sheet_id: str) -> int:
+    doc = await database.spreadsheets.get_spreadsheet_info(sheet_id, {"event_seq": 1})
+    return (doc or {}).get("event_seq", 0)
+
+manager = ConnectionManager(bus=bus_from_env(), sequencer=next_event_seq)
+
+@app.on_event("startup")
+async def start_realtime():
+    await manager.start()
+
+# ---------- Write-behind (see write_behind.py) ----------
+async def write_behind_flushed(sheet_id: str, rows: List[Dict[str, Any]]):
+    """What patch_row does after its write, for a batch of flushed rows."""
+    for r in rows:
+        row_cache.invalidate_rows(sheet_id, r["row_index"], r["row_index"])
+        # the row skipped the versions in between; snapshot if one of them would have been
+        if any(history.should_snapshot(v) for v in range(r["prev_version"] + 1, r["version"] + 1)):
+            await history.take_snapshot(db, sheet_id, r["row_id"])
+        if r["conflict"]:
+            # another writer got in between; subscribers need the row's real version
+            await manager.broadcast(sheet_id, row_updated(r["row_index"], r["cells"], r["changes"], r["version"]))
+    agg_cache.invalidate_columns(sheet_id, {col for r in rows for col in r["changes"]})
+    await search.update(db, sheet_id, [(r["row_index"], r["changes"]) for r in rows])
+    await recalculate_after_write(
+        sheet_id,
+        {(COLUMN_INDEX[col], r["row_index"]): c["new"] for r in rows for col, c in r["changes"].items()
+         if col in COLUMN_INDEX},
+        {(COLUMN_INDEX[col], r["row_index"]) for r in rows for col, c in r["changes"].items()
+         if col in COLUMN_INDEX and isinstance(c["old"], dict) and c["old"].get("type") == "formula"})
+
+writes = write_behind.WriteBehind(sequencer=manager.next_seq, on_flush=write_behind_flushed)
+
+@app.on_event("startup")
+async def start_write_behind():
+    await writes.start(db)
+
+@app.on_event("shutdown")
+async def stop_write_behind():
+    # before the bus closes: flushing may still broadcast
+    await writes.stop()
+
+@app.on_event("shutdown")
+async def stop_realtime():
+    await manager.close()
+
+# ---------- History (see history.py) ----------
+@app.on_event("startup")
+async def start_history():
+    await database.init_indexes()
+    await history.ensure_indexes(db)
+    await recalc.ensure_indexes(db)
+    await recalc.count_formula_cells(db)
+    await row_order.ensure_indexes(db)
+    await tiles.ensure_indexes(db)
+    await workbooks.ensure_indexes(db)
+    await query_indexes.load(db)
+    await search.ensure_indexes(db)
+    if history.HISTORY_COMPACT_EVERY > 0:
+        app.state.history_compactor = asyncio.create_task(history.compaction_loop(db))
+
+@app.on_event("shutdown")
+async def stop_history():
+    task = getattr(app.state, "history_compactor", None)
+    if task is not None:
+        task.cancel()
 
 # ---------- Endpoints ----------
 @app.post("/api/spreadsheets")
 async def create_spreadsheet(req: CreateSpreadsheetReq):
     doc = {"_id": str(uuid.uuid4()), "title": req.title, "created_at": now_iso(), "updated_at": now_iso()}
-    await db.spreadsheets.insert_one(doc)
-    return {"id": doc["_id"], "title": req.title}
+    doc.update(storage_fields(req.storage))
+    await database.spreadsheets.insert_sheet(doc)
+    tiles.remember(doc["_id"], doc)
+    return {"id": doc["_id"], "title": req.title, "storage": doc.get("storage", "rows")}
 
-@app.get("/api/spreadsheets/{sheet_id}/rows")
-async def get_rows(sheet_id: str, start: int = 1, end: int = 100):
-    cursor = db.rows.find({"spreadsheet_id": sheet_id, "row_index": {"$gte": start, "$lte": end}}).sort("row_index", 1)
+row_cache = RowCache()
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+def rows_cursor(sheet_id: str, start: int, end: int, cols: Optional[List[str]] = None):
+    """Range cursor projected to what the API returns; cols limits cells to cells.<col> paths."""
+    projection = {"row_index": 1, "version": 1}
+    if cols is None:
+        projection["cells"] = 1
+    else:
+        projection.update({f"cells.{col}": 1 for col in cols})
+    return db.rows.find({"spreadsheet_id": sheet_id, "row_index": {"$gte": start, "$lte": end}},
+                        projection).sort("row_index", 1)
+
+async def load_rows(sheet_id: str, start: int, end: int, cols: Optional[List[str]] = None) -> List[Dict[str, Any]]:
     rows = []
-    async for r in cursor:
-        r["_id"] = str(r["_id"])
+    async for r in rows_cursor(sheet_id, start, end, cols):
         rows.append({"row_index": r["row_index"], "cells": r.get("cells", {}), "version": r.get("version", 1)})
     return rows
 
+async def stream_rows(rows, ndjson: bool):
+    """Yield rows straight from the cursor (or tiles.iter_rows) as NDJSON lines or as one chunked JSON array."""
+    buf = [] if ndjson else ["["]
+    size = 0
+    first = True
+    async for r in rows:
+        line = json.dumps({"row_index": r["row_index"], "cells": r.get("cells", {}), "version": r.get("version", 1)},
+                          separators=(",", ":"), ensure_ascii=False, default=str)
+        if ndjson:
+            line += "\n"
+        elif not first:
+            line = "," + line
+        first = False
+        buf.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_BYTES:
+            yield "".join(buf)
+            buf, size = [], 0
+    if not ndjson:
+        buf.append("]")
+    if buf:
+        yield "".join(buf)
+
+@app.get("/api/spreadsheets/{sheet_id}/rows")
+async def get_rows(sheet_id: str, start: int = 1, end: int = 100, columns: Optional[str] = None,
+                   stream: Optional[str] = None):
+    """
+    columns: e.g. "A,C,F:H" - only those cells are returned (Mongo projection on cells.<col>).
+    stream: "ndjson" or "json" - rows are streamed from the cursor (no buffering, no cache).
+    """
+    try:
+        cols = parse_column_spec(columns) if columns else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_columns")
+    tile_rows = await tiles.layout(db, sheet_id)
+    if stream is not None:
+        if stream not in ("ndjson", "json"):
+            raise HTTPException(status_code=400, detail="invalid_stream_format")
+        media_type = "application/x-ndjson" if stream == "ndjson" else "application/json"
+        rows = (tiles.iter_rows(db, sheet_id, tile_rows, start, end, cols) if tile_rows
+                else rows_cursor(sheet_id, start, end, cols))
+        return StreamingResponse(stream_rows(rows, stream == "ndjson"), media_type=media_type)
+    if tile_rows:
+        load = lambda lo, hi, cols=None: tiles.load_rows(db, sheet_id, tile_rows, lo, hi, cols)
+    else:
+        load = lambda lo, hi, cols=None: load_rows(sheet_id, lo, hi, cols)
+    if cols is None:
+        return await row_cache.get_window(sheet_id, start, end, load)
+    cached = row_cache.peek_window(sheet_id, start, end)
+    if cached is None:
+        return await load(start, end, cols)
+    return [{"row_index": r["row_index"], "cells": {c: r["cells"][c] for c in cols if c in r["cells"]},
+             "version": r["version"]} for r in cached]
+
+agg_cache = aggregates.AggregateCache()
+
+@app.post("/api/spreadsheets/{sheet_id}/aggregate")
+async def aggregate(sheet_id: str, req: AggregateReq = Body(...)):
+    """
+    SUM/AVG/MIN/MAX/COUNT over columns, optionally grouped by another column,
+    limited to a row range and filtered on cells.<col>.value; runs as one Mongo
+    aggregation and is cached until one of the columns it reads is written.
+    """
+    await require_row_storage(sheet_id)
+    try:
+        return await aggregates.run(db, agg_cache, sheet_id, req.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": "invalid_aggregate", "message": str(e)})
+
+@app.get("/api/aggregate_cache/stats")
+async def aggregate_cache_stats():
+    return agg_cache.stats()
+
+query_indexes = queries.ColumnIndexes()
+
+@app.post("/api/spreadsheets/{sheet_id}/query")
+async def query_rows(sheet_id: str, req: QueryReq = Body(...)):
+    """
+    Rows matching `where`, ordered by `sort`, one page of `limit` rows at a time
+    (pass next_cursor back as `cursor`). Columns that are queried often get an
+    index (see queries.py), so pages come from index scans.
+    """
+    await require_row_storage(sheet_id)
+    try:
+        cols = parse_column_spec(req.columns) if req.columns else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_columns")
+    try:
+        return await queries.run(db, query_indexes, sheet_id, req.model_dump(exclude={"columns"}), cols)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": "invalid_query", "message": str(e)})
+
+@app.get("/api/query_indexes/stats")
+async def query_index_stats():
+    return query_indexes.stats()
+
+@app.get("/api/spreadsheets/{sheet_id}/search")
+async def search_cells(sheet_id: str, q: str, limit: int = search.SEARCH_DEFAULT_LIMIT, cursor: Optional[str] = None):
+    """
+    String cells matching q as (row_index, column) hits: exact cell matches first,
+    then cells containing every word, then word prefixes (see search.py). Pass
+    next_cursor back as `cursor` for the next page.
+    """
+    sheet = await database.spreadsheets.get_spreadsheet_info(sheet_id, {"storage": 1, "search_index": 1})
+    if not sheet:
+        raise HTTPException(status_code=404, detail="spreadsheet_not_found")
+    if sheet.get("storage") == "tiled":
+        raise HTTPException(status_code=409, detail={"error": "unsupported_for_tiled_sheet"})
+    if sheet.get("search_index") != search.READY:
+        search.schedule_rebuild(db, sheet_id)
+        raise HTTPException(status_code=409, detail={"error": "search_index_building"})
+    try:
+        return await search.search(db, sheet_id, q, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": "invalid_search", "message": str(e)})
+
+@app.post("/api/spreadsheets/{sheet_id}/search/reindex", status_code=202)
+async def reindex_search(sheet_id: str):
+    """Rebuild the sheet's search index in the background; searches answer 409 until it is done."""
+    await require_row_storage(sheet_id)
+    if not await database.spreadsheets.get_spreadsheet_info(sheet_id, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="spreadsheet_not_found")
+    started = search.schedule_rebuild(db, sheet_id)
+    return {"ok": True, "started": started}
+
+@app.get("/api/row_cache/stats")
+async def row_cache_stats():
+    return row_cache.stats()
+
 @app.post("/api/spreadsheets/{sheet_id}/rows")
 async def insert_row(sheet_id: str, payload: RowModel):
     # ensure sheet exists
-    sheet = await db.spreadsheets.find_one({"_id": sheet_id})
+    sheet = await database.spreadsheets.get_spreadsheet_info(sheet_id)
     if not sheet:
         raise HTTPException(status_code=404, detail="spreadsheet_not_found")
-    existing = await db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": payload.row_index})
-    if existing:
-        raise HTTPException(status_code=400, detail="row_exists")
+    tiles.remember(sheet_id, sheet)
+    tiled = sheet.get("storage") == "tiled"
+    if not tiled:
+        existing = await db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": payload.row_index})
+        if existing:
+            raise HTTPException(status_code=400, detail="row_exists")
     cells_norm = {}
     for col, c in payload.cells.items():
-        if isinstance(c, dict):
-            cells_norm[col] = c
+        if isinstance(c, CellModel):
+            if c.type == "formula":
+                cells_norm[col] = normalize_cell({"type": "formula", "formula": c.value})
+            else:
+                cells_norm[col] = {"type": c.type, "value": c.value}
+            if c.meta is not None:
+                cells_norm[col]["meta"] = c.meta
         else:
-            cells_norm[col] = parse_typed_value(c)
+            cells_norm[col] = normalize_cell(c)
+    if tiled:
+        return await insert_tiled_row(sheet_id, sheet["tile_rows"], payload.row_index, cells_norm)
+    keys = await row_order.keys_for_indexes(db, sheet, [payload.row_index])
     row_doc = {
         "_id": str(uuid.uuid4()),
         "spreadsheet_id": sheet_id,
         "row_index": payload.row_index,
+        "order_key": keys[payload.row_index],
         "cells": cells_norm,
         "version": 1,
         "updated_by": None,
         "updated_at": now_iso(),
     }
     await db.rows.insert_one(row_doc)
-    # audit change
+    await search.add_rows(db, sheet_id, [row_doc])
+    # audit change, stamped with the seq of the event that announces it
+    seq = await manager.next_seq(sheet_id)
     change = {
         "_id": str(uuid.uuid4()),
         "spreadsheet_id": sheet_id,
         "row_id": row_doc["_id"],
+        "row_index": payload.row_index,
         "user_id": None,
         "op_type": "insert_row",
         "payload": {"row_index": payload.row_index, "cells": cells_norm},
-        "created_at": now_iso(),
+        "version": 1,
+        "seq": seq,
+        "created_at": row_doc["updated_at"],
     }
     await db.changes.insert_one(change)
+    row_cache.put_row(sheet_id, {"row_index": row_doc["row_index"], "cells": cells_norm, "version": 1})
+    agg_cache.invalidate_columns(sheet_id, cells_norm)
     # broadcast
-    await manager.broadcast(sheet_id, {"type": "row_inserted", "row": {"row_index": row_doc["row_index"], "cells": cells_norm, "version": 1}})
+    await manager.broadcast(sheet_id, {"type": "row_inserted", "row": {"row_index": row_doc["row_index"], "cells": cells_norm, "version": 1}},
+                            seq=seq)
+    await recalculate_after_write(sheet_id, {(COLUMN_INDEX[col], payload.row_index): cell
+                                             for col, cell in cells_norm.items() if col in COLUMN_INDEX}, set())
     return {"ok": True, "row_index": row_doc["row_index"]}
 
-@app.patch("/api/spreadsheets/{sheet_id}/rows/{row_index}")
-async def patch_row(sheet_id: str, row_index: int, req: PatchRowReq = Body(...)):
-    row = await db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": row_index})
-    if not row:
-        raise HTTPException(status_code=404, detail="row_not_found")
-    current_version = row.get("version", 1)
-    if req.expected_version is not None and req.expected_version != current_version:
-        raise HTTPException(status_code=409, detail={"error": "version_mismatch", "current_version": current_version})
-    cells = dict(row.get("cells", {}))
-    changes_record = {}
+async def insert_tiled_row(sheet_id: str, tile_rows: int, row_index: int, cells: Dict[str, Any]):
+    """insert_row for tiled sheets (see tiles.py); formulas need per-row storage."""
+    if any(c.get("type") == "formula" for c in cells.values()):
+        raise HTTPException(status_code=409, detail={"error": "unsupported_for_tiled_sheet"})
+    ts = now_iso()
+    if not await tiles.insert_row(db, sheet_id, tile_rows, row_index, cells, None, ts):
+        raise HTTPException(status_code=400, detail="row_exists")
+    seq = await manager.next_seq(sheet_id)
+    await db.changes.insert_one({
+        "_id": str(uuid.uuid4()),
+        "spreadsheet_id": sheet_id,
+        "row_id": tiles.row_id(sheet_id, row_index),
+        "row_index": row_index,
+        "user_id": None,
+        "op_type": "insert_row",
+        "payload": {"row_index": row_index, "cells": cells},
+        "version": 1,
+        "seq": seq,
+        "created_at": ts,
+    })
+    row = {"row_index": row_index, "cells": cells, "version": 1}
+    row_cache.put_row(sheet_id, row)
+    await manager.broadcast(sheet_id, {"type": "row_inserted", "row": row}, seq=seq)
+    return {"ok": True, "row_index": row_index}
+
+async def recalculate_after_write(sheet_id: str, written: Dict[Any, Any], was_formula: set):
+    """Update the formula graph for written cells and push recalculated formula values (see recalc.py)."""
+    if any(c is not None and c.get("type") == "formula" for c in written.values()) or was_formula:
+        await recalc.update_graph(db, sheet_id, written, was_formula)
+    if not await recalc.has_formulas(db, sheet_id):
+        return
+    rows = await recalc.recalculate(db, sheet_id, written)
+    if not rows:
+        return
+    for r in rows:
+        row_cache.invalidate_rows(sheet_id, r["row_index"], r["row_index"])
+        agg_cache.invalidate_columns(sheet_id, r["cells"])
+    await manager.broadcast(sheet_id, {"type": "cells_recalculated", "rows": rows})
+
+def patched_cells(req: PatchRowReq) -> Dict[str, Any]:
+    """col -> normalized new cell (None clears it) for a patch request."""
+    new_cells = {}
     for col, change in req.changes.items():
+        if "." in col or col.startswith("$"):
+            raise HTTPException(status_code=400, detail="invalid_column")
         new_cell = change.get("new")
-        if new_cell is None:
-            old = cells.pop(col, None)
-            changes_record[col] = {"old": old, "new": None}
-        else:
-            if not isinstance(new_cell, dict):
-                normalized = parse_typed_value(new_cell)
-            else:
-                normalized = new_cell
-            old = cells.get(col)
-            cells[col] = normalized
-            changes_record[col] = {"old": old, "new": normalized}
+        new_cells[col] = None if new_cell is None else normalize_cell(new_cell)
+    return new_cells
+
+def cells_after(old_cells: Dict[str, Any], new_cells: Dict[str, Any]) -> Dict[str, Any]:
+    """The row's cells once a patch is applied to its pre-image."""
+    cells = {col: cell for col, cell in old_cells.items() if col not in new_cells}
+    cells.update({col: cell for col, cell in new_cells.items() if cell is not None})
+    return cells
+
+@app.patch("/api/spreadsheets/{sheet_id}/rows/{row_index}")
+async def patch_row(sheet_id: str, row_index: int, req: PatchRowReq = Body(...)):
+    """
+    Single round trip: one find_one_and_update that $set/$unset's only the touched
+    cells.<col> paths and bumps the version, returning the row's pre-image for the
+    audit record and the full-row broadcast. Edits to different cells of one row never clobber
+    each other; expected_version, when given, is part of the filter.
+    """
+    new_cells = patched_cells(req)
+    to_set = {f"cells.{col}": cell for col, cell in new_cells.items() if cell is not None}
+    to_unset = {f"cells.{col}": "" for col, cell in new_cells.items() if cell is None}
+    await writes.flush_sheet(sheet_id)
+    tile_rows = await tiles.layout(db, sheet_id)
+    if tile_rows:
+        return await patch_tiled_row(sheet_id, tile_rows, row_index, req, new_cells)
+    to_set.update({"updated_by": req.user_id, "updated_at": now_iso()})
+    update_doc = {"$set": to_set, "$inc": {"version": 1}}
+    if to_unset:
+        update_doc["$unset"] = to_unset
+    flt = {"spreadsheet_id": sheet_id, "row_index": row_index}
+    if req.expected_version is not None:
+        flt["version"] = req.expected_version
+    # the whole pre-image: v1 subscribers get the full row (see wire.py)
+    before = await db.rows.find_one_and_update(flt, update_doc, projection={"version": 1, "cells": 1},
+                                               return_document=ReturnDocument.BEFORE)
+    if before is None:
+        # only the failure path pays for a second read to tell 404 from 409
+        row = await db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": row_index}, {"version": 1})
+        if not row:
+            raise HTTPException(status_code=404, detail="row_not_found")
+        raise HTTPException(status_code=409, detail={"error": "version_mismatch", "current_version": row.get("version", 1)})
+    current_version = before.get("version", 1)
     new_version = current_version + 1
-    update_doc = {
-        "$set": {
-            "cells": cells,
-            "version": new_version,
-            "updated_by": req.user_id,
-            "updated_at": now_iso()
-        }
-    }
-    await db.rows.update_one({"_id": row["_id"]}, update_doc)
+    old_cells = before.get("cells", {})
+    changes_record = {col: {"old": old_cells.get(col), "new": new} for col, new in new_cells.items()}
     # audit
+    seq = await manager.next_seq(sheet_id)
     change = {
         "_id": str(uuid.uuid4()),
         "spreadsheet_id": sheet_id,
-        "row_id": row["_id"],
+        "row_id": before["_id"],
+        "row_index": row_index,
         "user_id": req.user_id,
         "op_type": "update_cells",
         "payload": {"changes": changes_record, "prev_version": current_version, "new_version": new_version},
-        "created_at": now_iso(),
+        "version": new_version,
+        "seq": seq,
+        "created_at": to_set["updated_at"],
     }
     await db.changes.insert_one(change)
-    # broadcast
-    await manager.broadcast(sheet_id, {"type": "row_updated", "row": {"row_index": row_index, "cells": cells, "version": new_version}})
+    await history.maybe_snapshot(db, sheet_id, before["_id"], new_version)
+    await search.update(db, sheet_id, [(row_index, changes_record)])
+    row_cache.merge_cells(sheet_id, row_index, new_cells, new_version)
+    agg_cache.invalidate_columns(sheet_id, new_cells)
+    await manager.broadcast(sheet_id, row_updated(row_index, cells_after(old_cells, new_cells), new_cells, new_version),
+                            seq=seq)
+    await recalculate_after_write(
+        sheet_id,
+        {(COLUMN_INDEX[col], row_index): cell for col, cell in new_cells.items() if col in COLUMN_INDEX},
+        {(COLUMN_INDEX[col], row_index) for col in new_cells
+         if col in COLUMN_INDEX and isinstance(old_cells.get(col), dict) and old_cells[col].get("type") == "formula"})
     return {"ok": True, "row_index": row_index, "version": new_version}
 
+async def patch_row_buffered(sheet_id: str, row_index: int, req: PatchRowReq, config: Dict[str, int]):
+    """patch_row for write-behind sheets: acked and broadcast now, written by the next flush (see write_behind.py)."""
+    new_cells = patched_cells(req)
+    try:
+        result = await writes.apply(sheet_id, row_index, new_cells, req.user_id, req.expected_version, config)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="row_not_found")
+    except write_behind.VersionMismatch as e:
+        raise HTTPException(status_code=409, detail={"error": "version_mismatch", "current_version": e.current_version})
+    row_cache.merge_cells(sheet_id, row_index, new_cells, result["version"])
+    await manager.broadcast(sheet_id, row_updated(row_index, result["cells"], new_cells, result["version"]),
+                            seq=result["seq"])
+    return {"ok": True, "row_index": row_index, "version": result["version"], "buffered": True}
+
+async def patch_tiled_row(sheet_id: str, tile_rows: int, row_index: int, req: PatchRowReq, new_cells: Dict[str, Any]):
+    """patch_row for tiled sheets: one find_one_and_update on the row's tile (see tiles.py)."""
+    if any(c is not None and c.get("type") == "formula" for c in new_cells.values()):
+        raise HTTPException(status_code=409, detail={"error": "unsupported_for_tiled_sheet"})
+    ts = now_iso()
+    try:
+        before = await tiles.patch_cells(db, sheet_id, tile_rows, row_index, new_cells, req.expected_version,
+                                         req.user_id, ts)
+    except tiles.VersionMismatch as e:
+        raise HTTPException(status_code=409, detail={"error": "version_mismatch", "current_version": e.current_version})
+    if before is None:
+        raise HTTPException(status_code=404, detail="row_not_found")
+    old_cells, current_version = before
+    new_version = current_version + 1
+    changes_record = {col: {"old": old_cells.get(col), "new": new} for col, new in new_cells.items()}
+    seq = await manager.next_seq(sheet_id)
+    await db.changes.insert_one({
+        "_id": str(uuid.uuid4()),
+        "spreadsheet_id": sheet_id,
+        "row_id": tiles.row_id(sheet_id, row_index),
+        "row_index": row_index,
+        "user_id": req.user_id,
+        "op_type": "update_cells",
+        "payload": {"changes": changes_record, "prev_version": current_version, "new_version": new_version},
+        "version": new_version,
+        "seq": seq,
+        "created_at": ts,
+    })
+    row_cache.merge_cells(sheet_id, row_index, new_cells, new_version)
+    await manager.broadcast(sheet_id, row_updated(row_index, cells_after(old_cells, new_cells), new_cells, new_version),
+                            seq=seq)
+    return {"ok": True, "row_index": row_index, "version": new_version}
+
+@app.patch("/api/spreadsheets/{sheet_id}/range")
+async def write_range(sheet_id: str, req: RangeWriteReq = Body(...)):
+    """
+    Write a rectangular block of cells anchored at (start_row, start_col).
+    One range read for the pre-image, one bulk_write, one insert_many for the audit
+    records and a single range_updated broadcast. Missing rows are created.
+
+    Each row update is filtered on the version read, so a row that changes in
+    between is not written blind: if the bulk_write falls short, the rows it
+    missed are found by the `write_id` it sets and redone by rewrite_missed_rows.
+    Rows that can't be (stale expected_versions, deleted) make the request a 409
+    after the others have been written, logged and broadcast.
+    """
+    await require_row_storage(sheet_id)
+    await writes.flush_sheet(sheet_id)
+    start_col = COLUMN_INDEX.get(req.start_col)
+    width = max((len(r) for r in req.values), default=0)
+    if start_col is None or req.start_row < 1 or start_col + width - 1 > MAX_COLUMNS:
+        raise HTTPException(status_code=400, detail="range_out_of_bounds")
+    if sum(len(r) for r in req.values) > MAX_RANGE_CELLS:
+        raise HTTPException(status_code=400, detail="range_too_large")
+    if not width:
+        return {"ok": True, "rows": []}
+    end_row = req.start_row + len(req.values) - 1
+    cols = COLUMN_LETTERS[start_col - 1:start_col - 1 + width]
+
+    projection = {"row_index": 1, "version": 1}
+    projection.update({f"cells.{col}": 1 for col in cols})
+    cursor = db.rows.find({"spreadsheet_id": sheet_id, "row_index": {"$gte": req.start_row, "$lte": end_row}}, projection)
+    existing = {}
+    async for r in cursor:
+        existing[r["row_index"]] = r
+
+    expected = req.expected_versions or {}
+    mismatches = {}
+    for row_index, version in expected.items():
+        row = existing.get(row_index)
+        current_version = row.get("version", 1) if row else None
+        if current_version != version:
+            mismatches[row_index] = current_version
+    if mismatches:
+        raise HTTPException(status_code=409, detail={"error": "version_mismatch", "rows": mismatches})
+
+    ts = now_iso()
+    token = str(uuid.uuid4())
+    ops = []
+    changes = []
+    updated_rows = []
+    inserted, updates = {}, {}
+    for i, values in enumerate(req.values):
+        row_index = req.start_row + i
+        row = existing.get(row_index)
+        old_cells = row.get("cells", {}) if row else {}
+        to_set, to_unset, changes_record, broadcast_cells = {}, {}, {}, {}
+        for j, value in enumerate(values):
+            col = cols[j]
+            old = old_cells.get(col)
+            if value is None:
+                if old is None:
+                    continue
+                to_unset[f"cells.{col}"] = ""
+                changes_record[col] = {"old": old, "new": None}
+                broadcast_cells[col] = None
+            else:
+                normalized = normalize_cell(value)
+                to_set[f"cells.{col}"] = normalized
+                changes_record[col] = {"old": old, "new": normalized}
+                broadcast_cells[col] = normalized
+        if not changes_record:
+            continue
+        to_set.update({"updated_by": req.user_id, "updated_at": ts, "write_id": token})
+        update = {"$set": to_set, "$inc": {"version": 1}}
+        if to_unset:
+            update["$unset"] = to_unset
+        if row:
+            row_id = row["_id"]
+            prev_version = row.get("version", 1)
+            # expected_versions, when given, equal the version read (checked above)
+            ops.append(UpdateOne({"_id": row_id, "version": prev_version}, update))
+            updates[row_id] = (row_index, update)
+        else:
+            row_id = str(uuid.uuid4())
+            prev_version = 0
+            # order_key is filled in below, once the sheet doc has been read
+            update["$setOnInsert"] = inserted[row_index] = {"_id": row_id}
+            ops.append(UpdateOne({"spreadsheet_id": sheet_id, "row_index": row_index}, update, upsert=True))
+        new_version = prev_version + 1
+        changes.append({
+            "_id": str(uuid.uuid4()),
+            "spreadsheet_id": sheet_id,
+            "row_id": row_id,
+            "row_index": row_index,
+            "user_id": req.user_id,
+            "op_type": "update_cells",
+            "payload": {"changes": changes_record, "prev_version": prev_version, "new_version": new_version},
+            "version": new_version,
+            "created_at": ts,
+        })
+        updated_rows.append({"row_index": row_index, "cells": broadcast_cells, "version": new_version})
+
+    if not ops:
+        return {"ok": True, "rows": []}
+    if inserted:
+        sheet = await database.spreadsheets.get_spreadsheet_info(sheet_id, {"reordered": 1})
+        if not sheet:
+            raise HTTPException(status_code=404, detail="spreadsheet_not_found")
+        for row_index, key in (await row_order.keys_for_indexes(db, sheet, list(inserted))).items():
+            inserted[row_index]["order_key"] = key
+    conflicts = {}
+    try:
+        result = await db.rows.bulk_write(ops, ordered=False)
+        if result.matched_count + result.upserted_count < len(ops):
+            conflicts = await rewrite_missed_rows(token, updates, expected, changes, updated_rows)
+    finally:
+        # unordered bulk writes can fail part-way; drop whatever we had for these rows
+        row_cache.invalidate_rows(sheet_id, req.start_row, end_row)
+        agg_cache.invalidate_columns(sheet_id, {col for r in updated_rows for col in r["cells"]})
+    if changes:
+        await log_range_write(sheet_id, req, end_row, cols, changes, updated_rows)
+    written_rows = [{"row_index": r["row_index"], "version": r["version"]} for r in updated_rows]
+    if conflicts:
+        raise HTTPException(status_code=409, detail={"error": "version_mismatch", "rows": conflicts,
+                                                     "written": written_rows})
+    return {"ok": True, "rows": written_rows}
+
+async def rewrite_missed_rows(token: str, updates: Dict[str, Any], expected: Dict[int, int],
+                              changes: List[Dict[str, Any]], updated_rows: List[Dict[str, Any]]) -> Dict[int, Any]:
+    """
+    Rows write_range's bulk_write didn't update because they changed after its read.
+    Those with an expected version are conflicts; the others are written one by one
+    on top of what they hold now, with their change records fixed up in place.
+    Returns row_index -> current version (None = deleted) of the rows left unwritten,
+    which are dropped from changes / updated_rows.
+    """
+    written = {d["_id"] async for d in db.rows.find({"_id": {"$in": list(updates)}, "write_id": token}, {"_id": 1})}
+    by_index = {c["row_index"]: (c, r) for c, r in zip(changes, updated_rows)}
+    conflicts = {}
+    for row_id, (row_index, update) in updates.items():
+        if row_id in written:
+            continue
+        change, row = by_index[row_index]
+        before = None
+        if row_index not in expected:
+            projection = {"version": 1}
+            projection.update({f"cells.{col}": 1 for col in change["payload"]["changes"]})
+            before = await db.rows.find_one_and_update({"_id": row_id}, update, projection=projection,
+                                                       return_document=ReturnDocument.BEFORE)
+        if before is None:
+            current = await db.rows.find_one({"_id": row_id}, {"version": 1})
+            conflicts[row_index] = current.get("version", 1) if current else None
+            continue
+        old_cells = before.get("cells", {})
+        for col, diff in change["payload"]["changes"].items():
+            diff["old"] = old_cells.get(col)
+        prev_version = before.get("version", 1)
+        change["payload"].update({"prev_version": prev_version, "new_version": prev_version + 1})
+        change["version"] = row["version"] = prev_version + 1
+    changes[:] = [c for c in changes if c["row_index"] not in conflicts]
+    updated_rows[:] = [r for r in updated_rows if r["row_index"] not in conflicts]
+    return conflicts
+
+async def log_range_write(sheet_id: str, req: RangeWriteReq, end_row: int, cols: List[str],
+                          changes: List[Dict[str, Any]], updated_rows: List[Dict[str, Any]]):
+    """What write_range does after its write: audit records, snapshots, one broadcast, recalculation."""
+    written, was_formula = {}, set()
+    for c in changes:
+        for col, change in c["payload"]["changes"].items():
+            cell = (COLUMN_INDEX[col], c["row_index"])
+            written[cell] = change["new"]
+            if isinstance(change["old"], dict) and change["old"].get("type") == "formula":
+                was_formula.add(cell)
+    await search.update(db, sheet_id, [(c["row_index"], c["payload"]["changes"]) for c in changes])
+    # one event for the whole range: all its change records share the seq
+    seq = await manager.next_seq(sheet_id)
+    for c in changes:
+        c["seq"] = seq
+    await db.changes.insert_many(changes)
+    for c in changes:
+        await history.maybe_snapshot(db, sheet_id, c["row_id"], c["version"])
+    await manager.broadcast(sheet_id, {
+        "type": "range_updated",
+        "range": {"start_row": req.start_row, "start_col": req.start_col, "end_row": end_row, "end_col": cols[-1]},
+        "rows": updated_rows,
+    }, seq=seq)
+    await recalculate_after_write(sheet_id, written, was_formula)
+
+# ---------- Row positions (see row_order.py) ----------
+@app.get("/api/spreadsheets/{sheet_id}/rows/ordered")
+async def get_rows_ordered(sheet_id: str, offset: int = 0, limit: int = 100, after: Optional[str] = None):
+    """
+    Rows in display order. Page with offset/limit, or pass the last order_key seen
+    as `after` (index seek instead of skipping `offset` entries).
+    """
+    await require_row_storage(sheet_id)
+    await row_order.ensure_order_keys(db, sheet_id)
+    cursor = row_order.ordered_cursor(db, sheet_id, {"row_index": 1, "order_key": 1, "cells": 1, "version": 1}, after)
+    if after is None and offset > 0:
+        cursor = cursor.skip(offset)
+    rows = []
+    async for r in cursor.limit(limit):
+        rows.append({"row_index": r["row_index"], "order_key": r["order_key"], "cells": r.get("cells", {}),
+                     "version": r.get("version", 1)})
+    return rows
+
+async def resolve_slot(sheet_id: str, position: Optional[int], before: Optional[int], after: Optional[int],
+                       exclude: Optional[List[int]] = None):
+    """(key above, key below) of the target slot; exactly one of the three anchors must be given."""
+    if sum(x is not None for x in (position, before, after)) != 1:
+        raise HTTPException(status_code=400, detail="invalid_position")
+    anchor = before if before is not None else after
+    if anchor is not None:
+        if exclude and anchor in exclude:
+            raise HTTPException(status_code=400, detail="invalid_position")
+        slot = await row_order.neighbors_of(db, sheet_id, anchor, below=after is not None, exclude=exclude)
+        if slot is None:
+            raise HTTPException(status_code=404, detail="row_not_found")
+        return slot
+    if position < 0:
+        raise HTTPException(status_code=400, detail="invalid_position")
+    return await row_order.neighbors_at(db, sheet_id, position, exclude)
+
+async def open_slot(sheet_id: str, position: Optional[int], before: Optional[int], after: Optional[int],
+                    exclude: Optional[List[int]] = None):
+    """resolve_slot(), renumbering the sheet first if the slot sits between two equal keys; caller holds the lock."""
+    above, below = await resolve_slot(sheet_id, position, before, after, exclude)
+    if above is not None and below is not None and above >= below:
+        # duplicate keys (rows created by row_index on a sheet rebalanced before reordered was tracked)
+        await announce_rebalance(sheet_id, await row_order.renumber(db, sheet_id))
+        above, below = await resolve_slot(sheet_id, position, before, after, exclude)
+    await row_order.mark_reordered(db, sheet_id)
+    return above, below
+
+def after_reorder(sheet_id: str, keys: List[str]):
+    if row_order.needs_rebalance(keys):
+        row_order.schedule_rebalance(db, sheet_id, on_done=announce_rebalance)
+
+async def announce_rebalance(sheet_id: str, changed: int):
+    if changed:
+        await manager.broadcast(sheet_id, {"type": "rows_reordered"})
+
+@app.post("/api/spreadsheets/{sheet_id}/rows/insert")
+async def insert_rows_at(sheet_id: str, req: InsertRowsReq = Body(...)):
+    """Insert rows at a display position; only the new rows are written (no renumbering)."""
+    await require_row_storage(sheet_id)
+    count = len(req.rows) if req.rows else req.count
+    if count < 1 or count > MAX_RANGE_CELLS:
+        raise HTTPException(status_code=400, detail="invalid_count")
+    cells_list = [{col: normalize_cell(v) for col, v in (cells or {}).items()} for cells in (req.rows or [{}] * count)]
+    await row_order.ensure_order_keys(db, sheet_id)
+    async with row_order.lock(sheet_id):
+        above, below = await open_slot(sheet_id, req.position, req.before_row_index, req.after_row_index)
+        row_indexes = await row_order.allocate_row_indexes(db, sheet_id, count)
+        if not row_indexes:
+            raise HTTPException(status_code=404, detail="spreadsheet_not_found")
+        keys = row_order.keys_between(above, below, count)
+        ts = now_iso()
+        docs = [{
+            "_id": str(uuid.uuid4()),
+            "spreadsheet_id": sheet_id,
+            "row_index": row_index,
+            "order_key": key,
+            "cells": cells,
+            "version": 1,
+            "updated_by": req.user_id,
+            "updated_at": ts,
+        } for row_index, key, cells in zip(row_indexes, keys, cells_list)]
+        await db.rows.insert_many(docs)
+    await search.add_rows(db, sheet_id, docs)
+    seq = await manager.next_seq(sheet_id)
+    await db.changes.insert_many([{
+        "_id": str(uuid.uuid4()),
+        "spreadsheet_id": sheet_id,
+        "row_id": d["_id"],
+        "row_index": d["row_index"],
+        "user_id": req.user_id,
+        "op_type": "insert_row",
+        "payload": {"row_index": d["row_index"], "cells": d["cells"], "order_key": d["order_key"]},
+        "version": 1,
+        "seq": seq,
+        "created_at": ts,
+    } for d in docs])
+    rows = [{"row_index": d["row_index"], "order_key": d["order_key"], "cells": d["cells"], "version": 1} for d in docs]
+    for r in rows:
+        row_cache.put_row(sheet_id, {"row_index": r["row_index"], "cells": r["cells"], "version": 1})
+        agg_cache.invalidate_columns(sheet_id, r["cells"])
+    await manager.broadcast(sheet_id, {"type": "rows_inserted", "rows": rows}, seq=seq)
+    await recalculate_after_write(sheet_id, {(COLUMN_INDEX[col], r["row_index"]): cell for r in rows
+                                             for col, cell in r["cells"].items() if col in COLUMN_INDEX}, set())
+    after_reorder(sheet_id, keys)
+    return {"ok": True, "rows": [{"row_index": r["row_index"], "order_key": r["order_key"]} for r in rows]}
+
+@app.delete("/api/spreadsheets/{sheet_id}/rows/{row_index}")
+async def delete_row(sheet_id: str, row_index: int, user_id: Optional[str] = None):
+    """Delete one row; rows below keep their ids and keys, so nothing is renumbered."""
+    await require_row_storage(sheet_id)
+    await writes.flush_sheet(sheet_id)
+    row = await db.rows.find_one_and_delete({"spreadsheet_id": sheet_id, "row_index": row_index})
+    if not row:
+        raise HTTPException(status_code=404, detail="row_not_found")
+    cells = row.get("cells", {})
+    seq = await manager.next_seq(sheet_id)
+    await db.changes.insert_one({
+        "_id": str(uuid.uuid4()),
+        "spreadsheet_id": sheet_id,
+        "row_id": row["_id"],
+        "row_index": row_index,
+        "user_id": user_id,
+        "op_type": "delete_row",
+        "payload": {"row_index": row_index, "cells": cells, "order_key": row.get("order_key")},
+        "version": row.get("version", 1) + 1,
+        "seq": seq,
+        "created_at": now_iso(),
+    })
+    await search.update(db, sheet_id, [(row_index, {col: {"old": cell, "new": None} for col, cell in cells.items()})])
+    row_cache.invalidate_rows(sheet_id, row_index, row_index)
+    agg_cache.invalidate_columns(sheet_id, cells)
+    await manager.broadcast(sheet_id, {"type": "row_deleted", "row_index": row_index}, seq=seq)
+    await recalculate_after_write(
+        sheet_id,
+        {(COLUMN_INDEX[col], row_index): None for col in cells if col in COLUMN_INDEX},
+        {(COLUMN_INDEX[col], row_index) for col, cell in cells.items()
+         if col in COLUMN_INDEX and isinstance(cell, dict) and cell.get("type") == "formula"})
+    return {"ok": True, "row_index": row_index}
+
+@app.post("/api/spreadsheets/{sheet_id}/rows/move")
+async def move_rows(sheet_id: str, req: MoveRowsReq = Body(...)):
+    """Move rows to a new display position by rewriting only their order keys."""
+    await require_row_storage(sheet_id)
+    moving = list(dict.fromkeys(req.row_indexes))
+    if not moving or len(moving) > MAX_RANGE_CELLS:
+        raise HTTPException(status_code=400, detail="invalid_count")
+    await row_order.ensure_order_keys(db, sheet_id)
+    async with row_order.lock(sheet_id):
+        found = await db.rows.find({"spreadsheet_id": sheet_id, "row_index": {"$in": moving}},
+                                   {"row_index": 1, "order_key": 1}).sort("order_key", 1).to_list(None)
+        if len(found) != len(moving):
+            raise HTTPException(status_code=404, detail="row_not_found")
+        above, below = await open_slot(sheet_id, req.position, req.before_row_index, req.after_row_index, moving)
+        keys = row_order.keys_between(above, below, len(found))
+        await db.rows.bulk_write([UpdateOne({"_id": r["_id"]}, {"$set": {"order_key": k}})
+                                  for r, k in zip(found, keys)], ordered=False)
+    moved = [{"row_index": r["row_index"], "order_key": k} for r, k in zip(found, keys)]
+    await manager.broadcast(sheet_id, {"type": "rows_moved", "rows": moved})
+    after_reorder(sheet_id, keys)
+    return {"ok": True, "rows": moved}
+
+@app.post("/api/spreadsheets/{sheet_id}/rows/rebalance")
+async def rebalance_rows(sheet_id: str):
+    """Rewrite every order key of the sheet to a short one (normally runs in the background)."""
+    await require_row_storage(sheet_id)
+    await row_order.ensure_order_keys(db, sheet_id)
+    changed = await row_order.rebalance(db, sheet_id)
+    await announce_rebalance(sheet_id, changed)
+    return {"ok": True, "rows_rewritten": changed}
+
 @app.get("/api/spreadsheets/{sheet_id}/rows/{row_index}/history")
 async def row_history(sheet_id: str, row_index: int, limit: int = 50):
+    await require_row_storage(sheet_id)
     row = await db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": row_index})
     if not row:
         raise HTTPException(status_code=404, detail="row_not_found")
@@ -249,103 +1014,482 @@ async def row_history(sheet_id: str, row_index: int, limit: int = 50):
         })
     return out
 
+@app.get("/api/spreadsheets/{sheet_id}/rows/{row_index}/at")
+async def row_at(sheet_id: str, row_index: int, ts: str):
+    """Row as it was at ISO timestamp ts, rebuilt from the nearest snapshot."""
+    await require_row_storage(sheet_id)
+    row = await db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": row_index}, {"_id": 1})
+    if not row:
+        raise HTTPException(status_code=404, detail="row_not_found")
+    try:
+        state = await history.row_state_at(db, sheet_id, row["_id"], ts)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_timestamp")
+    if state is None:
+        raise HTTPException(status_code=404, detail="row_not_found_at_ts")
+    return {"row_index": row_index, "cells": state["cells"], "version": state["version"]}
+
+@app.get("/api/spreadsheets/{sheet_id}/at")
+async def sheet_at(sheet_id: str, ts: str, start: int = 1, end: int = 100):
+    await require_row_storage(sheet_id)
+    try:
+        return await history.sheet_state_at(db, sheet_id, ts, start, end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid_timestamp")
+
+@app.post("/api/spreadsheets/{sheet_id}/history/compact")
+async def compact_history(sheet_id: str, retention_days: Optional[float] = None):
+    """Fold deltas older than the retention window (HISTORY_RETENTION_DAYS by default) into snapshots."""
+    if retention_days is None:
+        retention_days = history.HISTORY_RETENTION_DAYS
+    if retention_days < 0:
+        raise HTTPException(status_code=400, detail="invalid_retention")
+    return await history.compact_sheet(db, sheet_id, retention_days)
+
+async def resume(sheet_id: str, sub, last_seq) -> Dict[str, Any]:
+    """
+    Events a reconnecting client missed after last_seq, as one "replay" frame: from
+    the replay buffer when it has them all, else rebuilt from the changes log.
+    "reload" when the gap is too large or can't be replayed (see history.events_since).
+    """
+    current = await current_event_seq(sheet_id)
+    if type(last_seq) is not int or last_seq < 0 or last_seq > current or current - last_seq > WS_RESUME_MAX_EVENTS:
+        sub.enqueue({"type": "reload", "reason": "gap_too_large", "seq": current})
+        return {"source": "reload", "events": 0}
+    frames = manager.replay.since(sheet_id, last_seq, current)
+    source = "buffer"
+    if frames is None:
+        events = await history.events_since(db, sheet_id, last_seq, current, WS_RESUME_MAX_EVENTS)
+        if events is None:
+            sub.enqueue({"type": "reload", "reason": "gap_too_large", "seq": current})
+            return {"source": "reload", "events": 0}
+        frames = [encode_frame(e) for e in events]
+        source = "log"
+    sub.replay(current, source, frames)
+    return {"source": source, "events": len(frames)}
+
 # WebSocket endpoint for realtime collaboration
 @app.websocket("/ws/{sheet_id}")
-async def websocket_endpoint(websocket: WebSocket, sheet_id: str):
+async def websocket_endpoint(websocket: WebSocket, sheet_id: str, proto: int = 1, encoding: str = "json"):
     """
     Simple protocol:
     - Client subscribes by opening ws to /ws/{sheet_id}
+      (?proto=2[&encoding=msgpack] for the compact, batched wire format, see wire.py)
 
     - Client -> Server messages (JSON):
       { "type": "update", "row_index": 5, "changes": {"B": {"old":..., "new":...}}, "user_id": "u1", "expected_version": 3 }
+      { "type": "update_range", "start_row": 5, "start_col": "B", "values": [[1, 2], [3, null]], "user_id": "u1", "expected_versions": {"5": 3} }
+      { "type": "resume", "seq": 41 }  # last seq the client applied, after a reconnect or a "resync"
       { "type": "ping" }
 
-    - Server -> Client broadcasts:
-      { "type": "row_updated", "row": {...} }
+    - Server -> Client on connect:
+      { "type": "hello", "seq": 42, "proto": 1, "encoding": "json" }  # current seq of the sheet, negotiated wire
+
+    - Server -> Client broadcasts, each with a per-sheet "seq" as its first field:
+      { "type": "row_updated", "row": {"row_index", "cells" (the whole row), "version"}, "changed": ["B"] }
+        # proto=2: "cells" holds the changed cells only (null = cleared), no "changed"
       { "type": "row_inserted", "row": {...} }
+      { "type": "range_updated", "range": {...}, "rows": [{"row_index", "cells" (changed cells only, null = cleared), "version"}] }
+      { "type": "cells_recalculated", "rows": [{"row_index", "cells" (formula cells with new results)}] }
+      { "type": "rows_inserted", "rows": [{"row_index", "order_key", "cells", "version"}] }
+      { "type": "row_deleted", "row_index": 7 }
+      { "type": "rows_moved", "rows": [{"row_index", "order_key"}] }
+      { "type": "rows_reordered" }  # order keys were rebalanced; reload the row order
       { "type": "ack", "result": {...} }  # ack for websocket-sent update
+
+    - Server -> Client answers to "resume":
+      { "type": "replay", "seq": 42, "source": "buffer" | "log", "events": [{"seq": 42, "type": ...}, ...] }
+      { "type": "reload", "reason": "gap_too_large", "seq": 42 }  # reload the rows, then continue from seq
+
+    Live events can overlap a replay; clients skip any event whose seq they already applied.
     """
-    await manager.connect(sheet_id, websocket)
+    wire = negotiate(proto, encoding)
+    sub = await manager.connect(sheet_id, websocket, wire)
+    sub.enqueue({"type": "hello", "seq": await current_event_seq(sheet_id),
+                 "proto": wire.version, "encoding": wire.encoding})
     try:
         while True:
-            data = await websocket.receive_json()
+            data = await wire.receive(websocket)
             t = data.get("type")
+            metrics.WS_MESSAGES_IN.inc(t if t in ("update", "update_range", "resume", "ping") else "unknown")
             if t == "update":
                 # Reuse patch_row logic but call directly
                 try:
                     req = PatchRowReq(changes=data.get("changes", {}), user_id=data.get("user_id"), expected_version=data.get("expected_version"))
-                    result = await patch_row(sheet_id, data.get("row_index"), req)
-                    await websocket.send_json({"type": "ack", "result": result})
+                    config = await writes.config(sheet_id)
+                    if config:
+                        result = await patch_row_buffered(sheet_id, data.get("row_index"), req, config)
+                    else:
+                        result = await patch_row(sheet_id, data.get("row_index"), req)
+                    sub.enqueue({"type": "ack", "result": result})
+                except HTTPException as e:
+                    sub.enqueue({"type": "error", "detail": getattr(e, "detail", str(e))})
+            elif t == "update_range":
+                try:
+                    req = RangeWriteReq(start_row=data.get("start_row"), start_col=data.get("start_col", "A"),
+                                        values=data.get("values", []), user_id=data.get("user_id"),
+                                        expected_versions=data.get("expected_versions"))
+                    result = await write_range(sheet_id, req)
+                    sub.enqueue({"type": "ack", "result": result})
                 except HTTPException as e:
-                    await websocket.send_json({"type": "error", "detail": getattr(e, "detail", str(e))})
+                    sub.enqueue({"type": "error", "detail": getattr(e, "detail", str(e))})
+            elif t == "resume":
+                await resume(sheet_id, sub, data.get("seq"))
             elif t == "ping":
-                await websocket.send_json({"type": "pong"})
+                sub.enqueue({"type": "pong"})
             else:
-                await websocket.send_json({"type": "unknown"})
+                sub.enqueue({"type": "unknown"})
     except WebSocketDisconnect:
         await manager.disconnect(sheet_id, websocket)
     except Exception:
         # ensure we remove on unexpected errors
         await manager.disconnect(sheet_id, websocket)
 
+@app.get("/api/realtime/stats")
+async def realtime_stats():
+    return manager.stats()
+
+@app.put("/api/spreadsheets/{sheet_id}/write_behind")
+async def set_write_behind(sheet_id: str, req: WriteBehindReq = Body(...)):
+    """
+    Buffer this sheet's WebSocket cell edits and write them in merged batches;
+    max_delay_ms bounds how long an acked edit may exist only in memory.
+    Turning it off flushes the buffer.
+    """
+    await require_row_storage(sheet_id)
+    config = None
+    if req.enabled:
+        try:
+            config = write_behind.normalize_config(req.window_ms, req.max_delay_ms)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail={"error": "invalid_write_behind", "message": str(e)})
+    if not await writes.configure(sheet_id, config):
+        raise HTTPException(status_code=404, detail="spreadsheet_not_found")
+    return {"id": sheet_id, "write_behind": config}
+
+@app.get("/api/write_behind/stats")
+async def write_behind_stats():
+    return writes.stats()
+
 # Import XLSX
-@app.post("/api/spreadsheets/import_xlsx")
-async def import_xlsx(file: UploadFile = File(...), title: Optional[str] = None):
-    content = await file.read()
-    wb = openpyxl.load_workbook(filename=io.BytesIO(content), data_only=False)
-    sheet = wb.active
-    sheet_doc = {"_id": str(uuid.uuid4()), "title": title or file.filename, "created_at": now_iso(), "updated_at": now_iso()}
-    await db.spreadsheets.insert_one(sheet_doc)
+imports = xlsx_import.ImportTracker()
+# heavy xlsx work runs in a bounded process pool (see jobs.py)
+job_runner = jobs.JobRunner()
+
+@app.on_event("shutdown")
+async def stop_jobs():
+    job_runner.shutdown()
+
+async def load_sheet(job: Dict[str, Any], path: str, sheet_doc: Dict[str, Any], worksheet: Optional[str] = None,
+                     import_id: Optional[str] = None) -> int:
+    """Insert the rows of one worksheet (the active one by default) as the pool parses them."""
+    tiles.remember(sheet_doc["_id"], sheet_doc)
+    tile_rows = sheet_doc.get("tile_rows")
+    batch_size = tiles.aligned_batch_size(xlsx_import.IMPORT_BATCH_SIZE, tile_rows) if tile_rows else xlsx_import.IMPORT_BATCH_SIZE
     rows_created = 0
-    bulk = []
-    for i, row in enumerate(sheet.iter_rows(values_only=True), start=1):
-        cells = {}
-        for col_idx, cell_value in enumerate(row):
-            if cell_value is None:
-                continue
-            col_letter = openpyxl.utils.get_column_letter(col_idx + 1)
-            cells[col_letter] = parse_typed_value(cell_value)
-        row_doc = {
-            "_id": str(uuid.uuid4()),
-            "spreadsheet_id": sheet_doc["_id"],
-            "row_index": i,
-            "cells": cells,
-            "version": 1,
-            "updated_by": None,
-            "updated_at": now_iso()
-        }
-        bulk.append(row_doc)
-        rows_created += 1
-    if bulk:
-        await db.rows.insert_many(bulk)
-    return {"spreadsheet_id": sheet_doc["_id"], "rows": rows_created}
+    try:
+        async for docs in job_runner.import_batches(job["job_id"], path, sheet_doc["_id"], batch_size, tile_rows,
+                                                    worksheet):
+            if tile_rows:
+                await db.tiles.insert_many(docs)
+                rows = sum(1 for d in docs for v in d["versions"] if v)
+            else:
+                await db.rows.insert_many(docs)
+                await search.add_rows(db, sheet_doc["_id"], docs)
+                rows = len(docs)
+            rows_created += rows
+            job["progress"]["rows"] += rows
+            if import_id:
+                imports.advance(import_id, rows)
+            metrics.IMPORT_ROWS.inc(amount=rows)
+    finally:
+        # readers may have cached partial windows while the import was running
+        row_cache.invalidate_sheet(sheet_doc["_id"])
+        agg_cache.invalidate_sheet(sheet_doc["_id"])
+    return rows_created
+
+async def import_sheet(job: Dict[str, Any], path: str, title: Optional[str], filename: Optional[str],
+                       fields: Dict[str, Any], import_id: str) -> Dict[str, Any]:
+    """
+    Job body of an import: the pool parses the spooled upload, the loop inserts the
+    batches as they come. Removes the upload when done.
+    """
+    started = time.perf_counter()
+    try:
+        sheet_doc = {"_id": str(uuid.uuid4()), "title": title or filename, "created_at": now_iso(), "updated_at": now_iso()}
+        sheet_doc.update(fields)
+        await database.spreadsheets.insert_sheet(sheet_doc)
+        job["spreadsheet_id"] = sheet_doc["_id"]
+        imports.start(import_id, sheet_doc["_id"], filename)
+        try:
+            rows_created = await load_sheet(job, path, sheet_doc, import_id=import_id)
+        except Exception as e:
+            imports.finish(import_id, error=str(e) or type(e).__name__)
+            metrics.IMPORTS.inc("error")
+            raise
+        imports.finish(import_id)
+        metrics.IMPORTS.inc("ok")
+    finally:
+        metrics.IMPORT_BYTES.inc(amount=os.path.getsize(path))
+        metrics.IMPORT_SECONDS.inc(amount=time.perf_counter() - started)
+        os.unlink(path)
+    return {"spreadsheet_id": sheet_doc["_id"], "rows": rows_created, "import_id": import_id}
+
+async def import_workbook(job: Dict[str, Any], path: str, title: Optional[str], filename: Optional[str],
+                          fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Job body of a workbook import: one spreadsheet per worksheet, all parsed and inserted concurrently."""
+    started = time.perf_counter()
+    try:
+        names = await job_runner.call(xlsx_import.worksheet_names, path)
+        workbook, sheets = await workbooks.create(db, title or filename, names, fields, now_iso())
+        job["workbook_id"] = workbook["_id"]
+        job["progress"]["sheets"] = len(sheets)
+        try:
+            counts = await jobs.gather_all(*(load_sheet(job, path, sheet, worksheet=name)
+                                             for sheet, name in zip(sheets, names)))
+        except Exception:
+            metrics.IMPORTS.inc("error")
+            raise
+        metrics.IMPORTS.inc("ok")
+    finally:
+        metrics.IMPORT_BYTES.inc(amount=os.path.getsize(path))
+        metrics.IMPORT_SECONDS.inc(amount=time.perf_counter() - started)
+        os.unlink(path)
+    return {"workbook_id": workbook["_id"],
+            "sheets": [{"spreadsheet_id": s["_id"], "title": s["title"], "rows": n} for s, n in zip(sheets, counts)]}
+
+async def submit_import(file: UploadFile, title: Optional[str], import_id: Optional[str],
+                        storage: Optional[str]) -> Dict[str, Any]:
+    import_id = import_id or str(uuid.uuid4())
+    if imports.get(import_id):
+        raise HTTPException(status_code=400, detail="import_exists")
+    fields = storage_fields(storage)
+    path = await xlsx_import.spool_upload(file)
+    try:
+        return job_runner.submit("import", lambda job: import_sheet(job, path, title, file.filename, fields, import_id),
+                                 filename=file.filename, import_id=import_id)
+    except HTTPException:
+        os.unlink(path)
+        raise
+
+async def submit_workbook_import(file: UploadFile, title: Optional[str], storage: Optional[str]) -> Dict[str, Any]:
+    fields = storage_fields(storage)
+    path = await xlsx_import.spool_upload(file)
+    try:
+        return job_runner.submit("import_workbook", lambda job: import_workbook(job, path, title, file.filename, fields),
+                                 filename=file.filename)
+    except HTTPException:
+        os.unlink(path)
+        raise
+
+@app.post("/api/spreadsheets/import_xlsx")
+async def import_xlsx(file: UploadFile = File(...), title: Optional[str] = None, import_id: Optional[str] = None,
+                      storage: Optional[str] = None):
+    """
+    Streaming import: the upload is spooled to disk, parsed in the job pool (see jobs.py)
+    and written in bounded insert_many batches; the request waits for the job. Pass
+    your own import_id to poll GET /api/imports/{import_id} while the request is
+    running, or use POST /api/jobs/import to get a job id back at once.
+    storage="tiled" packs the rows into tile documents (see tiles.py).
+    """
+    job = await job_runner.wait((await submit_import(file, title, import_id, storage))["job_id"])
+    if job["status"] != "done":
+        raise HTTPException(status_code=500, detail={"error": "import_failed", "message": job["error"]})
+    return job["result"]
+
+@app.post("/api/workbooks/import_xlsx")
+async def import_workbook_xlsx(file: UploadFile = File(...), title: Optional[str] = None, storage: Optional[str] = None):
+    """Every worksheet becomes a spreadsheet (a tab of the new workbook, see workbooks.py); waits for the job."""
+    job = await job_runner.wait((await submit_workbook_import(file, title, storage))["job_id"])
+    if job["status"] != "done":
+        raise HTTPException(status_code=500, detail={"error": "import_failed", "message": job["error"]})
+    return job["result"]
+
+@app.get("/api/imports")
+async def list_imports():
+    return imports.list_running()
+
+@app.get("/api/imports/{import_id}")
+async def import_status(import_id: str):
+    state = imports.get(import_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="import_not_found")
+    return state
 
 # Export XLSX
+async def metered_export(chunks):
+    started = time.perf_counter()
+    try:
+        async for chunk in chunks:
+            metrics.EXPORT_BYTES.inc(amount=len(chunk))
+            yield chunk
+    finally:
+        metrics.EXPORT_SECONDS.inc(amount=time.perf_counter() - started)
+
+async def export_rows(sheet: Optional[Dict[str, Any]], sheet_id: str):
+    """
+    Rows of a sheet in export order: display order, or row_index for tiled sheets.
+    Until a sheet is reordered its display order is row_index order, and rows are
+    exported at their row_index ("position", see xlsx_export.sheet_row): formulas
+    reference row_index, so they keep pointing at the same cells in the file.
+    A reordered sheet is written 1..n in display order; row_index references
+    can't follow rows that moved (a range may no longer be contiguous), so its
+    formulas are exported as their computed values.
+    """
+    if sheet and sheet.get("storage") == "tiled":
+        return at_row_index(tiles.iter_rows(db, sheet_id, sheet["tile_rows"]))
+    await row_order.ensure_order_keys(db, sheet_id)
+    cursor = row_order.ordered_cursor(db, sheet_id, {"row_index": 1, "cells": 1})
+    if sheet and row_order.is_reordered(sheet):
+        return cursor
+    return at_row_index(cursor)
+
+async def at_row_index(rows):
+    async for r in rows:
+        r["position"] = r["row_index"]
+        yield r
+
 @app.get("/api/spreadsheets/{sheet_id}/export_xlsx")
 async def export_xlsx(sheet_id: str):
-    cursor = db.rows.find({"spreadsheet_id": sheet_id}).sort("row_index", 1)
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    # We will append rows in increasing row_index
-    async for r in cursor:
-        cells = r.get("cells", {})
-        if not cells:
-            ws.append([])
-            continue
-        # Find max column index for this row
-        max_idx = max((openpyxl.utils.column_index_from_string(col) for col in cells.keys()), default=0)
-        row_list = [None] * max_idx
-        for col, c in cells.items():
-            idx = openpyxl.utils.column_index_from_string(col)
-            val = c.get("value") if isinstance(c, dict) else c
-            row_list[idx - 1] = val
-        ws.append(row_list)
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return StreamingResponse(buf, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    """Streamed from the cursor on the event loop; POST /api/jobs/export/{sheet_id} builds it in the job pool."""
+    sheet = await database.spreadsheets.get_spreadsheet_info(sheet_id, {"title": 1, "storage": 1, "tile_rows": 1, "reordered": 1})
+    cursor = await export_rows(sheet, sheet_id)
+    title = (sheet or {}).get("title") or "Sheet1"
+    return StreamingResponse(metered_export(xlsx_export.stream_xlsx(cursor, title)), media_type=xlsx_export.XLSX_MEDIA_TYPE,
                              headers={"Content-Disposition": f"attachment; filename=sheet_{sheet_id}.xlsx"})
 
+async def export_sheet(job: Dict[str, Any], sheet: Dict[str, Any]) -> Dict[str, Any]:
+    """Job body of an export: the loop spools the rows, the pool writes the .xlsx."""
+    started = time.perf_counter()
+    job["progress"]["phase"] = "reading"
+    try:
+        path = await job_runner.export_file(job["job_id"], await export_rows(sheet, sheet["_id"]),
+                                            sheet.get("title") or "Sheet1", job["progress"])
+    finally:
+        metrics.EXPORT_SECONDS.inc(amount=time.perf_counter() - started)
+    return exported(job, path)
+
+async def export_workbook(job: Dict[str, Any], workbook_id: str) -> Dict[str, Any]:
+    """Job body of a workbook export: every tab's cursor and sheet part are worked on concurrently."""
+    started = time.perf_counter()
+    sheets = await workbooks.tabs(db, workbook_id)
+    job["progress"].update(phase="reading", sheets=len(sheets))
+    try:
+        sources = [(s.get("title") or "Sheet1", await export_rows(s, s["_id"])) for s in sheets]
+        path = await job_runner.export_workbook_file(job["job_id"], sources, job["progress"])
+    finally:
+        metrics.EXPORT_SECONDS.inc(amount=time.perf_counter() - started)
+    return exported(job, path)
+
+def exported(job: Dict[str, Any], path: str) -> Dict[str, Any]:
+    size = os.path.getsize(path)
+    metrics.EXPORT_ROWS.inc(amount=job["progress"]["rows"])
+    metrics.EXPORT_BYTES.inc(amount=size)
+    return {"rows": job["progress"]["rows"], "bytes": size, "download": f"/api/jobs/{job['job_id']}/download"}
+
+# ---------- Jobs (see jobs.py) ----------
+@app.post("/api/jobs/import", status_code=202)
+async def import_job(file: UploadFile = File(...), title: Optional[str] = None, import_id: Optional[str] = None,
+                     storage: Optional[str] = None):
+    """Background import_xlsx: answers with the job at once; poll GET /api/jobs/{job_id}."""
+    return await submit_import(file, title, import_id, storage)
+
+@app.post("/api/jobs/export/{sheet_id}", status_code=202)
+async def export_job(sheet_id: str):
+    """Background export_xlsx; when the job is done its file is at GET /api/jobs/{job_id}/download."""
+    sheet = await database.spreadsheets.get_spreadsheet_info(sheet_id, {"title": 1, "storage": 1, "tile_rows": 1, "reordered": 1})
+    if not sheet:
+        raise HTTPException(status_code=404, detail="spreadsheet_not_found")
+    return job_runner.submit("export", lambda job: export_sheet(job, sheet), spreadsheet_id=sheet_id,
+                             filename=f"sheet_{sheet_id}.xlsx")
+
+@app.post("/api/jobs/import_workbook", status_code=202)
+async def import_workbook_job(file: UploadFile = File(...), title: Optional[str] = None, storage: Optional[str] = None):
+    """Background /api/workbooks/import_xlsx."""
+    return await submit_workbook_import(file, title, storage)
+
+async def submit_workbook_export(workbook_id: str) -> Dict[str, Any]:
+    if not await db.workbooks.find_one({"_id": workbook_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="workbook_not_found")
+    return job_runner.submit("export", lambda job: export_workbook(job, workbook_id), workbook_id=workbook_id,
+                             filename=f"workbook_{workbook_id}.xlsx")
+
+@app.post("/api/jobs/export_workbook/{workbook_id}", status_code=202)
+async def export_workbook_job(workbook_id: str):
+    """Background export of all tabs of a workbook as one .xlsx; download it from GET /api/jobs/{job_id}/download."""
+    return await submit_workbook_export(workbook_id)
+
+@app.get("/api/jobs")
+async def list_jobs():
+    return job_runner.list_active()
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = job_runner.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job_not_found")
+    return job
+
+@app.get("/api/jobs/{job_id}/download")
+async def job_download(job_id: str):
+    job = job_runner.get(job_id)
+    if not job or job["kind"] != "export":
+        raise HTTPException(status_code=404, detail="job_not_found")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail={"error": "job_not_finished", "status": job["status"]})
+    return FileResponse(os.path.join(job_runner.job_dir(job_id), "export.xlsx"), media_type=xlsx_export.XLSX_MEDIA_TYPE,
+                        filename=job["filename"])
+
+# ---------- Workbooks (see workbooks.py) ----------
+@app.get("/api/workbooks/{workbook_id}")
+async def get_workbook(workbook_id: str):
+    workbook = await db.workbooks.find_one({"_id": workbook_id})
+    if not workbook:
+        raise HTTPException(status_code=404, detail="workbook_not_found")
+    sheets = await workbooks.tabs(db, workbook_id)
+    return {"id": workbook["_id"], "title": workbook.get("title"),
+            "tabs": [{"spreadsheet_id": s["_id"], "title": s.get("title"), "tab": s.get("tab"),
+                      "storage": s.get("storage", "rows")} for s in sheets]}
+
+@app.get("/api/workbooks/{workbook_id}/export_xlsx")
+async def export_workbook_xlsx(workbook_id: str):
+    """All tabs as one .xlsx, built by a job (see export_workbook); waits for it."""
+    job = await job_runner.wait((await submit_workbook_export(workbook_id))["job_id"])
+    if job["status"] != "done":
+        raise HTTPException(status_code=500, detail={"error": "export_failed", "message": job["error"]})
+    return await job_download(job["job_id"])
+
+# ---------- Metrics (see metrics.py) ----------
+metrics.REGISTRY.gauge_callback("noexcel_ws_connections", "Open WebSocket connections.",
+                                lambda: sum(len(c) for c in manager.connections.values()))
+metrics.REGISTRY.gauge_callback("noexcel_ws_sheets", "Sheets with at least one local subscriber.",
+                                lambda: len(manager.connections))
+metrics.REGISTRY.gauge_callback("noexcel_ws_queue_depth", "Frames waiting in outbound socket queues.",
+                                lambda: sum(s.queue.qsize() for c in manager.connections.values() for s in c.values()))
+metrics.REGISTRY.counter_callback("noexcel_ws_messages_out_total", "WebSocket frames sent.", lambda: manager.messages_out)
+metrics.REGISTRY.counter_callback("noexcel_ws_bytes_out_total", "WebSocket payload bytes sent.", lambda: manager.bytes_out)
+metrics.REGISTRY.counter_callback("noexcel_ws_broadcasts_total", "Broadcasts published.", lambda: manager.broadcasts)
+metrics.REGISTRY.counter_callback("noexcel_ws_dropped_total", "Frames dropped for slow clients.", lambda: manager.dropped)
+metrics.REGISTRY.counter_callback("noexcel_ws_resyncs_total", "Resync messages sent to slow clients.", lambda: manager.resyncs)
+metrics.REGISTRY.counter_callback("noexcel_row_cache_lookups_total", "Row cache block lookups.",
+                                  lambda: {("hit",): row_cache.hits, ("miss",): row_cache.misses}, ("result",))
+metrics.REGISTRY.gauge_callback("noexcel_row_cache_blocks", "Cached row blocks.", lambda: row_cache.stats()["blocks"])
+metrics.REGISTRY.gauge_callback("noexcel_imports_running", "Imports in progress.", lambda: len(imports.list_running()))
+metrics.REGISTRY.gauge_callback("noexcel_query_indexes", "Per-column query indexes on rows.",
+                                lambda: len(query_indexes.indexed))
+metrics.REGISTRY.gauge_callback("noexcel_write_behind_pending_rows", "Rows with buffered, unwritten edits.",
+                                writes.pending_rows)
+metrics.REGISTRY.counter_callback("noexcel_write_behind_edits_total", "Edits taken by the write-behind buffer.",
+                                  lambda: writes.edits)
+metrics.REGISTRY.counter_callback("noexcel_write_behind_rows_flushed_total", "Rows written by write-behind flushes.",
+                                  lambda: writes.rows_flushed)
+metrics.REGISTRY.gauge_callback("noexcel_jobs_active", "Import/export jobs queued or running.",
+                                lambda: len(job_runner.list_active()))
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/ping")
 async def ping():
     return {"ok": True}
@@ -0,0 +1,298 @@
+"""
+Process-local metrics in the Prometheus text exposition format (served on /metrics).
+
+Counters and histograms are plain dicts keyed by label tuples behind one lock
+per metric (pymongo command listeners fire from motor's worker threads), so an
+observation is a bisect plus a couple of additions. Values that other
+components already count (queue depths, cache hits, ...) are read at scrape
+time through callback gauges instead of being double counted on the hot path.
+
+Per-sheet labels are capped at METRICS_SHEET_LABELS distinct sheets; the rest
+are reported as sheet="other".
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, Any, Callable, List, Sequence, Tuple
+
+from pymongo import monitoring
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+METRICS_SHEET_LABELS = int(os.getenv("METRICS_SHEET_LABELS", "50"))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, doc, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels_text(self.labelnames, k)} {_num(v)}" for k, v in items]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last = +Inf), sum, count]
+        self._values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labels: str):
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._values.items()]
+        out = []
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = 'le="' + _num(bound) + '"'
+                out.append(f"{self.name}_bucket{_labels_text(self.labelnames, labels, le)} {cumulative}")
+            out.append(f"{self.name}_sum{_labels_text(self.labelnames, labels)} {_num(total)}")
+            out.append(f"{self.name}_count{_labels_text(self.labelnames, labels)} {count}")
+        return out
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class CallbackMetric(Metric):
+    """Gauge/counter whose value is read from `fn` at scrape time; fn returns a number or {labels: number}."""
+
+    def __init__(self, name: str, doc: str, fn: Callable[[], Any], labelnames: Sequence[str] = (), kind: str = "gauge"):
+        super().__init__(name, doc, labelnames)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self) -> List[str]:
+        value = self.fn()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_labels_text(self.labelnames, k)} {_num(v)}"
+                for k, v in value.items() if v is not None]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, doc: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, doc, labelnames))
+
+    def histogram(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, doc, labelnames, buckets))
+
+    def gauge_callback(self, name: str, doc: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()):
+        return self.register(CallbackMetric(name, doc, fn, labelnames, "gauge"))
+
+    def counter_callback(self, name: str, doc: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()):
+        return self.register(CallbackMetric(name, doc, fn, labelnames, "counter"))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ---------- HTTP ----------
+HTTP_REQUESTS = REGISTRY.counter("noexcel_http_requests_total", "HTTP requests by route and status.",
+                                 ("method", "route", "status"))
+HTTP_LATENCY = REGISTRY.histogram("noexcel_http_request_duration_seconds", "HTTP request latency by route.",
+                                  ("method", "route"))
+
+# ---------- Mongo ----------
+MONGO_COMMANDS = REGISTRY.counter("noexcel_mongo_commands_total", "Mongo commands by name and outcome.",
+                                  ("command", "outcome"))
+MONGO_LATENCY = REGISTRY.histogram("noexcel_mongo_command_duration_seconds", "Mongo command latency (driver-measured).",
+                                   ("command",))
+
+# ---------- WebSocket ----------
+WS_MESSAGES_IN = REGISTRY.counter("noexcel_ws_messages_in_total", "WebSocket messages received by type.", ("type",))
+WS_FANOUT = REGISTRY.histogram("noexcel_ws_fanout_duration_seconds",
+                               "Time to hand one broadcast to every local subscriber of a sheet.",
+                               ("sheet",), FAST_BUCKETS)
+
+# ---------- import / export ----------
+IMPORT_ROWS = REGISTRY.counter("noexcel_import_rows_total", "Rows written by xlsx imports.")
+IMPORT_BYTES = REGISTRY.counter("noexcel_import_bytes_total", "Bytes of uploaded xlsx files.")
+IMPORT_SECONDS = REGISTRY.counter("noexcel_import_seconds_total", "Wall time spent in xlsx imports.")
+IMPORTS = REGISTRY.counter("noexcel_imports_total", "Finished xlsx imports by outcome.", ("outcome",))
+EXPORT_ROWS = REGISTRY.counter("noexcel_export_rows_total", "Rows written by xlsx exports.")
+EXPORT_BYTES = REGISTRY.counter("noexcel_export_bytes_total", "Bytes streamed by xlsx exports.")
+EXPORT_SECONDS = REGISTRY.counter("noexcel_export_seconds_total", "Wall time spent streaming xlsx exports.")
+
+# ---------- typed values ----------
+PARSE_CALLS = REGISTRY.counter("noexcel_parse_typed_value_calls_total", "parse_typed_value calls.")
+PARSE_SECONDS = REGISTRY.counter("noexcel_parse_typed_value_seconds_total", "Time spent in parse_typed_value.")
+# imports type whole batches with typed_values.parse_rows, in the job pool (see jobs.parse_import)
+IMPORT_PARSE_CELLS = REGISTRY.counter("noexcel_import_parse_cells_total", "Cells typed by parse_rows in imports.")
+IMPORT_PARSE_SECONDS = REGISTRY.counter("noexcel_import_parse_seconds_total", "Time spent in parse_rows in imports.")
+
+
+_sheet_labels: set = set()
+
+
+def sheet_label(sheet_id: str) -> str:
+    if sheet_id in _sheet_labels:
+        return sheet_id
+    if len(_sheet_labels) < METRICS_SHEET_LABELS:
+        _sheet_labels.add(sheet_id)
+        return sheet_id
+    return "other"
+
+
+def timed_calls(calls: Counter, seconds: Counter):
+    """Decorator counting calls and cumulative time of a sync function."""
+    def decorate(fn):
+        if not METRICS_ENABLED:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                seconds.inc(amount=time.perf_counter() - started)
+                calls.inc()
+        return wrapper
+    return decorate
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Pass to the client (event_listeners=[...]); durations come from the driver events."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMANDS.inc(event.command_name, "ok")
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMANDS.inc(event.command_name, "error")
+        MONGO_LATENCY.observe(event.duration_micros / 1e6, event.command_name)
+
+
+def mongo_listeners() -> List[monitoring.CommandListener]:
+    return [MongoCommandListener()] if METRICS_ENABLED else []
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware timing HTTP requests by route template (e.g.
+    /api/spreadsheets/{sheet_id}/rows), so ids don't create new series.
+    Unmatched paths are reported as route="unmatched".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            HTTP_LATENCY.observe(elapsed, scope["method"], path)
+            HTTP_REQUESTS.inc(scope["method"], path, str(status["code"]))
@@ -1,14 +1,12 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends
 from pydantic import BaseModel, constr, validator
-from motor.motor_asyncio import AsyncIOMotorClient
 from passlib.context import CryptContext
+from database import get_database
+import auth
 app = FastAPI()
-#TODO -  добавить правильную базу данных  MongoDB, для сохранения логинов и паролей пользователей
-MONGO_DETAILS = "mongodb://localhost:27017"
-client = AsyncIOMotorClient(MONGO_DETAILS)
-db = client.users_db
-users_collection = db.get_collection("users")
+# общий пул соединений и репозитории (см. database/database.py)
+database = get_database()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 #Задал ограничения по длине и набору символов
 
@@ -28,12 +26,26 @@ class UserIn(BaseModel):
         return v
 class UserOut(BaseModel):
     username: str
-def users_password(pasword: str) -> str:
-    return pwd_context.hash(pasword)
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt выполняется в пуле потоков auth.py, чтобы не блокировать event loop
+async def users_password(pasword: str) -> str:
+    return await auth.run_hashing(pwd_context.hash, pasword)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await auth.run_hashing(pwd_context.verify, plain_password, hashed_password)
+login_throttle = auth.LoginThrottle()
 async def get_user(username: str):
-    return await users_collection.find_one({"username": username})
+    return await database.users.get_user_by_username(username)
+
+
+@app.on_event("startup")
+async def init_indexes():
+    await database.init_indexes()
+    # аккаунты из users_db.users (до общей базы) должны продолжать входить
+    await database.migrate_legacy_users()
+
+
+@app.on_event("shutdown")
+async def stop_auth_pool():
+    auth.shutdown()
 
 
 @app.post("/register", response_model=UserOut, tags=["Создание пользователя"])
@@ -41,20 +53,37 @@ async def register(user: UserIn):
     existing_user = await get_user(user.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Пользователь уже существует")
-    hashed_password = users_password(user.password)
-    user_doc = {"username": user.username, "password": hashed_password}
-    await users_collection.insert_one(user_doc)
+    hashed_password = await users_password(user.password)
+    user_id = await database.users.create_user({"username": user.username, "password_hash": hashed_password})
+    if user_id is None:
+        # уникальный индекс по username: параллельная регистрация с тем же логином
+        raise HTTPException(status_code=400, detail="Пользователь уже существует")
     return {"username": user.username}
 
 
 @app.post("/login", tags=[" Вход в систему"])
 async def login(user: UserIn):
-    existing_user = await get_user(user.username)
-    if not existing_user:
-        raise HTTPException(status_code=400, detail="Неверный логин или пароль")
-    if not verify_password(user.password, existing_user["password"]):
-        raise HTTPException(status_code=400, detail="Неверный логин или пароль")
-    return {"message": f"Пользователь {user.username} успешно вошёл в систему"}
+    login_throttle.begin(user.username)
+    ok = None  # None: попытка не состоялась (например, пул занят) и не считается неудачной
+    try:
+        existing_user = await get_user(user.username)
+        ok = bool(existing_user) and await verify_password(user.password, existing_user["password_hash"])
+        if not ok:
+            raise HTTPException(status_code=400, detail="Неверный логин или пароль")
+    finally:
+        login_throttle.end(user.username, ok)
+    return {
+        "message": f"Пользователь {user.username} успешно вошёл в систему",
+        "access_token": auth.issue_token(str(existing_user["_id"]), user.username),
+        "token_type": "bearer",
+        "expires_in": auth.AUTH_TOKEN_TTL,
+    }
+
+
+# Проверка токена — один HMAC, без bcrypt и без запроса в базу
+@app.get("/me", response_model=UserOut, tags=["Текущий пользователь"])
+async def me(claims: dict = Depends(auth.current_user)):
+    return {"username": claims["usr"]}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+"""
+Server-side filter and sort over typed cell values.
+
+A query ({"where": [{"column": "C", "op": "gt", "value": 1000}, ...],
+"sort": "-E", "limit": 100, "cursor": ...}) is compiled into one find() on
+`rows`:
+
+- where: predicates ANDed on cells.<col>.value. Comparisons follow Mongo's type
+  brackets, so {"op": "gt", "value": 1000} only matches numbers, and dates
+  (stored as ISO strings) compare chronologically against ISO strings. Besides
+  the aggregate filter ops there are "prefix" (anchored, can use an index),
+  "exists" (true: non-empty cell) and "type" (on cells.<col>.type).
+- sort: one column, "-" for descending; ties are broken by row_index. Without a
+  sort the rows come in row_index order.
+- pagination is by cursor (keyset): next_cursor carries the sort value and
+  row_index of the last row, and the next page continues strictly after it.
+  It never skips, so page N costs the same as page 1.
+
+Columns that are filtered or sorted on often get an index on
+(spreadsheet_id, cells.<col>.value, row_index) built in the background
+(QUERY_INDEX_MODE=column, after QUERY_INDEX_AFTER queries, at most
+QUERY_MAX_INDEXES columns). QUERY_INDEX_MODE=wildcard builds one compound
+wildcard index over all cells instead (MongoDB 7.0+), "off" leaves indexing
+to the operator.
+"""
+import os
+import re
+import json
+import base64
+import asyncio
+import hashlib
+import logging
+from typing import Dict, Any, List, Optional, Set
+
+from aggregates import FILTER_OPS
+from columns import COLUMN_INDEX
+
+QUERY_INDEX_MODE = os.getenv("QUERY_INDEX_MODE", "column")  # column | wildcard | off
+QUERY_INDEX_AFTER = int(os.getenv("QUERY_INDEX_AFTER", "3"))
+QUERY_MAX_INDEXES = int(os.getenv("QUERY_MAX_INDEXES", "32"))
+QUERY_DEFAULT_LIMIT = 100
+QUERY_MAX_LIMIT = int(os.getenv("QUERY_MAX_LIMIT", "1000"))
+
+OPS = tuple(FILTER_OPS) + ("prefix", "exists", "type")
+INDEX_PREFIX = "query_"
+
+# BSON sort order of the value kinds cells can hold ($type aliases); null and missing sort first
+_BRACKETS = (None, "number", "string", "object", "array", "bool")
+
+logger = logging.getLogger(__name__)
+
+
+def _column(col: Any) -> str:
+    if not isinstance(col, str) or col.upper() not in COLUMN_INDEX:
+        raise ValueError(f"bad column {col!r}")
+    return col.upper()
+
+
+def normalize(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """Validated, canonical form of a query; raises ValueError."""
+    where = []
+    for f in spec.get("where") or []:
+        op = f.get("op", "eq")
+        if op not in OPS:
+            raise ValueError(f"bad op {op!r}")
+        value = f.get("value")
+        if op in ("in", "nin") and not isinstance(value, list):
+            raise ValueError(f"{op} needs a list")
+        if op in ("prefix", "type") and not isinstance(value, str):
+            raise ValueError(f"{op} needs a string")
+        if op == "exists":
+            value = bool(value)
+        where.append({"column": _column(f.get("column")), "op": op, "value": value})
+    sort = spec.get("sort") or None
+    desc = False
+    if sort is not None:
+        desc = sort.startswith("-")
+        sort = _column(sort.lstrip("-"))
+    limit = spec.get("limit")
+    if limit is None:
+        limit = QUERY_DEFAULT_LIMIT
+    if not 1 <= limit <= QUERY_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {QUERY_MAX_LIMIT}")
+    return {"where": where, "sort": sort, "desc": desc, "limit": limit}
+
+
+def columns_of(spec: Dict[str, Any]) -> Set[str]:
+    cols = {f["column"] for f in spec["where"]}
+    if spec["sort"]:
+        cols.add(spec["sort"])
+    return cols
+
+
+def _fingerprint(spec: Dict[str, Any]) -> str:
+    # a cursor only continues the query it came from
+    key = json.dumps([spec["where"], spec["sort"], spec["desc"]], sort_keys=True, default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def encode_cursor(spec: Dict[str, Any], row: Dict[str, Any]) -> str:
+    value = row.get("cells", {}).get(spec["sort"], {}).get("value") if spec["sort"] else None
+    raw = json.dumps({"q": _fingerprint(spec), "v": value, "r": row["row_index"]}, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(spec: Dict[str, Any], cursor: str) -> Dict[str, Any]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        ok = data["q"] == _fingerprint(spec) and isinstance(data["r"], int)
+    except Exception:
+        ok = False
+    if not ok:
+        raise ValueError("bad cursor")
+    return data
+
+
+def _bracket(value: Any) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 5
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, list):
+        return 4
+    raise ValueError("bad cursor")
+
+
+def _after(field: str, value: Any, row_index: int, desc: bool) -> List[Dict[str, Any]]:
+    """$or clauses for rows sorting strictly after (value, row_index)."""
+    b = _bracket(value)
+    clauses: List[Dict[str, Any]] = [{field: value, "row_index": {"$lt" if desc else "$gt": row_index}}]
+    if b:
+        # type-bracketed: only compares within the value's own kind
+        clauses.append({field: {"$lt" if desc else "$gt": value}})
+    if desc:
+        beyond = _BRACKETS[1:b]
+        if b:
+            clauses.append({field: None})
+    else:
+        beyond = _BRACKETS[b + 1:]
+    clauses.extend({field: {"$type": kind}} for kind in beyond)
+    return clauses
+
+
+def compile_filter(sheet_id: str, spec: Dict[str, Any], after: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    match: Dict[str, Any] = {"spreadsheet_id": sheet_id}
+    for f in spec["where"]:
+        col, op, value = f["column"], f["op"], f["value"]
+        if op == "type":
+            match[f"cells.{col}.type"] = value
+            continue
+        cond = match.setdefault(f"cells.{col}.value", {})
+        if op == "prefix":
+            cond["$regex"] = "^" + re.escape(value)
+        elif op == "exists":
+            cond["$ne" if value else "$eq"] = None
+        else:
+            cond[FILTER_OPS[op]] = value
+    if after is not None:
+        if spec["sort"]:
+            match["$or"] = _after(f"cells.{spec['sort']}.value", after["v"], after["r"], spec["desc"])
+        else:
+            match["row_index"] = {"$gt": after["r"]}
+    return match
+
+
+def sort_keys(spec: Dict[str, Any]) -> List[tuple]:
+    if not spec["sort"]:
+        return [("row_index", 1)]
+    direction = -1 if spec["desc"] else 1
+    return [(f"cells.{spec['sort']}.value", direction), ("row_index", direction)]
+
+
+def projection(spec: Dict[str, Any], cols: Optional[List[str]]) -> Dict[str, Any]:
+    proj: Dict[str, Any] = {"_id": 0, "row_index": 1, "version": 1}
+    if cols is None:
+        proj["cells"] = 1
+    else:
+        # the sort cell is needed for next_cursor even if the caller didn't ask for it
+        proj.update({f"cells.{col}": 1 for col in set(cols) | ({spec["sort"]} if spec["sort"] else set())})
+    return proj
+
+
+class ColumnIndexes:
+    """Builds per-column query indexes on `rows` for columns that keep being queried."""
+
+    def __init__(self, mode: str = QUERY_INDEX_MODE, after: int = QUERY_INDEX_AFTER,
+                 max_indexes: int = QUERY_MAX_INDEXES):
+        self.mode = mode
+        self.after = after
+        self.max_indexes = max_indexes
+        self.indexed: Set[str] = set()
+        self.building: Set[str] = set()
+        self.uses: Dict[str, int] = {}
+        self.failed = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def load(self, db):
+        """Pick up indexes built earlier (by any instance); in wildcard mode build the one index."""
+        if self.mode == "wildcard":
+            try:
+                await db.rows.create_index([("spreadsheet_id", 1), ("cells.$**", 1)], name=INDEX_PREFIX + "wildcard")
+            except Exception:
+                self.failed += 1
+                logger.exception("wildcard query index could not be built (needs MongoDB 7.0+)")
+            return
+        async for ix in db.rows.list_indexes():
+            name = ix.get("name", "")
+            if name.startswith(INDEX_PREFIX) and name[len(INDEX_PREFIX):] in COLUMN_INDEX:
+                self.indexed.add(name[len(INDEX_PREFIX):])
+
+    def note(self, db, columns: Set[str]):
+        """Count a query on these columns; start building indexes for the ones that became hot."""
+        if self.mode != "column":
+            return
+        for col in columns:
+            if col in self.indexed or col in self.building:
+                continue
+            self.uses[col] = self.uses.get(col, 0) + 1
+            if self.uses[col] >= self.after and len(self.indexed) + len(self.building) < self.max_indexes:
+                self.building.add(col)
+                task = asyncio.create_task(self._build(db, col))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _build(self, db, col: str):
+        try:
+            await db.rows.create_index([("spreadsheet_id", 1), (f"cells.{col}.value", 1), ("row_index", 1)],
+                                       name=INDEX_PREFIX + col)
+            self.indexed.add(col)
+        except Exception:
+            self.failed += 1
+            logger.exception("query index on column %s failed", col)
+        finally:
+            self.building.discard(col)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "indexed": sorted(self.indexed, key=COLUMN_INDEX.get),
+            "building": sorted(self.building, key=COLUMN_INDEX.get),
+            "max_indexes": self.max_indexes,
+            "failed": self.failed,
+        }
+
+
+async def run(db, indexes: ColumnIndexes, sheet_id: str, spec: Dict[str, Any],
+              cols: Optional[List[str]] = None) -> Dict[str, Any]:
+    cursor = spec.get("cursor")
+    spec = normalize(spec)
+    after = decode_cursor(spec, cursor) if cursor else None
+    indexes.note(db, columns_of(spec))
+    found = db.rows.find(compile_filter(sheet_id, spec, after), projection(spec, cols))
+    docs = await found.sort(sort_keys(spec)).limit(spec["limit"] + 1).to_list(spec["limit"] + 1)
+    more = len(docs) > spec["limit"]
+    docs = docs[:spec["limit"]]
+    next_cursor = encode_cursor(spec, docs[-1]) if more else None
+    rows = []
+    for d in docs:
+        cells = d.get("cells", {})
+        if cols is not None:
+            cells = {c: cells[c] for c in cols if c in cells}
+        rows.append({"row_index": d["row_index"], "cells": cells, "version": d.get("version", 1)})
+    return {"rows": rows, "next_cursor": next_cursor}
@@ -0,0 +1,322 @@
+"""
+WebSocket fanout for sheet subscribers.
+
+Every socket gets a bounded outbound queue drained by its own writer task, so
+broadcast() only serializes the message once and enqueues it; it never waits on
+a socket. When a subscriber's queue is full the slow-client policy applies:
+
+- "drop":   the new message is dropped for that subscriber;
+- "resync": the backlog is discarded and replaced by a single
+            {"type": "resync"} message telling the client to reload its rows.
+
+Broadcasts go through a BroadcastBus (broadcast_bus.py), so with a network
+backend every instance fans events out to its own sockets.
+
+Every event carries a per-sheet sequence number as its first field
+({"seq": 17, "type": ...}). The sequencer is shared by all instances (main.py
+keeps the counter on the spreadsheet doc), so a client that reconnects, or that
+got a "resync", can send {"type": "resume", "seq": <last seen>}. Missed events
+come from a bounded per-sheet replay buffer (ReplayBuffer, WS_REPLAY_BUFFER
+events per sheet) or, when it has gaps, from the changes log (history.py).
+
+Sockets may negotiate a more compact wire format (wire.py): diff-only compact
+cells, batched frames and optionally MessagePack.
+"""
+import os
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, List, Callable, Awaitable
+
+from fastapi import WebSocket
+
+from broadcast_bus import BroadcastBus, InProcessBus
+from metrics import WS_FANOUT, sheet_label
+from wire import Wire, V1, WS_BATCH_MAX
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "256"))
+WS_SLOW_CLIENT_POLICY = os.getenv("WS_SLOW_CLIENT_POLICY", "resync")
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "1024"))
+WS_REPLAY_BYTES = int(os.getenv("WS_REPLAY_BYTES", str(1024 * 1024)))  # per sheet
+# sheets whose replay buffers are kept, least recently written are dropped first
+WS_REPLAY_SHEETS = int(os.getenv("WS_REPLAY_SHEETS", "1000"))
+RESYNC_MESSAGE = json.dumps({"type": "resync", "reason": "lagging"}, separators=(",", ":"))
+_SEQ_PREFIX = '{"seq":'
+
+
+def encode(message: Dict[str, Any]) -> str:
+    # same encoding as WebSocket.send_json
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def stamp(seq: int, message: Dict[str, Any]) -> Dict[str, Any]:
+    # seq goes first so frame_seq() can read it back without decoding the frame
+    out = {"seq": seq}
+    out.update(message)
+    return out
+
+
+def frame_seq(frame: str) -> Optional[int]:
+    if not frame.startswith(_SEQ_PREFIX):
+        return None
+    end = frame.find(",", len(_SEQ_PREFIX))
+    try:
+        return int(frame[len(_SEQ_PREFIX):end if end != -1 else len(frame) - 1])
+    except ValueError:
+        return None
+
+
+class _SheetFrames:
+    __slots__ = ("order", "frames", "size")
+
+    def __init__(self):
+        self.order: deque = deque()
+        self.frames: Dict[int, str] = {}
+        self.size = 0
+
+
+class ReplayBuffer:
+    """
+    Last event frames per sheet, keyed by seq: at most `size` frames and `max_bytes`
+    characters per sheet, for at most `max_sheets` sheets (least recently written
+    are dropped first).
+    """
+
+    def __init__(self, size: int = WS_REPLAY_BUFFER, max_bytes: int = WS_REPLAY_BYTES,
+                 max_sheets: int = WS_REPLAY_SHEETS):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_sheets = max_sheets
+        self._sheets: "OrderedDict[str, _SheetFrames]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, sheet_id: str, seq: int, frame: str):
+        entry = self._sheets.get(sheet_id)
+        if entry is None:
+            entry = self._sheets[sheet_id] = _SheetFrames()
+            while len(self._sheets) > self.max_sheets:
+                self._sheets.popitem(last=False)
+        else:
+            self._sheets.move_to_end(sheet_id)
+        if seq in entry.frames:
+            return
+        entry.order.append(seq)
+        entry.frames[seq] = frame
+        entry.size += len(frame)
+        while entry.order and (len(entry.order) > self.size or entry.size > self.max_bytes):
+            entry.size -= len(entry.frames.pop(entry.order.popleft()))
+
+    def since(self, sheet_id: str, after: int, upto: int) -> Optional[List[str]]:
+        """Frames after..upto in seq order, or None unless every one of them is buffered."""
+        entry = self._sheets.get(sheet_id)
+        frames = entry.frames if entry else {}
+        out = []
+        for seq in range(after + 1, upto + 1):
+            frame = frames.get(seq)
+            if frame is None:
+                self.misses += 1
+                return None
+            out.append(frame)
+        self.hits += 1
+        return out
+
+
+class Subscriber:
+    """One socket: bounded queue of encoded frames plus the task that writes them."""
+
+    def __init__(self, manager: "ConnectionManager", sheet_id: str, websocket: WebSocket, queue_size: int,
+                 wire: Wire = V1):
+        self.manager = manager
+        self.sheet_id = sheet_id
+        self.websocket = websocket
+        self.wire = wire
+        # frames already in this socket's wire format
+        self.queue: "asyncio.Queue" = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message: Dict[str, Any]) -> bool:
+        return self.offer(self.wire.encode(message))
+
+    def replay(self, seq: int, source: str, frames: List[str]):
+        """Queue a "replay" message carrying already encoded (v1) event frames."""
+        if self.wire is V1:
+            # splice them in instead of decoding and re-encoding
+            self.offer(f'{{"type":"replay","seq":{seq},"source":"{source}","events":[{",".join(frames)}]}}')
+        else:
+            self.enqueue({"type": "replay", "seq": seq, "source": source, "events": [json.loads(f) for f in frames]})
+
+    def offer(self, frame) -> bool:
+        """Queue a frame already in this socket's wire format; never blocks. False if it was not queued."""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if self.manager.policy == "resync":
+            discarded = 0
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                discarded += 1
+            self.queue.put_nowait(self.wire.render(RESYNC_MESSAGE, {}))
+            self.dropped += discarded + 1
+            self.manager.dropped += discarded + 1
+            self.manager.resyncs += 1
+        else:
+            self.dropped += 1
+            self.manager.dropped += 1
+        return False
+
+    async def _writer(self):
+        try:
+            while True:
+                items = [await self.queue.get()]
+                # whatever else is already queued goes out in the same frame (v2 wires)
+                while self.wire.version > 1 and len(items) < WS_BATCH_MAX and not self.queue.empty():
+                    items.append(self.queue.get_nowait())
+                self.manager.bytes_out += await self.wire.send(self.websocket, items)
+                self.manager.messages_out += self.wire.frames(items)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # socket is gone; the receive loop will see the disconnect as well
+            await self.manager.disconnect(self.sheet_id, self.websocket)
+
+    def close(self):
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+
+class ConnectionManager:
+    """sheet_id -> {websocket: Subscriber}, with a lock per sheet instead of one global lock."""
+
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, policy: str = WS_SLOW_CLIENT_POLICY,
+                 bus: Optional[BroadcastBus] = None,
+                 sequencer: Optional[Callable[[str], Awaitable[int]]] = None):
+        if policy not in ("drop", "resync"):
+            raise ValueError(f"unknown slow client policy: {policy}")
+        self.bus = bus or InProcessBus()
+        # sequencer(sheet_id) -> next seq; the default counter is per process
+        self.sequencer = sequencer
+        self._seqs: Dict[str, int] = {}
+        self.replay = ReplayBuffer()
+        self.queue_size = queue_size
+        self.policy = policy
+        self.connections: Dict[str, Dict[WebSocket, Subscriber]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # tasks holding or waiting for each sheet's lock
+        self._lock_users: Dict[str, int] = {}
+        # counters
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.broadcasts = 0
+
+    async def start(self):
+        await self.bus.start(self.deliver_local)
+
+    async def close(self):
+        await self.bus.close()
+
+    @asynccontextmanager
+    async def _lock(self, sheet_id: str):
+        """
+        Serializes (un)subscribing a sheet. The lock is dropped once the sheet has
+        no sockets and no task holds or waits for it; a task that drops it while
+        another is queued on it would let the next caller create a second lock.
+        """
+        lock = self._locks.get(sheet_id)
+        if lock is None:
+            lock = self._locks[sheet_id] = asyncio.Lock()
+        self._lock_users[sheet_id] = self._lock_users.get(sheet_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            users = self._lock_users[sheet_id] - 1
+            if users:
+                self._lock_users[sheet_id] = users
+            else:
+                del self._lock_users[sheet_id]
+                if sheet_id not in self.connections:
+                    del self._locks[sheet_id]
+
+    async def connect(self, sheet_id: str, websocket: WebSocket, wire: Wire = V1) -> Subscriber:
+        await websocket.accept()
+        sub = Subscriber(self, sheet_id, websocket, self.queue_size, wire)
+        async with self._lock(sheet_id):
+            conns = self.connections.setdefault(sheet_id, {})
+            if not conns:
+                await self.bus.subscribe(sheet_id)
+            conns[websocket] = sub
+        sub.start()
+        return sub
+
+    async def disconnect(self, sheet_id: str, websocket: WebSocket):
+        async with self._lock(sheet_id):
+            conns = self.connections.get(sheet_id)
+            if not conns:
+                return
+            sub = conns.pop(websocket, None)
+            if sub is not None:
+                sub.close()
+            if len(conns) == 0:
+                self.connections.pop(sheet_id, None)
+                await self.bus.unsubscribe(sheet_id)
+
+    async def next_seq(self, sheet_id: str) -> int:
+        if self.sequencer is not None:
+            return await self.sequencer(sheet_id)
+        seq = self._seqs[sheet_id] = self._seqs.get(sheet_id, 0) + 1
+        return seq
+
+    async def broadcast(self, sheet_id: str, message: Dict[str, Any], seq: Optional[int] = None) -> int:
+        """
+        Stamp the next seq (or the one reserved with next_seq()), encode once and
+        publish on the bus; local delivery only enqueues, it never waits on sends.
+        """
+        if seq is None:
+            seq = await self.next_seq(sheet_id)
+        self.broadcasts += 1
+        await self.bus.publish(sheet_id, encode(stamp(seq, message)))
+        return seq
+
+    def deliver_local(self, sheet_id: str, frame: str):
+        """Bus callback: remember the frame for resume and fan it out to this instance's subscribers."""
+        seq = frame_seq(frame)
+        if seq is not None:
+            self.replay.add(sheet_id, seq, frame)
+        conns = self.connections.get(sheet_id)
+        if not conns:
+            return
+        started = time.perf_counter()
+        rendered: Dict[Any, Any] = {}
+        for sub in list(conns.values()):
+            sub.offer(sub.wire.render(frame, rendered))
+        WS_FANOUT.observe(time.perf_counter() - started, sheet_label(sheet_id))
+
+    def stats(self) -> Dict[str, Any]:
+        depths = [sub.queue.qsize() for conns in self.connections.values() for sub in conns.values()]
+        return {
+            "sheets": len(self.connections),
+            "connections": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_size": self.queue_size,
+            "policy": self.policy,
+            "broadcasts": self.broadcasts,
+            "messages_out": self.messages_out,
+            "bytes_out": self.bytes_out,
+            "dropped": self.dropped,
+            "resyncs": self.resyncs,
+            "replay_hits": self.replay.hits,
+            "replay_misses": self.replay.misses,
+            "bus": self.bus.stats(),
+        }
@@ -0,0 +1,276 @@
+"""
+Formula dependency graph and incremental recalculation.
+
+The graph is persisted in `formula_deps`, one document per formula cell:
+
+    {_id: "<sheet_id>:<ref>", spreadsheet_id, col, row_index, formula,
+     refs: [{c1, r1, c2, r2}, ...]}   # rectangles the formula reads
+
+so "which formulas read cell X" is an $elemMatch over refs. After a write,
+recalculate() walks dependents level by level from the written cells, orders
+the dirty formulas topologically (Kahn), evaluates them against the cells they
+read and writes back only results that changed. Work is proportional to the
+dirty cells and their inputs, never to the sheet size. Formulas left over by
+Kahn's algorithm sit on (or behind) a cycle and get #CYCLE!.
+
+The spreadsheet doc counts its formula cells (`formula_cells`, kept by
+update_graph). Writes to a sheet without formulas skip the dependents lookup;
+the count comes along with the event seq every write already takes, so the
+check costs no extra round trip.
+"""
+import logging
+from bisect import bisect_left, bisect_right
+from collections import deque
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
+
+import formulas
+from columns import COLUMN_LETTERS, COLUMN_INDEX
+
+# dependents of this many written cells are looked up in one query
+FRONTIER_QUERY_RUNS = 200
+# input rows are read with at most this many row intervals per query
+LOAD_QUERY_INTERVALS = 200
+
+logger = logging.getLogger(__name__)
+
+Cell = Tuple[int, int]  # (col, row), 1-based
+
+# sheet id -> formula_cells, as last seen on the spreadsheet doc
+_formula_cells: Dict[str, int] = {}
+
+
+def dep_id(sheet_id: str, col: int, row: int) -> str:
+    return f"{sheet_id}:{COLUMN_LETTERS[col - 1]}{row}"
+
+
+async def ensure_indexes(db):
+    await db.formula_deps.create_index([("spreadsheet_id", 1), ("refs.c1", 1), ("refs.r1", 1)])
+
+
+async def count_formula_cells(db):
+    """Give sheets created before formula_cells existed their count; runs at startup."""
+    if not await db.spreadsheets.find_one({"formula_cells": {"$exists": False}}, {"_id": 1}):
+        return
+    async for d in db.formula_deps.aggregate([{"$group": {"_id": "$spreadsheet_id", "n": {"$sum": 1}}}]):
+        await db.spreadsheets.update_one({"_id": d["_id"], "formula_cells": {"$exists": False}},
+                                         {"$set": {"formula_cells": d["n"]}})
+    await db.spreadsheets.update_many({"formula_cells": {"$exists": False}}, {"$set": {"formula_cells": 0}})
+
+
+def remember(sheet_id: str, fields: Dict[str, Any]):
+    """Note formula_cells from a spreadsheet doc read for something else."""
+    if "formula_cells" in fields:
+        _formula_cells[sheet_id] = fields["formula_cells"]
+
+
+async def has_formulas(db, sheet_id: str) -> bool:
+    count = _formula_cells.get(sheet_id)
+    if count is None:
+        sheet = await db.spreadsheets.find_one({"_id": sheet_id}, {"formula_cells": 1})
+        if sheet is None:
+            return False
+        if "formula_cells" not in sheet:
+            return True  # not counted yet
+        remember(sheet_id, sheet)
+        count = sheet["formula_cells"]
+    return count > 0
+
+
+async def update_graph(db, sheet_id: str, written: Dict[Cell, Optional[Dict[str, Any]]],
+                       was_formula: Set[Cell]):
+    """
+    Keep formula_deps in step with a write. written maps every written cell to
+    its new stored cell (None = cleared); was_formula holds the cells that were
+    formulas before the write.
+    """
+    ops = []
+    for (col, row), cell in written.items():
+        _id = dep_id(sheet_id, col, row)
+        if cell is not None and cell.get("type") == "formula":
+            refs = formulas.references(formulas.parse(cell["formula"]))
+            ops.append(UpdateOne({"_id": _id}, {"$set": {
+                "spreadsheet_id": sheet_id,
+                "col": col,
+                "row_index": row,
+                "formula": cell["formula"],
+                "refs": [{"c1": c1, "r1": r1, "c2": c2, "r2": r2} for c1, r1, c2, r2 in refs],
+            }}, upsert=True))
+        elif (col, row) in was_formula:
+            ops.append(DeleteOne({"_id": _id}))
+    if not ops:
+        return
+    result = await db.formula_deps.bulk_write(ops, ordered=False)
+    added = result.upserted_count - result.deleted_count
+    if added:
+        sheet = await db.spreadsheets.find_one_and_update({"_id": sheet_id}, {"$inc": {"formula_cells": added}},
+                                                          projection={"formula_cells": 1},
+                                                          return_document=ReturnDocument.AFTER)
+        if sheet is not None:
+            remember(sheet_id, sheet)
+
+
+def _runs(cells) -> List[Tuple[int, int, int]]:
+    """Group cells into (col, first_row, last_row) runs of consecutive rows."""
+    by_col: Dict[int, List[int]] = {}
+    for col, row in cells:
+        by_col.setdefault(col, []).append(row)
+    runs = []
+    for col, rows in by_col.items():
+        rows.sort()
+        start = prev = rows[0]
+        for row in rows[1:]:
+            if row != prev + 1:
+                runs.append((col, start, prev))
+                start = row
+            prev = row
+        runs.append((col, start, prev))
+    return runs
+
+
+async def _dependents(db, sheet_id: str, frontier) -> List[Dict[str, Any]]:
+    runs = _runs(frontier)
+    out = []
+    for i in range(0, len(runs), FRONTIER_QUERY_RUNS):
+        clauses = [{"refs": {"$elemMatch": {"c1": {"$lte": col}, "c2": {"$gte": col},
+                                            "r1": {"$lte": last}, "r2": {"$gte": first}}}}
+                   for col, first, last in runs[i:i + FRONTIER_QUERY_RUNS]]
+        flt = {"spreadsheet_id": sheet_id}
+        flt.update(clauses[0] if len(clauses) == 1 else {"$or": clauses})
+        async for doc in db.formula_deps.find(flt, {"col": 1, "row_index": 1, "formula": 1}):
+            out.append(doc)
+    return out
+
+
+def _topological(dirty: Dict[Cell, str]) -> Tuple[List[Cell], List[Cell]]:
+    """(evaluation order, cells on or behind a cycle)."""
+    by_col: Dict[int, List[int]] = {}
+    for col, row in dirty:
+        by_col.setdefault(col, []).append(row)
+    for rows in by_col.values():
+        rows.sort()
+    indegree = {cell: 0 for cell in dirty}
+    dependents: Dict[Cell, List[Cell]] = {cell: [] for cell in dirty}
+    for cell, text in dirty.items():
+        for c1, r1, c2, r2 in formulas.references(formulas.parse(text)):
+            cols = range(c1, c2 + 1) if c2 - c1 < len(by_col) else [c for c in by_col if c1 <= c <= c2]
+            for col in cols:
+                rows = by_col.get(col)
+                if not rows:
+                    continue
+                for row in rows[bisect_left(rows, r1):bisect_right(rows, r2)]:
+                    dependents[(col, row)].append(cell)
+                    indegree[cell] += 1
+    queue = deque(cell for cell, n in indegree.items() if n == 0)
+    order = []
+    while queue:
+        cell = queue.popleft()
+        order.append(cell)
+        for dep in dependents[cell]:
+            indegree[dep] -= 1
+            if indegree[dep] == 0:
+                queue.append(dep)
+    stuck = [cell for cell, n in indegree.items() if n > 0]
+    return order, stuck
+
+
+def _merge_intervals(intervals: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged: List[List[int]] = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return [(lo, hi) for lo, hi in merged]
+
+
+async def _load_cells(db, sheet_id: str, rects: List[formulas.Rect]) -> Dict[Cell, Dict[str, Any]]:
+    """Stored cells inside the given rectangles, keyed by (col, row)."""
+    if not rects:
+        return {}
+    intervals = _merge_intervals([(r1, r2) for _, r1, _, r2 in rects])
+    cols = sorted({c for c1, _, c2, _ in rects for c in range(c1, c2 + 1)})
+    projection = {"row_index": 1}
+    projection.update({f"cells.{COLUMN_LETTERS[c - 1]}": 1 for c in cols})
+    out: Dict[Cell, Dict[str, Any]] = {}
+    for i in range(0, len(intervals), LOAD_QUERY_INTERVALS):
+        chunk = intervals[i:i + LOAD_QUERY_INTERVALS]
+        ranges = [{"row_index": {"$gte": lo, "$lte": hi}} for lo, hi in chunk]
+        flt = {"spreadsheet_id": sheet_id}
+        flt.update(ranges[0] if len(ranges) == 1 else {"$or": ranges})
+        async for r in db.rows.find(flt, projection):
+            for letter, cell in (r.get("cells") or {}).items():
+                col = COLUMN_INDEX.get(letter)
+                if col is not None:
+                    out[(col, r["row_index"])] = cell
+    return out
+
+
+async def recalculate(db, sheet_id: str, written: Dict[Cell, Optional[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Recompute every formula that transitively reads a written cell (and the
+    written formula cells themselves). Returns the rows whose formula results
+    changed as [{"row_index", "cells": {col: cell}}], for cache/broadcast.
+    """
+    dirty: Dict[Cell, str] = {cell: c["formula"] for cell, c in written.items()
+                              if c is not None and c.get("type") == "formula"}
+    frontier = list(written)
+    while frontier:
+        found = []
+        for doc in await _dependents(db, sheet_id, frontier):
+            cell = (doc["col"], doc["row_index"])
+            if cell not in dirty:
+                dirty[cell] = doc["formula"]
+                found.append(cell)
+        frontier = found
+    if not dirty:
+        return []
+
+    order, stuck = _topological(dirty)
+    rects = [rect for text in dirty.values() for rect in formulas.references(formulas.parse(text))]
+    rects.extend((col, row, col, row) for col, row in dirty)
+    stored = await _load_cells(db, sheet_id, rects)
+
+    results: Dict[Cell, Any] = {cell: formulas.CYCLE for cell in stuck}
+
+    def value_of(col: int, row: int):
+        if (col, row) in results:
+            return results[(col, row)]
+        if (col, row) in dirty:
+            return formulas.CYCLE
+        return formulas.cell_value(stored.get((col, row)))
+
+    def values_of(rect):
+        c1, r1, c2, r2 = rect
+        return [value_of(c, r) for r in range(r1, r2 + 1) for c in range(c1, c2 + 1)]
+
+    for cell in order:
+        results[cell] = formulas.evaluate(formulas.parse(dirty[cell]), value_of, values_of)
+
+    ops = []
+    changed: Dict[int, Dict[str, Any]] = {}
+    for (col, row), value in results.items():
+        text = dirty[(col, row)]
+        result = formulas.formula_result(value)
+        current = stored.get((col, row)) or {}
+        if current.get("formula") != text:
+            continue  # overwritten since the graph was read
+        if current.get("value") == result["value"] and current.get("error") == result["error"]:
+            continue
+        letter = COLUMN_LETTERS[col - 1]
+        update = {"$set": {f"cells.{letter}.value": result["value"]}}
+        if result["error"]:
+            update["$set"][f"cells.{letter}.error"] = result["error"]
+        else:
+            update["$unset"] = {f"cells.{letter}.error": ""}
+        ops.append(UpdateOne({"spreadsheet_id": sheet_id, "row_index": row, f"cells.{letter}.formula": text}, update))
+        new_cell = {"type": "formula", "formula": text, "value": result["value"]}
+        if result["error"]:
+            new_cell["error"] = result["error"]
+        changed.setdefault(row, {})[letter] = new_cell
+    if ops:
+        await db.rows.bulk_write(ops, ordered=False)
+    if stuck:
+        logger.info("sheet %s: %d formula cells on a reference cycle", sheet_id, len(stuck))
+    return [{"row_index": row, "cells": cells} for row, cells in sorted(changed.items())]
@@ -0,0 +1,228 @@
+"""
+In-process cache of row windows for get_rows.
+
+Rows are cached in fixed blocks of ROW_BLOCK_SIZE row indexes per sheet, in an
+LRU bounded to ROW_CACHE_BLOCKS blocks. A cached block holds every row that
+exists in its index range, so a window made of cached blocks needs no query.
+
+Writes go through the cache: inserted rows are added to their block, patched
+rows are merged when the new version directly follows the cached one, and
+anything else (out-of-order versions, range writes, imports) invalidates.
+The cache is per process and only sees this instance's writes. With a shared
+broadcast bus (BROADCAST_BUS other than memory, i.e. several instances) blocks
+expire after ROW_CACHE_TTL seconds by default, which bounds how long another
+instance's writes can go unseen; with the in-process bus they never expire.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+
+from broadcast_bus import BROADCAST_BUS
+
+ROW_BLOCK_SIZE = int(os.getenv("ROW_BLOCK_SIZE", "100"))
+ROW_CACHE_BLOCKS = int(os.getenv("ROW_CACHE_BLOCKS", "4096"))
+# seconds, 0 = no expiry; other instances' writes are only picked up on expiry
+ROW_CACHE_TTL = float(os.getenv("ROW_CACHE_TTL", "0" if BROADCAST_BUS == "memory" else "2"))
+# windows spanning more blocks than this bypass the cache instead of flooding it
+ROW_CACHE_MAX_WINDOW_BLOCKS = int(os.getenv("ROW_CACHE_MAX_WINDOW_BLOCKS", "20"))
+
+BlockKey = Tuple[str, int]
+# write generations are tracked in hashed slots; a collision only skips a cache fill
+_GENERATION_SLOTS = 4096
+
+
+class _Block:
+    __slots__ = ("rows", "loaded_at")
+
+    def __init__(self, rows: Dict[int, Dict[str, Any]]):
+        self.rows = rows
+        self.loaded_at = time.monotonic()
+
+
+class RowCache:
+    def __init__(self, block_size: int = ROW_BLOCK_SIZE, max_blocks: int = ROW_CACHE_BLOCKS,
+                 ttl: float = ROW_CACHE_TTL, max_window_blocks: int = ROW_CACHE_MAX_WINDOW_BLOCKS):
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.ttl = ttl
+        self.max_window_blocks = max_window_blocks
+        self._blocks: "OrderedDict[BlockKey, _Block]" = OrderedDict()
+        self._by_sheet: Dict[str, set] = {}
+        self._generations = [0] * _GENERATION_SLOTS
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bypasses = 0
+
+    def block_of(self, row_index: int) -> int:
+        return (row_index - 1) // self.block_size
+
+    def block_range(self, block: int) -> Tuple[int, int]:
+        first = block * self.block_size + 1
+        return first, first + self.block_size - 1
+
+    # ---------- internals ----------
+    def _slot(self, sheet_id: str) -> int:
+        return hash(sheet_id) % _GENERATION_SLOTS
+
+    def _bump(self, sheet_id: str):
+        self._generations[self._slot(sheet_id)] += 1
+
+    def _get(self, key: BlockKey) -> Optional[_Block]:
+        block = self._blocks.get(key)
+        if block is None:
+            return None
+        if self.ttl and time.monotonic() - block.loaded_at > self.ttl:
+            self._drop(key)
+            return None
+        self._blocks.move_to_end(key)
+        return block
+
+    def _drop(self, key: BlockKey):
+        if self._blocks.pop(key, None) is not None:
+            keys = self._by_sheet.get(key[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    self._by_sheet.pop(key[0], None)
+
+    def _store(self, key: BlockKey, rows: Dict[int, Dict[str, Any]]):
+        self._blocks[key] = _Block(rows)
+        self._blocks.move_to_end(key)
+        self._by_sheet.setdefault(key[0], set()).add(key)
+        while len(self._blocks) > self.max_blocks:
+            old_key, _ = self._blocks.popitem(last=False)
+            self.evictions += 1
+            keys = self._by_sheet.get(old_key[0])
+            if keys is not None:
+                keys.discard(old_key)
+                if not keys:
+                    self._by_sheet.pop(old_key[0], None)
+
+    # ---------- reads ----------
+    async def get_window(self, sheet_id: str, start: int, end: int, load) -> List[Dict[str, Any]]:
+        """
+        Rows with start <= row_index <= end, sorted. `load(lo, hi)` is an async callable
+        returning the rows of that index range; it is called at most once, for the
+        span of the blocks that were not cached.
+        """
+        if end < start:
+            return []
+        first_block, last_block = self.block_of(max(start, 1)), self.block_of(max(end, 1))
+        if last_block - first_block + 1 > self.max_window_blocks:
+            self.bypasses += 1
+            return await load(start, end)
+        blocks: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        missing = []
+        for b in range(first_block, last_block + 1):
+            cached = self._get((sheet_id, b))
+            if cached is None:
+                missing.append(b)
+            else:
+                blocks[b] = cached.rows
+        self.hits += len(blocks)
+        self.misses += len(missing)
+        if missing:
+            lo, hi = self.block_range(missing[0])[0], self.block_range(missing[-1])[1]
+            generation = self._generations[self._slot(sheet_id)]
+            fetched: Dict[int, Dict[int, Dict[str, Any]]] = {b: {} for b in missing}
+            for row in await load(lo, hi):
+                b = self.block_of(row["row_index"])
+                if b in fetched:
+                    fetched[b][row["row_index"]] = row
+            # a write that landed while we were loading may not be in `fetched`
+            fresh = generation == self._generations[self._slot(sheet_id)]
+            for b, rows in fetched.items():
+                if fresh:
+                    self._store((sheet_id, b), rows)
+                blocks[b] = rows
+        out = []
+        for b in range(first_block, last_block + 1):
+            rows = blocks[b]
+            for idx in sorted(rows):
+                if start <= idx <= end:
+                    out.append(rows[idx])
+        return out
+
+    def peek_window(self, sheet_id: str, start: int, end: int) -> Optional[List[Dict[str, Any]]]:
+        """Like get_window but never loads: the rows if every block is cached, else None."""
+        if end < start:
+            return []
+        first_block, last_block = self.block_of(max(start, 1)), self.block_of(max(end, 1))
+        if last_block - first_block + 1 > self.max_window_blocks:
+            return None
+        blocks = []
+        for b in range(first_block, last_block + 1):
+            cached = self._get((sheet_id, b))
+            if cached is None:
+                return None
+            blocks.append(cached.rows)
+        self.hits += len(blocks)
+        out = []
+        for rows in blocks:
+            for idx in sorted(rows):
+                if start <= idx <= end:
+                    out.append(rows[idx])
+        return out
+
+    # ---------- write-through ----------
+    def put_row(self, sheet_id: str, row: Dict[str, Any]):
+        """A row was created (or fully rewritten): add it to its block if that block is cached."""
+        self._bump(sheet_id)
+        block = self._get((sheet_id, self.block_of(row["row_index"])))
+        if block is not None:
+            block.rows[row["row_index"]] = row
+
+    def merge_cells(self, sheet_id: str, row_index: int, cells: Dict[str, Any], version: int):
+        """
+        Apply a partial update (null = cleared cell). Cached rows are replaced, not
+        mutated, since earlier responses may still hold them. If the cached version
+        isn't version - 1 the block is invalidated instead.
+        """
+        self._bump(sheet_id)
+        key = (sheet_id, self.block_of(row_index))
+        block = self._get(key)
+        if block is None:
+            return
+        row = block.rows.get(row_index)
+        if row is None or row.get("version", 1) != version - 1:
+            self._drop(key)
+            self.invalidations += 1
+            return
+        merged = dict(row.get("cells", {}))
+        for col, cell in cells.items():
+            if cell is None:
+                merged.pop(col, None)
+            else:
+                merged[col] = cell
+        block.rows[row_index] = {"row_index": row_index, "cells": merged, "version": version}
+
+    def invalidate_rows(self, sheet_id: str, start: int, end: int):
+        self._bump(sheet_id)
+        for b in range(self.block_of(max(start, 1)), self.block_of(max(end, 1)) + 1):
+            if (sheet_id, b) in self._blocks:
+                self._drop((sheet_id, b))
+                self.invalidations += 1
+
+    def invalidate_sheet(self, sheet_id: str):
+        self._bump(sheet_id)
+        for key in list(self._by_sheet.get(sheet_id, ())):
+            self._drop(key)
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "blocks": len(self._blocks),
+            "max_blocks": self.max_blocks,
+            "block_size": self.block_size,
+            "sheets": len(self._by_sheet),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "bypasses": self.bypasses,
+        }
@@ -0,0 +1,317 @@
+"""
+Display order of rows via lexicographic order keys.
+
+row_index stays what it always was, the stable id of a row (cells, history,
+formulas and caches all key on it). Where a row is *shown* is decided by its
+`order_key`: a string over the base-62 alphabet 0-9A-Za-z, compared bytewise
+(Mongo's default string order). Keys are fractions in base 62, so between any
+two keys there is always another one:
+
+- inserting above/below a row writes only the new rows;
+- deleting a row deletes only that row;
+- moving rows rewrites only the moved rows' keys.
+
+Rows that are created by row_index (insert_row, write_range, imports) get
+key_for_index(row_index), so a sheet that never uses positional operations
+keeps row_index order. Once a sheet has been reordered (positional insert, move
+or rebalance; the spreadsheet doc's `reordered` flag) those keys no longer line
+up with display positions, and a new row goes right below the row with the next
+lower row_index instead (keys_for_indexes). Appending and prepending step to the neighbouring
+integer key; repeated inserts at the same spot in the middle make keys grow by
+about one character per six halvings. Once a key passes ORDER_KEY_MAX_LEN the sheet
+is rebalanced in the background (every key rewritten to key_for_index of its
+position). Positional operations and rebalancing of a sheet are serialized per
+process.
+"""
+import os
+import bisect
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from pymongo import UpdateOne, ReturnDocument
+
+DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BASE = len(DIGITS)
+_VALUE = {ch: i for i, ch in enumerate(DIGITS)}
+# key_for_index covers row indexes below 62**ORDER_KEY_WIDTH
+ORDER_KEY_WIDTH = 6
+ORDER_KEY_MAX_LEN = int(os.getenv("ORDER_KEY_MAX_LEN", "24"))
+REBALANCE_BATCH = 1000
+
+logger = logging.getLogger(__name__)
+
+
+# ---------- keys ----------
+def key_for_index(i: int) -> str:
+    """Fixed-width key preserving integer order; the trailing "V" keeps keys from ending in "0"."""
+    digits = []
+    for _ in range(ORDER_KEY_WIDTH):
+        i, d = divmod(i, BASE)
+        digits.append(DIGITS[d])
+    if i:
+        raise ValueError("row index too large for an order key")
+    return "".join(reversed(digits)) + "V"
+
+
+def _midpoint(a: str, b: Optional[str]) -> str:
+    """A key strictly between a and b (b=None: no upper bound). Neither may end in "0"."""
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else "0") == b[n]:
+            n += 1
+        if n:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    da = _VALUE[a[0]] if a else 0
+    db = _VALUE[b[0]] if b is not None else BASE
+    if db - da > 1:
+        return DIGITS[(da + db) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[da] + _midpoint(a[1:], None)
+
+
+def _index_of(key: str) -> int:
+    """Integer that key_for_index would give the key's first ORDER_KEY_WIDTH digits."""
+    n = 0
+    for ch in key[:ORDER_KEY_WIDTH].ljust(ORDER_KEY_WIDTH, "0"):
+        n = n * BASE + _VALUE[ch]
+    return n
+
+
+def _after(a: str) -> str:
+    # appends step to the next integer key, so keys stay short at the end of a sheet
+    n = _index_of(a) + 1
+    if n < BASE ** ORDER_KEY_WIDTH:
+        return key_for_index(n)
+    return _midpoint(a, None)
+
+
+def _before(b: str) -> str:
+    n = _index_of(b)
+    if n > 0:
+        return key_for_index(n - 1)
+    for i, ch in enumerate(b):
+        if ch != "0":
+            d = _VALUE[ch] - 1
+            return b[:i] + DIGITS[d] + ("V" if d == 0 else "")
+    raise ValueError(f"no key before {b!r}")
+
+
+def key_between(a: Optional[str], b: Optional[str]) -> str:
+    """Key for a row placed between keys a and b (None = start/end of the sheet)."""
+    if a is not None and b is not None:
+        if a >= b:
+            raise ValueError(f"{a!r} is not before {b!r}")
+        return _midpoint(a, b)
+    if a is not None:
+        return _after(a)
+    if b is not None:
+        return _before(b)
+    return key_for_index(1)
+
+
+def keys_between(a: Optional[str], b: Optional[str], n: int) -> List[str]:
+    """n increasing keys between a and b, split by bisection so they stay short."""
+    if n <= 0:
+        return []
+    mid = key_between(a, b)
+    left = (n - 1) // 2
+    return keys_between(a, mid, left) + [mid] + keys_between(mid, b, n - 1 - left)
+
+
+# ---------- storage ----------
+_migrated: set = set()
+_locks: Dict[str, asyncio.Lock] = {}
+_rebalancing: set = set()
+_reordered: set = set()
+
+
+def lock(sheet_id: str) -> asyncio.Lock:
+    l = _locks.get(sheet_id)
+    if l is None:
+        l = _locks[sheet_id] = asyncio.Lock()
+    return l
+
+
+async def ensure_indexes(db):
+    await db.rows.create_index([("spreadsheet_id", 1), ("order_key", 1)])
+
+
+async def ensure_order_keys(db, sheet_id: str):
+    """Give rows written before order keys existed their key_for_index(row_index); once per sheet."""
+    if sheet_id in _migrated:
+        return
+    ops = []
+    cursor = db.rows.find({"spreadsheet_id": sheet_id, "order_key": {"$exists": False}}, {"row_index": 1})
+    async for r in cursor:
+        ops.append(UpdateOne({"_id": r["_id"], "order_key": {"$exists": False}},
+                             {"$set": {"order_key": key_for_index(r["row_index"])}}))
+        if len(ops) >= REBALANCE_BATCH:
+            await db.rows.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.rows.bulk_write(ops, ordered=False)
+    _migrated.add(sheet_id)
+
+
+def ordered_cursor(db, sheet_id: str, projection: Dict[str, Any], after: Optional[str] = None):
+    flt: Dict[str, Any] = {"spreadsheet_id": sheet_id}
+    if after is not None:
+        flt["order_key"] = {"$gt": after}
+    return db.rows.find(flt, projection).sort("order_key", 1)
+
+
+async def neighbors_at(db, sheet_id: str, position: int,
+                       exclude: Optional[List[int]] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Keys of the rows that end up before and after something inserted at 0-based
+    display position, counting positions without the `exclude` rows.
+    """
+    flt: Dict[str, Any] = {"spreadsheet_id": sheet_id}
+    if exclude:
+        flt["row_index"] = {"$nin": exclude}
+    if position <= 0:
+        first = await db.rows.find(flt, {"order_key": 1}).sort("order_key", 1).limit(1).to_list(1)
+        return None, (first[0]["order_key"] if first else None)
+    docs = await db.rows.find(flt, {"order_key": 1}).sort("order_key", 1).skip(position - 1).limit(2).to_list(2)
+    if not docs:
+        last = await db.rows.find(flt, {"order_key": 1}).sort("order_key", -1).limit(1).to_list(1)
+        return (last[0]["order_key"] if last else None), None
+    return docs[0]["order_key"], (docs[1]["order_key"] if len(docs) > 1 else None)
+
+
+async def neighbors_of(db, sheet_id: str, row_index: int, below: bool = False,
+                       exclude: Optional[List[int]] = None) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    """
+    Keys around the slot just above (or below) row row_index; None if the row
+    doesn't exist. Another row with the same key comes back as that neighbour,
+    so the caller sees the two equal keys.
+    """
+    row = await db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": row_index}, {"order_key": 1})
+    if not row:
+        return None
+    key = row["order_key"]
+    flt: Dict[str, Any] = {"spreadsheet_id": sheet_id, "_id": {"$ne": row["_id"]}}
+    if exclude:
+        flt["row_index"] = {"$nin": exclude}
+    if below:
+        flt["order_key"] = {"$gte": key}
+        nxt = await db.rows.find(flt, {"order_key": 1}).sort("order_key", 1).limit(1).to_list(1)
+        return key, (nxt[0]["order_key"] if nxt else None)
+    flt["order_key"] = {"$lte": key}
+    prev = await db.rows.find(flt, {"order_key": 1}).sort("order_key", -1).limit(1).to_list(1)
+    return (prev[0]["order_key"] if prev else None), key
+
+
+async def mark_reordered(db, sheet_id: str):
+    """Flag the sheet as no longer keyed by row_index (see keys_for_indexes)."""
+    if sheet_id in _reordered:
+        return
+    await db.spreadsheets.update_one({"_id": sheet_id}, {"$set": {"reordered": True}})
+    _reordered.add(sheet_id)
+
+
+def is_reordered(sheet: Dict[str, Any]) -> bool:
+    """Whether the sheet's display order may differ from row_index order."""
+    return bool(sheet.get("reordered")) or sheet["_id"] in _reordered
+
+
+async def keys_for_indexes(db, sheet: Dict[str, Any], row_indexes: List[int]) -> Dict[int, str]:
+    """
+    Order keys for new rows created by row_index (none of them may exist yet).
+    Until the sheet is reordered these are key_for_index(row_index); after that
+    each run of new rows goes right below the existing row with the next lower
+    row_index, or above the first row if there is none.
+    """
+    if not row_indexes:
+        return {}
+    if not is_reordered(sheet):
+        return {i: key_for_index(i) for i in row_indexes}
+    sheet_id = sheet["_id"]
+    new = sorted(set(row_indexes))
+    flt: Dict[str, Any] = {"spreadsheet_id": sheet_id}
+    proj = {"_id": 0, "row_index": 1, "order_key": 1}
+    lower = await db.rows.find(dict(flt, row_index={"$lt": new[0]}), proj).sort("row_index", -1).limit(1).to_list(1)
+    inside = await db.rows.find(dict(flt, row_index={"$gt": new[0], "$lt": new[-1]}), proj).to_list(None)
+    existing = {r["row_index"]: r["order_key"] for r in lower + inside}
+    bounds = sorted(existing)
+    runs: Dict[int, List[int]] = {}
+    for i in new:
+        runs.setdefault(bisect.bisect_left(bounds, i), []).append(i)
+    out: Dict[int, str] = {}
+    for gap, run in runs.items():
+        above = existing[bounds[gap - 1]] if gap else None
+        cond = {"$gt": above} if above is not None else {"$exists": True}
+        nxt = await db.rows.find(dict(flt, order_key=cond), {"order_key": 1}).sort("order_key", 1).limit(1).to_list(1)
+        below = nxt[0]["order_key"] if nxt else None
+        out.update(zip(run, keys_between(above, below, len(run))))
+    return out
+
+
+async def position_of(db, sheet_id: str, order_key: str) -> int:
+    """0-based display position of the row with this key (a counted index range scan)."""
+    return await db.rows.count_documents({"spreadsheet_id": sheet_id, "order_key": {"$lt": order_key}})
+
+
+async def allocate_row_indexes(db, sheet_id: str, count: int) -> List[int]:
+    """Fresh row ids for positionally inserted rows, above every id in use."""
+    top = await db.rows.find({"spreadsheet_id": sheet_id}, {"row_index": 1}).sort("row_index", -1).limit(1).to_list(1)
+    highest = top[0]["row_index"] if top else 0
+    await db.spreadsheets.update_one({"_id": sheet_id}, {"$max": {"row_seq": highest}})
+    doc = await db.spreadsheets.find_one_and_update({"_id": sheet_id}, {"$inc": {"row_seq": count}},
+                                                    projection={"row_seq": 1}, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        return []
+    end = doc["row_seq"]
+    return list(range(end - count + 1, end + 1))
+
+
+def needs_rebalance(keys: List[str]) -> bool:
+    return any(len(k) > ORDER_KEY_MAX_LEN for k in keys)
+
+
+async def rebalance(db, sheet_id: str) -> int:
+    """Rewrite every key of the sheet to key_for_index(position + 1); returns rows rewritten."""
+    async with lock(sheet_id):
+        return await renumber(db, sheet_id)
+
+
+async def renumber(db, sheet_id: str) -> int:
+    """rebalance() for a caller that already holds the sheet's lock."""
+    await mark_reordered(db, sheet_id)
+    ops = []
+    changed = 0
+    position = 0
+    async for r in ordered_cursor(db, sheet_id, {"order_key": 1}):
+        position += 1
+        key = key_for_index(position)
+        if r.get("order_key") == key:
+            continue
+        ops.append(UpdateOne({"_id": r["_id"]}, {"$set": {"order_key": key}}))
+        changed += 1
+        if len(ops) >= REBALANCE_BATCH:
+            await db.rows.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db.rows.bulk_write(ops, ordered=False)
+    return changed
+
+
+def schedule_rebalance(db, sheet_id: str, on_done=None):
+    """Run rebalance() in the background unless one is already running for the sheet."""
+    if sheet_id in _rebalancing:
+        return
+
+    async def run():
+        try:
+            changed = await rebalance(db, sheet_id)
+            if on_done is not None:
+                await on_done(sheet_id, changed)
+        except Exception:
+            logger.exception("order key rebalance failed for %s", sheet_id)
+        finally:
+            _rebalancing.discard(sheet_id)
+
+    _rebalancing.add(sheet_id)
+    asyncio.create_task(run())
@@ -0,0 +1,290 @@
+"""
+Full-text search over string cells with an inverted index kept in Mongo.
+
+Every non-empty string cell of a row-storage sheet has one posting document,
+and every distinct term of a sheet one vocabulary document:
+
+    search_cells: {"_id": "<sheet>:<row_index>:<col>", "spreadsheet_id", "row_index",
+                   "col": <column number>, "terms": [<distinct terms>], "text": <normalized cell text>}
+    search_terms: {"_id": "<sheet>:<term>", "spreadsheet_id", "term", "cells": <posting count>}
+
+The multikey index on (spreadsheet_id, terms, row_index, col) is the posting
+list of each term, already in sheet order. Terms are the casefolded \\w+ runs of
+the text (at most SEARCH_MAX_TERMS per cell, SEARCH_MAX_TERM_LEN characters
+each). Numbers, dates and formulas are not indexed.
+
+A query returns hits in three tiers, each in sheet order:
+
+1. exact:  the cell's normalized text is the query's;
+2. words:  the cell contains every query term;
+3. prefix: as words, but the last query term only as a prefix (incremental
+   Ctrl+F). Prefixes expand to at most SEARCH_PREFIX_TERMS vocabulary terms.
+
+Each tier is an index scan that stops after one page; `words` scans the
+posting list of the rarest term (vocabulary counts pick it), so a page costs
+the same on a 500-row sheet and a 500k-row one. Pages continue through
+next_cursor.
+
+Imports index their batches in bulk (add_rows), cell writes update the
+postings of the cells they touch (update), and sheets created before search
+existed are indexed by a background rebuild on their first search.
+"""
+import os
+import re
+import json
+import base64
+import asyncio
+import hashlib
+import logging
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from columns import COLUMN_INDEX, COLUMN_LETTERS
+
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", "64"))
+SEARCH_MAX_TERM_LEN = int(os.getenv("SEARCH_MAX_TERM_LEN", "40"))
+SEARCH_PREFIX_TERMS = int(os.getenv("SEARCH_PREFIX_TERMS", "64"))
+SEARCH_MIN_PREFIX = int(os.getenv("SEARCH_MIN_PREFIX", "2"))
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "500"))
+MAX_TEXT_LEN = 256
+REBUILD_BATCH = 1000
+
+READY = "ready"
+BUILDING = "building"
+TIERS = ("exact", "words", "prefix")
+
+_WORD = re.compile(r"\w+")
+_building: set = set()
+
+logger = logging.getLogger(__name__)
+
+
+async def ensure_indexes(db):
+    await db.search_cells.create_index([("spreadsheet_id", 1), ("terms", 1), ("row_index", 1), ("col", 1)])
+    await db.search_cells.create_index([("spreadsheet_id", 1), ("text", 1), ("row_index", 1), ("col", 1)])
+
+
+# ---------- tokenizing ----------
+def tokenize(text: str) -> List[str]:
+    return [w[:SEARCH_MAX_TERM_LEN] for w in _WORD.findall(text.casefold())]
+
+
+def _indexed_text(cell: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not isinstance(cell, dict) or cell.get("type") != "string" or not isinstance(cell.get("value"), str):
+        return None
+    return cell["value"]
+
+
+def posting(sheet_id: str, row_index: int, col: str, cell: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Posting doc of a cell; None if the cell has nothing to index."""
+    text = _indexed_text(cell)
+    if text is None or col not in COLUMN_INDEX:
+        return None
+    tokens = tokenize(text)
+    if not tokens:
+        return None
+    return {"_id": f"{sheet_id}:{row_index}:{col}", "spreadsheet_id": sheet_id, "row_index": row_index,
+            "col": COLUMN_INDEX[col], "terms": list(dict.fromkeys(tokens))[:SEARCH_MAX_TERMS],
+            "text": " ".join(tokens)[:MAX_TEXT_LEN]}
+
+
+def _vocab_ops(sheet_id: str, deltas: Counter) -> List[UpdateOne]:
+    return [UpdateOne({"_id": f"{sheet_id}:{term}"},
+                      {"$inc": {"cells": n}, "$setOnInsert": {"spreadsheet_id": sheet_id, "term": term}}, upsert=True)
+            for term, n in deltas.items() if n]
+
+
+# ---------- writes ----------
+async def add_rows(db, sheet_id: str, rows: List[Dict[str, Any]]):
+    """Bulk-index new rows (imports, rebuilds): one insert_many and one vocabulary bulk_write."""
+    docs, deltas = [], Counter()
+    for r in rows:
+        for col, cell in r.get("cells", {}).items():
+            doc = posting(sheet_id, r["row_index"], col, cell)
+            if doc is not None:
+                docs.append(doc)
+                deltas.update(doc["terms"])
+    if not docs:
+        return
+    try:
+        await db.search_cells.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # a concurrent cell write already indexed the newer value
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+    await db.search_terms.bulk_write(_vocab_ops(sheet_id, deltas), ordered=False)
+
+
+async def update(db, sheet_id: str, rows: List[Tuple[int, Dict[str, Dict[str, Any]]]]):
+    """
+    Re-index written cells. rows: (row_index, {col: {"old": cell, "new": cell}}),
+    i.e. the changes records of the audit log; None is an empty cell.
+    """
+    ops, deltas = [], Counter()
+    for row_index, changes in rows:
+        for col, change in changes.items():
+            old = posting(sheet_id, row_index, col, change.get("old"))
+            new = posting(sheet_id, row_index, col, change.get("new"))
+            if old == new:
+                continue
+            if old is not None:
+                deltas.subtract(old["terms"])
+            if new is not None:
+                deltas.update(new["terms"])
+                ops.append(ReplaceOne({"_id": new["_id"]}, new, upsert=True))
+            else:
+                ops.append(DeleteOne({"_id": old["_id"]}))
+    if ops:
+        await db.search_cells.bulk_write(ops, ordered=False)
+    vocab = _vocab_ops(sheet_id, deltas)
+    if vocab:
+        await db.search_terms.bulk_write(vocab, ordered=False)
+
+
+async def rebuild(db, sheet_id: str) -> int:
+    """Index a sheet from scratch; returns the rows read."""
+    await db.spreadsheets.update_one({"_id": sheet_id}, {"$set": {"search_index": BUILDING}})
+    await db.search_cells.delete_many({"spreadsheet_id": sheet_id})
+    await db.search_terms.delete_many({"spreadsheet_id": sheet_id})
+    batch, total = [], 0
+    async for r in db.rows.find({"spreadsheet_id": sheet_id}, {"row_index": 1, "cells": 1}):
+        batch.append(r)
+        if len(batch) >= REBUILD_BATCH:
+            await add_rows(db, sheet_id, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        await add_rows(db, sheet_id, batch)
+        total += len(batch)
+    await db.spreadsheets.update_one({"_id": sheet_id}, {"$set": {"search_index": READY}})
+    return total
+
+
+def schedule_rebuild(db, sheet_id: str) -> bool:
+    """Run rebuild() in the background unless one is already running here; False if it was."""
+    if sheet_id in _building:
+        return False
+
+    async def run():
+        try:
+            await rebuild(db, sheet_id)
+        except Exception:
+            logger.exception("search index rebuild failed for %s", sheet_id)
+        finally:
+            _building.discard(sheet_id)
+
+    _building.add(sheet_id)
+    asyncio.create_task(run())
+    return True
+
+
+# ---------- queries ----------
+def _fingerprint(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+def encode_cursor(text: str, tier: int, row_index: int, col: int) -> str:
+    raw = json.dumps({"q": _fingerprint(text), "t": tier, "r": row_index, "c": col}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(text: str, cursor: str) -> Tuple[int, int, int]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if data["q"] == _fingerprint(text) and all(isinstance(data[k], int) for k in ("t", "r", "c")):
+            return data["t"], data["r"], data["c"]
+    except Exception:
+        pass
+    raise ValueError("bad cursor")
+
+
+async def _counts(db, sheet_id: str, terms: List[str]) -> Dict[str, int]:
+    ids = [f"{sheet_id}:{t}" for t in terms]
+    counts = {t: 0 for t in terms}
+    async for d in db.search_terms.find({"_id": {"$in": ids}}, {"term": 1, "cells": 1}):
+        counts[d["term"]] = d.get("cells", 0)
+    return counts
+
+
+async def _expand(db, sheet_id: str, prefix: str) -> List[str]:
+    """Vocabulary terms starting with prefix (other than prefix itself), alphabetically."""
+    lo = f"{sheet_id}:{prefix}"
+    cursor = db.search_terms.find({"_id": {"$gt": lo, "$lt": lo + "\uffff"}, "cells": {"$gt": 0}}, {"term": 1})
+    return [d["term"] for d in await cursor.sort("_id", 1).limit(SEARCH_PREFIX_TERMS).to_list(SEARCH_PREFIX_TERMS)]
+
+
+async def tier_filters(db, sheet_id: str, tokens: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """Filter per tier (None: the tier can't match anything)."""
+    text = " ".join(tokens)[:MAX_TEXT_LEN]
+    terms = list(dict.fromkeys(tokens))[:SEARCH_MAX_TERMS]
+    counts = await _counts(db, sheet_id, terms)
+    head, last = terms[:-1], terms[-1]
+    exact = words = prefix = None
+    if all(counts[t] > 0 for t in terms):
+        exact = {"text": text}
+        # Mongo bounds the index scan by the first $all term: start from the rarest
+        words = {"terms": {"$all": sorted(terms, key=counts.get)}, "text": {"$ne": text}}
+    if len(last) >= SEARCH_MIN_PREFIX and all(counts[t] > 0 for t in head):
+        expansions = await _expand(db, sheet_id, last)
+        if expansions:
+            prefix = {"terms": {"$in": expansions, "$ne": last}}
+            if head:
+                prefix["terms"]["$all"] = sorted(head, key=counts.get)
+    return [exact, words, prefix]
+
+
+async def search(db, sheet_id: str, q: str, limit: int = SEARCH_DEFAULT_LIMIT,
+                 cursor: Optional[str] = None) -> Dict[str, Any]:
+    """One page of (row_index, column) hits, best tier first; raises ValueError on a bad query."""
+    if not 1 <= limit <= SEARCH_MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {SEARCH_MAX_LIMIT}")
+    tokens = tokenize(q)
+    if not tokens:
+        raise ValueError("nothing to search for")
+    text = " ".join(tokens)
+    start_tier, after = 0, None
+    if cursor:
+        start_tier, row_index, col = decode_cursor(text, cursor)
+        after = {"$or": [{"row_index": {"$gt": row_index}}, {"row_index": row_index, "col": {"$gt": col}}]}
+    found: List[Tuple[int, Dict[str, Any]]] = []
+    for tier, flt in enumerate(await tier_filters(db, sheet_id, tokens)):
+        if tier < start_tier or flt is None:
+            continue
+        flt = dict(flt, spreadsheet_id=sheet_id)
+        if tier == start_tier and after is not None:
+            flt.update(after)
+        need = limit + 1 - len(found)
+        docs = await db.search_cells.find(flt, {"_id": 0, "row_index": 1, "col": 1}) \
+            .sort([("row_index", 1), ("col", 1)]).limit(need).to_list(need)
+        found.extend((tier, d) for d in docs)
+        if len(found) > limit:
+            break
+    more = len(found) > limit
+    found = found[:limit]
+    next_cursor = None
+    if more:
+        tier, last = found[-1]
+        next_cursor = encode_cursor(text, tier, last["row_index"], last["col"])
+    values = await _values(db, sheet_id, [d for _, d in found])
+    hits = []
+    for tier, d in found:
+        col = COLUMN_LETTERS[d["col"] - 1]
+        hits.append({"row_index": d["row_index"], "column": col, "match": TIERS[tier],
+                     "value": values.get((d["row_index"], col))})
+    return {"hits": hits, "next_cursor": next_cursor}
+
+
+async def _values(db, sheet_id: str, postings: List[Dict[str, Any]]) -> Dict[Tuple[int, str], Any]:
+    """Current cell values of a page of hits, in one read."""
+    if not postings:
+        return {}
+    cols = {COLUMN_LETTERS[d["col"] - 1] for d in postings}
+    projection = {"row_index": 1}
+    projection.update({f"cells.{c}.value": 1 for c in cols})
+    rows = db.rows.find({"spreadsheet_id": sheet_id, "row_index": {"$in": sorted({d["row_index"] for d in postings})}},
+                        projection)
+    return {(r["row_index"], c): cell.get("value") async for r in rows for c, cell in r.get("cells", {}).items()}
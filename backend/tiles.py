@@ -0,0 +1,238 @@
+"""
+Tiled storage mode for very large sheets.
+
+A sheet created with storage="tiled" keeps its rows in the `tiles` collection
+instead of one `rows` document per row. A tile holds `size` consecutive rows
+(tile_rows on the spreadsheet doc, TILE_ROWS when the sheet was created):
+
+    {"_id": "<sheet>:<tile>", "spreadsheet_id", "tile": (row_index - 1) // size,
+     "versions": [v0, v1, ...],            # per row, 0 = the row does not exist
+     "cols": {"A": [c0, c1, ...], ...},     # per column, one entry per row, None = empty
+     "updated_at", "updated_by"}
+
+Column entries are stored compactly: plain numbers and strings as the bare value,
+every other cell (dates, json, meta, ...) as the usual {"type", "value"} dict.
+A 1M-row sheet becomes ~4k documents with one index entry each, and the per-row
+spreadsheet_id / updated_* fields are stored once per tile. The price is paid on
+writes: a cell edit rewrites its whole tile document instead of one small row, so
+the mode suits large, read-mostly sheets (bench/tile_storage.py measures both).
+
+get_rows, patch_row, insert_row, import and export read and write tiles
+transparently. Features built on per-row documents (display order, range writes,
+aggregates, formulas and history) answer 409 for tiled sheets.
+"""
+import os
+from typing import Dict, Any, List, Optional, Tuple, AsyncIterator
+
+from pymongo import UpdateOne, ReturnDocument
+
+TILE_ROWS = int(os.getenv("TILE_ROWS", "256"))
+# storage mode of sheets created without an explicit one: "rows" or "tiled"
+SHEET_STORAGE = os.getenv("SHEET_STORAGE", "rows")
+STORAGE_MODES = ("rows", "tiled")
+
+
+class VersionMismatch(Exception):
+    def __init__(self, current_version: int):
+        super().__init__(current_version)
+        self.current_version = current_version
+
+
+# ---------- layout ----------
+def tile_of(row_index: int, size: int) -> Tuple[int, int]:
+    """(tile number, offset in the tile) of a row; rows are 1-based, so tile 0 holds rows 1..size."""
+    return divmod(row_index - 1, size)
+
+
+def tile_id(sheet_id: str, tile: int) -> str:
+    return f"{sheet_id}:{tile}"
+
+
+def row_id(sheet_id: str, row_index: int) -> str:
+    """Stable id of a tiled row, used as row_id in the changes log."""
+    return f"{sheet_id}:r{row_index}"
+
+
+def sheet_fields(storage: Optional[str]) -> Dict[str, Any]:
+    """Extra spreadsheet doc fields for a new sheet; raises ValueError on an unknown mode."""
+    storage = storage or SHEET_STORAGE
+    if storage not in STORAGE_MODES:
+        raise ValueError(f"unknown storage mode {storage!r}")
+    return {"storage": "tiled", "tile_rows": TILE_ROWS} if storage == "tiled" else {}
+
+
+# sheet id -> tile size (0 = per-row storage); the mode never changes after creation
+_layouts: Dict[str, int] = {}
+
+
+def remember(sheet_id: str, fields: Dict[str, Any]):
+    _layouts[sheet_id] = fields.get("tile_rows", 0) if fields.get("storage") == "tiled" else 0
+
+
+async def layout(db, sheet_id: str) -> Optional[int]:
+    """Tile size of a tiled sheet, None for per-row sheets (and sheets that don't exist)."""
+    size = _layouts.get(sheet_id)
+    if size is None:
+        sheet = await db.spreadsheets.find_one({"_id": sheet_id}, {"storage": 1, "tile_rows": 1})
+        if sheet is None:
+            return None
+        remember(sheet_id, sheet)
+        size = _layouts[sheet_id]
+    return size or None
+
+
+async def ensure_indexes(db):
+    await db.tiles.create_index([("spreadsheet_id", 1), ("tile", 1)])
+
+
+# ---------- cell encoding ----------
+def encode_cell(cell: Optional[Dict[str, Any]]):
+    if cell is None:
+        return None
+    if len(cell) == 2:
+        value = cell.get("value")
+        t = cell.get("type")
+        if t == "number" and type(value) in (int, float):
+            return value
+        if t == "string" and type(value) is str:
+            return value
+    return cell
+
+
+def decode_cell(value) -> Optional[Dict[str, Any]]:
+    if value is None or isinstance(value, dict):
+        return value
+    if isinstance(value, str):
+        return {"type": "string", "value": value}
+    return {"type": "number", "value": value}
+
+
+def empty_tile(sheet_id: str, tile: int, size: int) -> Dict[str, Any]:
+    return {"_id": tile_id(sheet_id, tile), "spreadsheet_id": sheet_id, "tile": tile,
+            "versions": [0] * size, "cols": {}}
+
+
+# ---------- reads ----------
+def _tile_rows(doc: Dict[str, Any], size: int, start: int, end: Optional[int]):
+    first = doc["tile"] * size + 1
+    versions = doc.get("versions") or []
+    cols = doc.get("cols") or {}
+    for off, version in enumerate(versions):
+        row_index = first + off
+        if not version or row_index < start or (end is not None and row_index > end):
+            continue
+        cells = {}
+        for col, values in cols.items():
+            if off < len(values) and values[off] is not None:
+                cells[col] = decode_cell(values[off])
+        yield {"row_index": row_index, "cells": cells, "version": version}
+
+
+def _range_cursor(db, sheet_id: str, size: int, start: int, end: Optional[int], cols: Optional[List[str]]):
+    tiles: Dict[str, Any] = {"$gte": tile_of(max(start, 1), size)[0]}
+    if end is not None:
+        tiles["$lte"] = tile_of(end, size)[0]
+    projection = {"tile": 1, "versions": 1}
+    if cols is None:
+        projection["cols"] = 1
+    else:
+        projection.update({f"cols.{col}": 1 for col in cols})
+    return db.tiles.find({"spreadsheet_id": sheet_id, "tile": tiles}, projection).sort("tile", 1)
+
+
+async def iter_rows(db, sheet_id: str, size: int, start: int = 1, end: Optional[int] = None,
+                    cols: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Existing rows of the range in row_index order, as {"row_index", "cells", "version"}."""
+    async for doc in _range_cursor(db, sheet_id, size, start, end, cols):
+        for row in _tile_rows(doc, size, start, end):
+            yield row
+
+
+async def load_rows(db, sheet_id: str, size: int, start: int, end: int,
+                    cols: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    return [r async for r in iter_rows(db, sheet_id, size, start, end, cols)]
+
+
+# ---------- writes ----------
+def pack_rows(sheet_id: str, size: int, rows: List[Dict[str, Any]], ts: str) -> List[Dict[str, Any]]:
+    """Tile docs for a batch of row docs (as built by xlsx_import); the batch must cover whole tiles."""
+    out: Dict[int, Dict[str, Any]] = {}
+    for r in rows:
+        tile, off = tile_of(r["row_index"], size)
+        doc = out.get(tile)
+        if doc is None:
+            doc = out[tile] = dict(empty_tile(sheet_id, tile, size), updated_at=ts, updated_by=r.get("updated_by"))
+        doc["versions"][off] = r.get("version", 1)
+        for col, cell in r["cells"].items():
+            values = doc["cols"].get(col)
+            if values is None:
+                values = doc["cols"][col] = [None] * size
+            values[off] = encode_cell(cell)
+    return list(out.values())
+
+
+def aligned_batch_size(batch_size: int, size: int) -> int:
+    """Import batch size rounded to whole tiles, so no tile is split across two insert_many calls."""
+    return max(size, batch_size // size * size)
+
+
+def _ensure_columns_ops(_id: str, columns, size: int) -> List[UpdateOne]:
+    # $set on cols.X.<n> would create an object, not an array, when cols.X is missing
+    return [UpdateOne({"_id": _id, f"cols.{col}": {"$exists": False}}, {"$set": {f"cols.{col}": [None] * size}})
+            for col in columns]
+
+
+async def insert_row(db, sheet_id: str, size: int, row_index: int, cells: Dict[str, Any],
+                     user_id: Optional[str], ts: str) -> bool:
+    """Create a row; False if it already exists."""
+    tile, off = tile_of(row_index, size)
+    _id = tile_id(sheet_id, tile)
+    skeleton = empty_tile(sheet_id, tile, size)
+    del skeleton["_id"]
+    ops = [UpdateOne({"_id": _id}, {"$setOnInsert": skeleton}, upsert=True)]
+    ops += _ensure_columns_ops(_id, cells, size)
+    await db.tiles.bulk_write(ops, ordered=True)
+    to_set = {f"cols.{col}.{off}": encode_cell(cell) for col, cell in cells.items()}
+    to_set.update({f"versions.{off}": 1, "updated_at": ts, "updated_by": user_id})
+    res = await db.tiles.update_one({"_id": _id, f"versions.{off}": 0}, {"$set": to_set})
+    return res.modified_count > 0
+
+
+async def patch_cells(db, sheet_id: str, size: int, row_index: int, new_cells: Dict[str, Any],
+                      expected_version: Optional[int], user_id: Optional[str], ts: str):
+    """
+    Set/clear cells of one existing row with a single find_one_and_update on its tile.
+    Returns (old cells of the row, previous version), None if the row doesn't
+    exist; raises VersionMismatch when expected_version is stale. The whole row
+    comes back because v1 row_updated events carry it (see wire.py).
+    """
+    tile, off = tile_of(row_index, size)
+    _id = tile_id(sheet_id, tile)
+    flt: Dict[str, Any] = {"_id": _id, f"versions.{off}": expected_version if expected_version is not None else {"$gt": 0}}
+    flt.update({f"cols.{col}": {"$exists": True} for col in new_cells})
+    to_set = {f"cols.{col}.{off}": encode_cell(cell) for col, cell in new_cells.items()}
+    to_set.update({"updated_at": ts, "updated_by": user_id})
+    update = {"$set": to_set, "$inc": {f"versions.{off}": 1}}
+    projection = {"versions": {"$slice": [off, 1]}, "cols": 1}
+
+    before = await db.tiles.find_one_and_update(flt, update, projection=projection,
+                                                return_document=ReturnDocument.BEFORE)
+    if before is None:
+        # first write of a column into this tile: create its array and retry once
+        ops = _ensure_columns_ops(_id, new_cells, size)
+        if ops:
+            await db.tiles.bulk_write(ops, ordered=False)
+            before = await db.tiles.find_one_and_update(flt, update, projection=projection,
+                                                        return_document=ReturnDocument.BEFORE)
+    if before is None:
+        doc = await db.tiles.find_one({"_id": _id}, {"versions": {"$slice": [off, 1]}})
+        current = (doc or {}).get("versions") or [0]
+        if not current[0]:
+            return None
+        raise VersionMismatch(current[0])
+    cols = before.get("cols") or {}
+    old_cells = {}
+    for col, values in cols.items():
+        if off < len(values) and values[off] is not None:
+            old_cells[col] = decode_cell(values[off])
+    return old_cells, before["versions"][0]
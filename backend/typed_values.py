@@ -0,0 +1,211 @@
+"""
+Typed cell value inference.
+
+parse_typed_value() keeps the original semantics (number / date / datetime /
+json / string, with dateutil as the date parser of record) but avoids calling
+dateutil for most inputs:
+
+1. strings containing a word dateutil cannot consume are plain text (dateutil
+   would raise on them anyway);
+2. ISO and dd.mm.yyyy / mm/dd/yyyy style dates are matched with precompiled
+   regexes and resolved the same way dateutil resolves them;
+3. everything else goes to dateutil, with results kept in an LRU cache.
+
+For imports, parse_rows() infers each column's kind once per batch and converts
+homogeneous native columns (numbers, datetimes) without per-cell dispatch.
+"""
+import os
+import re
+import string
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Dict, Any, Optional, List, Sequence, Tuple
+
+from dateutil import parser as dateparser
+
+TYPE_CACHE_SIZE = int(os.getenv("TYPE_CACHE_SIZE", "65536"))
+# longer strings are classified without caching so the cache stays small
+CACHEABLE_LEN = 64
+
+
+def _date_words() -> frozenset:
+    info = dateparser.parserinfo
+    words = set(info.JUMP) | set(info.UTCZONE) | set(info.PERTAIN) | set(info.TZOFFSET)
+    for group in (info.WEEKDAYS, info.MONTHS, info.HMS, info.AMPM):
+        for names in group:
+            words.update(names)
+    # float() accepts these, so dateutil treats them as numeric tokens
+    words.update(("nan", "inf", "infinity"))
+    return frozenset(w.lower() for w in words)
+
+
+_DATE_WORDS = _date_words()
+# "<month> of <anything>": dateutil swallows the token after "of" (see parser._parse)
+_PERTAIN_WORDS = frozenset(w.lower() for w in dateparser.parserinfo.PERTAIN)
+_ALPHA_RUN = re.compile(r"[^\W\d_]+")
+_TZ_LETTERS = frozenset(string.ascii_uppercase)
+
+_ISO_DATE = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})", re.ASCII)
+_ISO_DATETIME = re.compile(
+    r"(\d{4})-(\d{1,2})-(\d{1,2})[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?", re.ASCII)
+# 05.01.2023, 5/1/2023, 13-01-2023 (four digit year last)
+_DMY_OR_MDY = re.compile(r"(\d{1,2})([./-])(\d{1,2})\2(\d{4})", re.ASCII)
+
+
+def _has_foreign_word(s: str) -> bool:
+    """True if s contains a letter run dateutil can't interpret, i.e. parsing would fail."""
+    foreign = False
+    for m in _ALPHA_RUN.finditer(s):
+        word = m.group()
+        if not word.isalpha():
+            # letter-like characters that str.isalpha() rejects; let dateutil decide
+            return False
+        lowered = word.lower()
+        if lowered in _PERTAIN_WORDS:
+            return False
+        if lowered in _DATE_WORDS:
+            continue
+        if len(word) <= 5 and all(ch in _TZ_LETTERS for ch in word):
+            continue  # could be a timezone name after a time, e.g. "10:00 MSK"
+        foreign = True
+    return foreign
+
+
+def _fast_date(s: str) -> Optional[Tuple[str, str]]:
+    """Resolve common date formats without dateutil; None means 'ask dateutil'."""
+    m = _ISO_DATE.fullmatch(s)
+    if m:
+        try:
+            return "date", date(int(m.group(1)), int(m.group(2)), int(m.group(3))).isoformat()
+        except ValueError:
+            return None
+    m = _ISO_DATETIME.fullmatch(s)
+    if m:
+        y, mo, d, hh, mm, ss, frac = m.groups()
+        try:
+            dt = datetime(int(y), int(mo), int(d), int(hh), int(mm), int(ss or 0),
+                          int(frac.ljust(6, "0")) if frac else 0)
+        except ValueError:
+            return None
+        # always has ':' so it's a datetime, never a date
+        return "datetime", dt.isoformat()
+    m = _DMY_OR_MDY.fullmatch(s)
+    if m:
+        a, b, y = int(m.group(1)), int(m.group(3)), int(m.group(4))
+        if a > 31:
+            return None
+        # dateutil (dayfirst=False): month first unless the first number can't be a month
+        day, month = (a, b) if a > 12 else (b, a)
+        try:
+            return "date", date(y, month, day).isoformat()
+        except ValueError:
+            return None
+    return None
+
+
+def _classify_string(s: str) -> Tuple[str, Any]:
+    # number
+    try:
+        if '.' in s:
+            return "number", float(s)
+        else:
+            return "number", int(s)
+    except Exception:
+        pass
+    if _has_foreign_word(s):
+        return "string", s
+    fast = _fast_date(s)
+    if fast is not None:
+        return fast
+    # datetime
+    try:
+        dt = dateparser.parse(s)
+        # decide date vs datetime naive heuristic
+        if dt.hour == 0 and dt.minute == 0 and dt.second == 0 and ':' not in s:
+            return "date", dt.date().isoformat()
+        else:
+            return "datetime", dt.isoformat()
+    except Exception:
+        pass
+    return "string", s
+
+
+@lru_cache(maxsize=TYPE_CACHE_SIZE)
+def _classify_string_cached(s: str, today: int) -> Tuple[str, Any]:
+    # today is part of the key: dateutil fills missing fields from the current date
+    return _classify_string(s)
+
+
+def classify_string(s: str) -> Tuple[str, Any]:
+    if len(s) > CACHEABLE_LEN:
+        return _classify_string(s)
+    return _classify_string_cached(s, date.today().toordinal())
+
+
+def parse_typed_value(value):
+    """Try to detect number/date/datetime; otherwise return string type."""
+    if value is None:
+        return {"type": "string", "value": None}
+    if isinstance(value, (int, float, bool)):
+        return {"type": "number", "value": value}
+    if isinstance(value, dict):
+        return {"type": "json", "value": value}
+    if isinstance(value, datetime) and value.tzinfo is None:
+        # str(value) always contains ':' and round-trips through dateutil unchanged
+        return {"type": "datetime", "value": value.isoformat()}
+    if type(value) is date:
+        return {"type": "date", "value": value.isoformat()}
+    t, v = classify_string(str(value).strip())
+    return {"type": t, "value": v}
+
+
+def cache_info():
+    return _classify_string_cached.cache_info()
+
+
+# ---------- batch (column-wise) API ----------
+def column_kind(values: Sequence[Any]) -> str:
+    """'empty', 'number', 'datetime' or 'mixed' for a column of raw values (None ignored)."""
+    kind = "empty"
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, (int, float)):  # bool is an int
+            k = "number"
+        elif isinstance(v, datetime) and v.tzinfo is None:
+            k = "datetime"
+        else:
+            return "mixed"
+        if kind == "empty":
+            kind = k
+        elif kind != k:
+            return "mixed"
+    return kind
+
+
+def parse_column(values: Sequence[Any]) -> List[Optional[Dict[str, Any]]]:
+    """Typed cells for a whole column; None stays None (empty cell)."""
+    kind = column_kind(values)
+    if kind == "empty":
+        return [None] * len(values)
+    if kind == "number":
+        return [None if v is None else {"type": "number", "value": v} for v in values]
+    if kind == "datetime":
+        return [None if v is None else {"type": "datetime", "value": v.isoformat()} for v in values]
+    return [None if v is None else parse_typed_value(v) for v in values]
+
+
+def parse_rows(rows: Sequence[Sequence[Any]], letters: Sequence[str]) -> List[Dict[str, Dict[str, Any]]]:
+    """
+    Convert a block of raw rows (e.g. openpyxl values_only tuples) into cells dicts.
+    Types are inferred per column across the block; letters[i] names column i.
+    """
+    out: List[Dict[str, Dict[str, Any]]] = [{} for _ in rows]
+    width = max((len(r) for r in rows), default=0)
+    for j in range(width):
+        column = [r[j] if j < len(r) else None for r in rows]
+        letter = letters[j]
+        for cells, typed in zip(out, parse_column(column)):
+            if typed is not None:
+                cells[letter] = typed
+    return out
@@ -0,0 +1,158 @@
+"""
+WebSocket wire formats, negotiated per socket with /ws/{sheet_id}?proto=&encoding=.
+
+proto=1 (default): one JSON text frame per event, exactly as broadcast() encodes it.
+row_updated carries the whole row, as it always has (see row_updated below).
+
+proto=2:
+- cells are compact: number and string cells as the bare value, every other cell
+  as the usual {"type", "value"} dict, null = cleared (the tiles.py encoding);
+- row_updated carries the changed cells only (null = cleared), which clients
+  merge into their copy of the row;
+- every frame is an array of events. Whatever is queued for a socket when its
+  writer wakes up goes out as one frame, up to WS_BATCH_MAX events, so bursts
+  cost one frame instead of one per event and an idle socket adds no delay;
+- encoding=msgpack sends binary MessagePack frames (and accepts them from the
+  client). It needs the optional msgpack package; without it the socket falls
+  back to JSON, which the "hello" message reports.
+
+Events are still published once, as v1 JSON, on the bus and in the replay buffer;
+ConnectionManager.deliver_local renders each one at most once per wire in use.
+"""
+import os
+import json
+from typing import Dict, Any, List, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from tiles import encode_cell
+
+try:
+    import msgpack
+except ImportError:  # optional, see the module docstring
+    msgpack = None
+
+WS_BATCH_MAX = int(os.getenv("WS_BATCH_MAX", "64"))
+ENCODINGS = ("json", "msgpack")
+
+Frame = Union[str, bytes]
+
+
+def row_updated(row_index: int, cells: Dict[str, Any], changed, version: int) -> Dict[str, Any]:
+    """
+    A row_updated event as published: the full row after the edit for v1 sockets,
+    plus the edited columns, which compact() turns into the v2 diff.
+    """
+    return {"type": "row_updated", "row": {"row_index": row_index, "cells": cells, "version": version},
+            "changed": list(changed)}
+
+
+def _compact_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    if not isinstance(row, dict) or not isinstance(row.get("cells"), dict):
+        return row
+    out = dict(row)
+    out["cells"] = {col: encode_cell(cell) for col, cell in row["cells"].items()}
+    return out
+
+
+def compact(message: Dict[str, Any]) -> Dict[str, Any]:
+    """v2 form of a v1 message."""
+    out = dict(message)
+    if out.get("type") == "row_updated" and "changed" in out:
+        changed = out.pop("changed")
+        cells = out["row"].get("cells") or {}
+        out["row"] = dict(out["row"], cells={col: cells.get(col) for col in changed})
+    if "row" in out:
+        out["row"] = _compact_row(out["row"])
+    if isinstance(out.get("rows"), list):
+        out["rows"] = [_compact_row(r) for r in out["rows"]]
+    if isinstance(out.get("events"), list):
+        out["events"] = [compact(e) for e in out["events"]]
+    return out
+
+
+class Wire:
+    """Protocol version + encoding of one socket; shared by every socket that negotiated the same."""
+
+    def __init__(self, version: int = 1, encoding: str = "json"):
+        self.version = version
+        self.encoding = encoding
+        self.key = (version, encoding)
+        self.binary = encoding == "msgpack"
+        if self.binary:
+            self._packer = msgpack.Packer(use_bin_type=True)
+
+    def encode(self, message: Dict[str, Any]) -> Frame:
+        """One event, ready to be queued for a socket with this wire."""
+        if self.version == 1:
+            return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+        message = compact(message)
+        if self.binary:
+            return self._packer.pack(message)
+        return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+    def render(self, frame: str, cache: Dict[Any, Any]) -> Frame:
+        """
+        A published (v1 JSON) frame in this wire's form. `cache` lives for one
+        delivery, so each frame is decoded and re-encoded at most once per wire.
+        """
+        if self.version == 1:
+            return frame
+        out = cache.get(self.key)
+        if out is None:
+            message = cache.get("message")
+            if message is None:
+                message = cache["message"] = json.loads(frame)
+            out = cache[self.key] = self.encode(message)
+        return out
+
+    def join(self, items: List[Frame]) -> Frame:
+        """v2: several queued events as one array frame, without re-encoding them."""
+        if self.binary:
+            return self._packer.pack_array_header(len(items)) + b"".join(items)
+        return "[" + ",".join(items) + "]"
+
+    async def send(self, websocket: WebSocket, items: List[Frame]) -> int:
+        """Write queued events; returns the bytes sent."""
+        if self.version == 1:
+            for frame in items:
+                await websocket.send_text(frame)
+            return sum(len(f.encode()) for f in items)
+        frame = self.join(items)
+        if self.binary:
+            await websocket.send_bytes(frame)
+            return len(frame)
+        await websocket.send_text(frame)
+        return len(frame.encode())
+
+    def frames(self, items: List[Frame]) -> int:
+        """Number of WebSocket frames send() writes for items."""
+        return len(items) if self.version == 1 else 1
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        """Next client message, from a JSON text frame or (msgpack wires) a binary frame."""
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes") is not None:
+            if not self.binary:
+                raise ValueError("binary frame on a json socket")
+            return msgpack.unpackb(message["bytes"], raw=False)
+        return json.loads(message["text"])
+
+
+_wires: Dict[Any, Wire] = {}
+
+
+def negotiate(proto: int = 1, encoding: str = "json") -> Wire:
+    """Best wire this server supports for what the client asked for."""
+    version = 2 if proto >= 2 else 1
+    if version == 1 or encoding not in ENCODINGS or (encoding == "msgpack" and msgpack is None):
+        encoding = "json"
+    wire = _wires.get((version, encoding))
+    if wire is None:
+        wire = _wires[(version, encoding)] = Wire(version, encoding)
+    return wire
+
+
+V1 = negotiate()
@@ -0,0 +1,43 @@
+"""
+Multi-worksheet workbooks.
+
+Importing a workbook (rather than a single sheet) creates one `workbooks` doc and
+one spreadsheet per worksheet, in tab order:
+
+    workbooks:    {"_id", "title", "tabs": <count>, "created_at", "updated_at"}
+    spreadsheets: {..., "title": <worksheet title>, "workbook_id", "tab": 0, 1, ...}
+
+Every tab is an ordinary spreadsheet (rows, WebSocket, history, ... all work
+per tab); exporting the workbook writes the tabs back as the worksheets of one
+.xlsx. Parsing, inserts and export cursors of the tabs run concurrently (see
+jobs.py and main.py).
+"""
+import uuid
+from typing import Dict, Any, List, Optional, Tuple
+
+
+async def ensure_indexes(db):
+    await db.spreadsheets.create_index([("workbook_id", 1), ("tab", 1)], sparse=True)
+
+
+async def create(db, title: Optional[str], worksheets: List[str], fields: Dict[str, Any],
+                 ts: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Insert a workbook and one spreadsheet doc per worksheet title; returns (workbook, sheets)."""
+    workbook = {"_id": str(uuid.uuid4()), "title": title, "tabs": len(worksheets), "created_at": ts, "updated_at": ts}
+    sheets = []
+    for tab, name in enumerate(worksheets):
+        doc = {"_id": str(uuid.uuid4()), "title": name, "workbook_id": workbook["_id"], "tab": tab,
+               "created_at": ts, "updated_at": ts}
+        doc.update(fields)
+        sheets.append(doc)
+    await db.workbooks.insert_one(workbook)
+    if sheets:
+        await db.spreadsheets.insert_many(sheets)
+    return workbook, sheets
+
+
+async def tabs(db, workbook_id: str) -> List[Dict[str, Any]]:
+    """Spreadsheet docs of a workbook in tab order."""
+    cursor = db.spreadsheets.find({"workbook_id": workbook_id},
+                                  {"title": 1, "tab": 1, "storage": 1, "tile_rows": 1, "reordered": 1}).sort("tab", 1)
+    return [s async for s in cursor]
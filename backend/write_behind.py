@@ -0,0 +1,354 @@
+"""
+Write-behind buffer for WebSocket cell edits on hot sheets.
+
+For a sheet with write-behind enabled (the spreadsheet doc's `write_behind`
+field, set through PUT /api/spreadsheets/{id}/write_behind), an "update"
+message no longer runs patch_row. Instead it
+
+- applies the edit to the row's in-memory state (read from Mongo once, when
+  the row is first buffered), checks expected_version against it, and acks
+  and broadcasts the new version right away;
+- merges it with earlier buffered edits of the row: per cell the first "old"
+  and the latest "new" are kept, and a cell edited back to its old value drops
+  out (the row's version is still written, clients were acked with it);
+- leaves the row in the buffer until it has been quiet for `window_ms`, or at
+  most `max_delay_ms` after its first buffered edit (the loss window if the
+  process dies), then writes it with the other due rows of the sheet: one
+  bulk_write to `rows` and one insert_many of merged `changes` records.
+
+The per-sheet event seq is still taken per edit, so subscribers and resume see
+every edit. A merged changes record carries the seq of the row's last edit;
+resuming across the earlier ones from the log ends in a "reload" (the replay
+buffer has them all).
+
+Every other write to a sheet (REST patch_row, range writes, deletes) flushes
+the sheet's buffer first, and shutdown flushes everything. A flush that finds
+the row changed underneath it (another instance wrote it) applies the merged
+cells on top and reports a conflict, so the caller can re-broadcast the row.
+Which rows a flush wrote is told by the `flush_id` it sets on them, not by
+their version.
+"""
+import os
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+from pymongo import UpdateOne, ReturnDocument
+
+WRITE_BEHIND_WINDOW_MS = int(os.getenv("WRITE_BEHIND_WINDOW_MS", "250"))
+WRITE_BEHIND_MAX_DELAY_MS = int(os.getenv("WRITE_BEHIND_MAX_DELAY_MS", "1000"))
+# upper bound for any sheet's max_delay_ms, i.e. for the loss window
+WRITE_BEHIND_MAX_DELAY_CAP_MS = int(os.getenv("WRITE_BEHIND_MAX_DELAY_CAP_MS", "10000"))
+WRITE_BEHIND_MAX_ROWS = int(os.getenv("WRITE_BEHIND_MAX_ROWS", "1000"))  # buffered rows per sheet
+WRITE_BEHIND_TICK_MS = int(os.getenv("WRITE_BEHIND_TICK_MS", "50"))
+CONFIG_TTL = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class VersionMismatch(Exception):
+    def __init__(self, current_version: int):
+        super().__init__(current_version)
+        self.current_version = current_version
+
+
+def normalize_config(window_ms: Optional[int], max_delay_ms: Optional[int]) -> Dict[str, int]:
+    """Validated per-sheet settings; raises ValueError."""
+    window_ms = WRITE_BEHIND_WINDOW_MS if window_ms is None else window_ms
+    max_delay_ms = WRITE_BEHIND_MAX_DELAY_MS if max_delay_ms is None else max_delay_ms
+    if not 0 <= window_ms <= max_delay_ms:
+        raise ValueError("window_ms must be between 0 and max_delay_ms")
+    if not 0 < max_delay_ms <= WRITE_BEHIND_MAX_DELAY_CAP_MS:
+        raise ValueError(f"max_delay_ms must be between 1 and {WRITE_BEHIND_MAX_DELAY_CAP_MS}")
+    return {"window_ms": window_ms, "max_delay_ms": max_delay_ms}
+
+
+class PendingRow:
+    __slots__ = ("row_id", "base_version", "version", "cells", "changes", "user_id", "edits", "seq",
+                 "first_at", "last_at")
+
+    def __init__(self, doc: Dict[str, Any]):
+        self.row_id = doc["_id"]
+        self.base_version = doc.get("version", 1)
+        self.version = self.base_version
+        self.cells: Dict[str, Any] = dict(doc.get("cells", {}))
+        self.changes: Dict[str, Dict[str, Any]] = {}
+        self.user_id = None
+        self.edits = 0
+        self.seq = None
+        self.first_at = self.last_at = time.monotonic()
+
+    def due(self, now: float, config: Dict[str, int]) -> bool:
+        return (now - self.last_at) * 1000 >= config["window_ms"] or \
+            (now - self.first_at) * 1000 >= config["max_delay_ms"]
+
+    def merged(self) -> Dict[str, Dict[str, Any]]:
+        """Net cell changes; cells edited back to their old value are left out."""
+        return {col: c for col, c in self.changes.items() if c["old"] != c["new"]}
+
+
+class SheetBuffer:
+    def __init__(self, config: Dict[str, int]):
+        self.config = config
+        self.rows: Dict[int, PendingRow] = {}
+        self.lock = asyncio.Lock()
+
+
+class WriteBehind:
+    """Per-sheet buffers of WebSocket edits, flushed by a background loop."""
+
+    def __init__(self, sequencer: Callable[[str], Awaitable[int]],
+                 on_flush: Optional[Callable[[str, List[Dict[str, Any]]], Awaitable[None]]] = None,
+                 tick_ms: int = WRITE_BEHIND_TICK_MS, max_rows: int = WRITE_BEHIND_MAX_ROWS):
+        self.db = None
+        # sequencer(sheet_id) -> next event seq; on_flush(sheet_id, rows) runs after every flush
+        self.sequencer = sequencer
+        self.on_flush = on_flush
+        self.tick = tick_ms / 1000
+        self.max_rows = max_rows
+        self.buffers: Dict[str, SheetBuffer] = {}
+        self._configs: Dict[str, tuple] = {}
+        self._task: Optional[asyncio.Task] = None
+        # counters
+        self.edits = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.conflicts = 0
+        self.lost = 0
+        self.failures = 0
+
+    async def start(self, db):
+        self.db = db
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the loop and flush every buffered edit."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for sheet_id in list(self.buffers):
+            try:
+                await self.flush_sheet(sheet_id)
+            except Exception:
+                logger.exception("write-behind flush on shutdown failed for %s", sheet_id)
+
+    # ---------- config ----------
+    async def config(self, sheet_id: str) -> Optional[Dict[str, int]]:
+        """The sheet's settings, None when write-behind is off; cached for CONFIG_TTL seconds."""
+        cached = self._configs.get(sheet_id)
+        if cached is not None and time.monotonic() - cached[1] < CONFIG_TTL:
+            return cached[0]
+        doc = await self.db.spreadsheets.find_one({"_id": sheet_id}, {"write_behind": 1})
+        config = (doc or {}).get("write_behind") or None
+        self._configs[sheet_id] = (config, time.monotonic())
+        return config
+
+    async def configure(self, sheet_id: str, config: Optional[Dict[str, int]]) -> bool:
+        """Store (None: turn off) a sheet's settings; False if the sheet doesn't exist."""
+        if config is None:
+            result = await self.db.spreadsheets.update_one({"_id": sheet_id}, {"$unset": {"write_behind": ""}})
+        else:
+            result = await self.db.spreadsheets.update_one({"_id": sheet_id}, {"$set": {"write_behind": config}})
+        self._configs[sheet_id] = (config, time.monotonic())
+        buf = self.buffers.get(sheet_id)
+        if config is None:
+            await self.flush_sheet(sheet_id)
+        elif buf is not None:
+            buf.config = config
+        return result.matched_count > 0
+
+    # ---------- edits ----------
+    async def apply(self, sheet_id: str, row_index: int, new_cells: Dict[str, Any], user_id: Optional[str],
+                    expected_version: Optional[int], config: Dict[str, int]) -> Dict[str, Any]:
+        """
+        Buffer one edit (new_cells: col -> normalized cell, None clears it); returns
+        {"version", "seq"}. Raises LookupError for a missing row, VersionMismatch.
+        """
+        while True:
+            buf = self.buffers.get(sheet_id)
+            if buf is None:
+                buf = self.buffers[sheet_id] = SheetBuffer(config)
+            async with buf.lock:
+                # a flush may have retired the buffer while we waited for its lock
+                if self.buffers.get(sheet_id) is not buf:
+                    continue
+                buf.config = config
+                result = await self._apply(sheet_id, buf, row_index, new_cells, user_id, expected_version)
+                full = len(buf.rows) > self.max_rows
+            break
+        if full:
+            await self.flush_sheet(sheet_id)
+        return result
+
+    async def _apply(self, sheet_id: str, buf: SheetBuffer, row_index: int, new_cells: Dict[str, Any],
+                     user_id: Optional[str], expected_version: Optional[int]) -> Dict[str, Any]:
+        row = buf.rows.get(row_index)
+        if row is None:
+            doc = await self.db.rows.find_one({"spreadsheet_id": sheet_id, "row_index": row_index},
+                                              {"version": 1, "cells": 1})
+            if doc is None:
+                raise LookupError(row_index)
+            row = PendingRow(doc)
+        if expected_version is not None and expected_version != row.version:
+            raise VersionMismatch(row.version)
+        seq = await self.sequencer(sheet_id)
+        for col, new in new_cells.items():
+            change = row.changes.get(col)
+            if change is None:
+                row.changes[col] = {"old": row.cells.get(col), "new": new}
+            else:
+                change["new"] = new
+            if new is None:
+                row.cells.pop(col, None)
+            else:
+                row.cells[col] = new
+        row.version += 1
+        row.edits += 1
+        row.user_id = user_id
+        row.seq = seq
+        row.last_at = time.monotonic()
+        buf.rows[row_index] = row
+        self.edits += 1
+        return {"version": row.version, "seq": seq, "cells": dict(row.cells)}
+
+    def pending_rows(self) -> int:
+        return sum(len(b.rows) for b in self.buffers.values())
+
+    # ---------- flushing ----------
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            for sheet_id, buf in list(self.buffers.items()):
+                if any(r.due(now, buf.config) for r in buf.rows.values()):
+                    try:
+                        await self.flush_sheet(sheet_id, due_only=True)
+                    except Exception:
+                        # the rows stay buffered and are retried on the next tick
+                        self.failures += 1
+                        logger.exception("write-behind flush failed for %s", sheet_id)
+
+    async def flush_sheet(self, sheet_id: str, due_only: bool = False) -> int:
+        """Write the sheet's buffered rows (only the due ones with due_only); returns rows written."""
+        buf = self.buffers.get(sheet_id)
+        if buf is None:
+            return 0
+        async with buf.lock:
+            now = time.monotonic()
+            rows = {i: r for i, r in buf.rows.items() if not due_only or r.due(now, buf.config)}
+            if not rows:
+                return 0
+            flushed = await self._write(sheet_id, rows)
+            for row_index in rows:
+                del buf.rows[row_index]
+            if not buf.rows:
+                self.buffers.pop(sheet_id, None)
+        self.flushes += 1
+        self.rows_flushed += len(flushed)
+        if flushed and self.on_flush is not None:
+            await self.on_flush(sheet_id, flushed)
+        return len(flushed)
+
+    async def _write(self, sheet_id: str, rows: Dict[int, PendingRow]) -> List[Dict[str, Any]]:
+        ts = datetime.utcnow().isoformat()
+        # marks the rows this flush actually updated; the version alone can't tell
+        # (another writer may have moved the row by the same number of versions)
+        token = str(uuid.uuid4())
+        ops, written = [], []
+        for row_index, row in rows.items():
+            # edits that cancel out still write the version: clients were acked with it
+            changes = row.merged()
+            update = self._update(changes, row.user_id, ts)
+            update["$set"].update({"version": row.version, "flush_id": token})
+            ops.append(UpdateOne({"_id": row.row_id, "version": row.base_version}, update))
+            written.append((row_index, row, changes))
+        if not ops:
+            return []
+        result = await self.db.rows.bulk_write(ops, ordered=False)
+        conflicts: Dict[int, Optional[Dict[str, Any]]] = {}
+        if result.matched_count < len(ops):
+            conflicts = await self._resolve_conflicts(written, token, ts)
+        flushed, records = [], []
+        for row_index, row, changes in written:
+            current = conflicts.get(row_index, {"version": row.version, "cells": row.cells})
+            if current is None:
+                continue
+            version = current["version"]
+            flushed.append({"row_index": row_index, "row_id": row.row_id, "changes": changes,
+                            "cells": current.get("cells", {}), "prev_version": row.base_version,
+                            "version": version, "conflict": row_index in conflicts})
+            records.append({
+                "_id": str(uuid.uuid4()),
+                "spreadsheet_id": sheet_id,
+                "row_id": row.row_id,
+                "row_index": row_index,
+                "user_id": row.user_id,
+                "op_type": "update_cells",
+                "payload": {"changes": changes, "prev_version": row.base_version, "new_version": version,
+                            "edits": row.edits},
+                "version": version,
+                "seq": row.seq,
+                "created_at": ts,
+            })
+        if records:
+            await self.db.changes.insert_many(records)
+        return flushed
+
+    @staticmethod
+    def _update(changes: Dict[str, Dict[str, Any]], user_id: Optional[str], ts: str) -> Dict[str, Any]:
+        to_set: Dict[str, Any] = {"updated_by": user_id, "updated_at": ts}
+        to_unset = {}
+        for col, change in changes.items():
+            if change["new"] is None:
+                to_unset[f"cells.{col}"] = ""
+            else:
+                to_set[f"cells.{col}"] = change["new"]
+        update: Dict[str, Any] = {"$set": to_set}
+        if to_unset:
+            update["$unset"] = to_unset
+        return update
+
+    async def _resolve_conflicts(self, written, token: str, ts: str) -> Dict[int, Optional[Dict[str, Any]]]:
+        """
+        Rows another writer changed since they were buffered: apply on top.
+        Returns row_index -> {"version", "cells"} as written (None: the row is gone).
+        """
+        ids = [row.row_id for _, row, _ in written]
+        current = {d["_id"]: d.get("flush_id")
+                   async for d in self.db.rows.find({"_id": {"$in": ids}}, {"flush_id": 1})}
+        out: Dict[int, Optional[Dict[str, Any]]] = {}
+        for row_index, row, changes in written:
+            if row.row_id in current and current[row.row_id] == token:
+                continue
+            if row.row_id not in current:
+                self.lost += 1
+                logger.warning("write-behind: row %s was deleted before its buffered edits were written", row_index)
+                out[row_index] = None
+                continue
+            update = self._update(changes, row.user_id, ts)
+            update["$inc"] = {"version": 1}
+            doc = await self.db.rows.find_one_and_update({"_id": row.row_id}, update,
+                                                         projection={"version": 1, "cells": 1},
+                                                         return_document=ReturnDocument.AFTER)
+            self.conflicts += 1
+            out[row_index] = doc
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sheets": len(self.buffers),
+            "pending_rows": self.pending_rows(),
+            "edits": self.edits,
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "conflicts": self.conflicts,
+            "lost": self.lost,
+            "failures": self.failures,
+        }
@@ -0,0 +1,282 @@
+"""
+Streaming XLSX export.
+
+Instead of building an openpyxl Workbook in memory, the worksheet XML is written
+row by row straight from the sorted Mongo cursor into a zip archive whose output
+is drained to the HTTP response as it is produced (write-only, forward-only).
+Cell references come from the precomputed tables in columns.py.
+"""
+import re
+import json
+import math
+import zipfile
+from typing import Dict, Any, List, Optional, AsyncIterator
+from xml.sax.saxutils import escape, quoteattr
+
+from columns import COLUMN_LETTERS, COLUMN_INDEX
+from metrics import EXPORT_ROWS
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# flush compressed output to the client once this many bytes are buffered
+FLUSH_BYTES = 64 * 1024
+
+# characters that are not allowed in XML 1.0 (openpyxl raises on them too)
+_ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_XML_DECL = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+_NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+SHEET_HEADER = (_XML_DECL + f'<worksheet xmlns="{_NS_MAIN}"><sheetData>').encode("utf-8")
+SHEET_FOOTER = b"</sheetData></worksheet>"
+
+
+class _ChunkSink:
+    """Write-only, non-seekable file object; zipfile falls back to data descriptors for it."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        out = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return out
+
+
+# ---------- static package parts ----------
+def _content_types(sheet_count: int) -> str:
+    sheets = "".join(
+        f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for i in range(1, sheet_count + 1)
+    )
+    return (
+        _XML_DECL
+        + '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        + sheets + "</Types>"
+    )
+
+
+def _root_rels() -> str:
+    return (
+        _XML_DECL + f'<Relationships xmlns="{_NS_PKG_REL}">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>'
+    )
+
+
+def _workbook(titles: List[str]) -> str:
+    sheets = "".join(
+        f'<sheet name={quoteattr(title)} sheetId="{i}" r:id="rId{i}"/>'
+        for i, title in enumerate(titles, start=1)
+    )
+    return (
+        _XML_DECL + f'<workbook xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}">'
+        f"<sheets>{sheets}</sheets></workbook>"
+    )
+
+
+def _workbook_rels(sheet_count: int) -> str:
+    rels = "".join(
+        f'<Relationship Id="rId{i}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        f'Target="worksheets/sheet{i}.xml"/>'
+        for i in range(1, sheet_count + 1)
+    )
+    styles_id = sheet_count + 1
+    rels += (
+        f'<Relationship Id="rId{styles_id}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+        'Target="styles.xml"/>'
+    )
+    return _XML_DECL + f'<Relationships xmlns="{_NS_PKG_REL}">{rels}</Relationships>'
+
+
+_STYLES = (
+    _XML_DECL + f'<styleSheet xmlns="{_NS_MAIN}">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+
+def sheet_title(title: str) -> str:
+    """Excel sheet names: max 31 chars, no []:*?/\\ characters."""
+    cleaned = re.sub(r"[\[\]:*?/\\]", "_", title or "").strip("'")
+    return cleaned[:31] or "Sheet1"
+
+
+def write_package_parts(zf: zipfile.ZipFile, titles: List[str]):
+    """Everything except the worksheet parts themselves."""
+    zf.writestr("[Content_Types].xml", _content_types(len(titles)))
+    zf.writestr("_rels/.rels", _root_rels())
+    zf.writestr("xl/workbook.xml", _workbook(titles))
+    zf.writestr("xl/_rels/workbook.xml.rels", _workbook_rels(len(titles)))
+    zf.writestr("xl/styles.xml", _STYLES)
+
+
+# ---------- cells ----------
+def _text(value: str) -> str:
+    return escape(_ILLEGAL_XML_CHARS.sub("", value))
+
+
+def cell_xml(ref: str, value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)) and not (isinstance(value, float) and not math.isfinite(value)):
+        return f'<c r="{ref}"><v>{value!r}</v></c>'
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False)
+    value = str(value)
+    if len(value) > 1 and value.startswith("="):
+        # same as openpyxl: strings starting with "=" are written as formulas
+        return f'<c r="{ref}"><f>{_text(value[1:])}</f></c>'
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{_text(value)}</t></is></c>'
+
+
+def row_xml(n: int, cells: Dict[str, Any], formulas: bool = True) -> str:
+    """
+    <row> element for sheet row n; cells must be emitted in column order.
+    formulas=False writes formula cells as their last computed value.
+    """
+    if not cells:
+        return ""
+    indexed = []
+    for col, c in cells.items():
+        idx = COLUMN_INDEX.get(col)
+        if idx is None:
+            continue
+        if isinstance(c, dict):
+            # formula cells are written as <f> (Excel recalculates them on open)
+            c = c.get("formula") if formulas and c.get("type") == "formula" else c.get("value")
+        indexed.append((idx, c))
+    indexed.sort(key=lambda item: item[0])
+    row = str(n)
+    parts = [cell_xml(COLUMN_LETTERS[idx - 1] + row, val) for idx, val in indexed]
+    return f'<row r="{row}">{"".join(parts)}</row>'
+
+
+def sheet_row(r: Dict[str, Any], previous: int) -> int:
+    """
+    Sheet row a doc is written at: its "position" when it has one, so formula
+    references (which name sheet rows) still point at the same cells; the next
+    row otherwise (like Worksheet.append). Positions must increase.
+    """
+    return r.get("position") or previous + 1
+
+
+def positioned_row_xml(n: int, r: Dict[str, Any]) -> str:
+    # without a position the row may not be where its formulas' references
+    # assume, so those are exported as their computed values
+    return row_xml(n, r.get("cells") or {}, formulas=r.get("position") is not None)
+
+
+async def write_sheet_rows(part, cursor, sink: Optional[_ChunkSink] = None) -> AsyncIterator[bytes]:
+    """
+    Write rows from cursor into an open worksheet zip part, at sheet_row() of
+    each. If a sink is given, its buffered bytes are yielded every FLUSH_BYTES.
+    """
+    part.write(SHEET_HEADER)
+    n = count = 0
+    async for r in cursor:
+        n = sheet_row(r, n)
+        count += 1
+        xml = positioned_row_xml(n, r)
+        if xml:
+            part.write(xml.encode("utf-8"))
+        if sink is not None and sink.size >= FLUSH_BYTES:
+            yield sink.drain()
+    part.write(SHEET_FOOTER)
+    EXPORT_ROWS.inc(amount=count)
+
+
+async def stream_xlsx(cursor, title: str = "Sheet1") -> AsyncIterator[bytes]:
+    """Yield the bytes of a single-sheet .xlsx built from a row cursor in sheet order."""
+    sink = _ChunkSink()
+    zf = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED)
+    write_package_parts(zf, [sheet_title(title)])
+    yield sink.drain()
+    with zf.open("xl/worksheets/sheet1.xml", "w") as part:
+        async for chunk in write_sheet_rows(part, cursor, sink):
+            yield chunk
+    zf.close()
+    yield sink.drain()
+
+
+def unique_titles(titles: List[str]) -> List[str]:
+    """sheet_title() of each, suffixed " (2)", " (3)", ... where Excel would see a duplicate (case-insensitive)."""
+    seen, out = set(), []
+    for title in titles:
+        base = sheet_title(title)
+        name, n = base, 1
+        while name.lower() in seen:
+            n += 1
+            suffix = f" ({n})"
+            name = base[:31 - len(suffix)] + suffix
+        seen.add(name.lower())
+        out.append(name)
+    return out
+
+
+def _write_rows(part, rows) -> int:
+    part.write(SHEET_HEADER)
+    n = count = 0
+    for r in rows:
+        n = sheet_row(r, n)
+        count += 1
+        xml = positioned_row_xml(n, r)
+        if xml:
+            part.write(xml.encode("utf-8"))
+    part.write(SHEET_FOOTER)
+    return count
+
+
+def write_xlsx(rows, out, title: str = "Sheet1") -> int:
+    """
+    Blocking variant of stream_xlsx for the job workers (jobs.py): rows is any
+    iterable of row docs in sheet order, out a writable binary file. Returns the
+    number of rows written.
+    """
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        write_package_parts(zf, [sheet_title(title)])
+        with zf.open("xl/worksheets/sheet1.xml", "w") as part:
+            return _write_rows(part, rows)
+
+
+def write_sheet_xml(rows, out) -> int:
+    """Uncompressed worksheet part for write_workbook; lets each sheet be rendered in its own process."""
+    return _write_rows(out, rows)
+
+
+def write_workbook(sheets: List[tuple], out):
+    """Multi-sheet .xlsx from (title, path of a write_sheet_xml part) pairs; titles must be unique."""
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        write_package_parts(zf, [title for title, _ in sheets])
+        for i, (_, path) in enumerate(sheets, start=1):
+            zf.write(path, f"xl/worksheets/sheet{i}.xml")
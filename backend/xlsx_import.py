@@ -0,0 +1,149 @@
+"""
+Streaming XLSX import helpers.
+
+The upload is spooled to a temp file on disk, parsed with openpyxl's read-only
+row iterator in a job pool process (see jobs.py) and handed back as bounded
+batches of row docs, so peak memory depends on IMPORT_BATCH_SIZE and not on the
+workbook size.
+"""
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import tempfile
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Iterator
+
+import openpyxl
+
+from columns import COLUMN_LETTERS
+from metrics import IMPORT_PARSE_CELLS, IMPORT_PARSE_SECONDS
+from typed_values import parse_rows
+from row_order import key_for_index
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+SPOOL_CHUNK_SIZE = 1024 * 1024
+# how many finished imports stay queryable after they complete
+FINISHED_IMPORTS_KEPT = 100
+
+
+def now_iso():
+    return datetime.utcnow().isoformat()
+
+
+def _copy_to_disk(src, path: str):
+    src.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(src, out, SPOOL_CHUNK_SIZE)
+
+
+async def spool_upload(file) -> str:
+    """Copy an UploadFile to a named temp file in chunks; returns the path (caller removes it)."""
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        await asyncio.to_thread(_copy_to_disk, file.file, path)
+    except Exception:
+        os.unlink(path)
+        raise
+    return path
+
+
+def build_row_docs(sheet_id: str, first_row_index: int, rows: List[tuple], ts: str) -> List[Dict[str, Any]]:
+    """Row docs for a block of raw openpyxl rows; cell types are inferred per column for the block."""
+    started = time.perf_counter()
+    typed = parse_rows(rows, COLUMN_LETTERS)
+    IMPORT_PARSE_SECONDS.inc(amount=time.perf_counter() - started)
+    IMPORT_PARSE_CELLS.inc(amount=sum(len(cells) for cells in typed))
+    return [
+        {
+            "_id": str(uuid.uuid4()),
+            "spreadsheet_id": sheet_id,
+            "row_index": first_row_index + i,
+            "order_key": key_for_index(first_row_index + i),
+            "cells": cells,
+            "version": 1,
+            "updated_by": None,
+            "updated_at": ts,
+        }
+        for i, cells in enumerate(typed)
+    ]
+
+
+def worksheet_names(path: str) -> List[str]:
+    """Worksheet titles in workbook order, chartsheets left out (blocking)."""
+    wb = openpyxl.load_workbook(filename=path, read_only=True, data_only=False)
+    try:
+        return [ws.title for ws in wb.worksheets]
+    finally:
+        wb.close()
+
+
+def iter_row_batches(path: str, sheet_id: str, batch_size: int = IMPORT_BATCH_SIZE,
+                     worksheet: Optional[str] = None) -> Iterator[List[Dict[str, Any]]]:
+    """Yield lists of at most batch_size row docs from a worksheet, the active one by default (blocking)."""
+    wb = openpyxl.load_workbook(filename=path, read_only=True, data_only=False)
+    try:
+        sheet = wb[worksheet] if worksheet is not None else wb.active
+        raw = []
+        first = 1
+        for row in sheet.iter_rows(values_only=True):
+            raw.append(row)
+            if len(raw) >= batch_size:
+                yield build_row_docs(sheet_id, first, raw, now_iso())
+                first += len(raw)
+                raw = []
+        if raw:
+            yield build_row_docs(sheet_id, first, raw, now_iso())
+    finally:
+        wb.close()
+
+
+# ---------- Progress tracking ----------
+class ImportTracker:
+    """In-process registry of running (and recently finished) imports."""
+
+    def __init__(self, keep_finished: int = FINISHED_IMPORTS_KEPT):
+        self.keep_finished = keep_finished
+        self.running: Dict[str, Dict[str, Any]] = {}
+        self.finished: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def start(self, import_id: str, sheet_id: str, filename: Optional[str]) -> Dict[str, Any]:
+        state = {
+            "import_id": import_id,
+            "spreadsheet_id": sheet_id,
+            "filename": filename,
+            "status": "running",
+            "rows": 0,
+            "batches": 0,
+            "error": None,
+            "started_at": now_iso(),
+            "finished_at": None,
+        }
+        self.running[import_id] = state
+        return state
+
+    def advance(self, import_id: str, rows: int):
+        state = self.running.get(import_id)
+        if state is not None:
+            state["rows"] += rows
+            state["batches"] += 1
+
+    def finish(self, import_id: str, error: Optional[str] = None):
+        state = self.running.pop(import_id, None)
+        if state is None:
+            return
+        state["status"] = "failed" if error else "done"
+        state["error"] = error
+        state["finished_at"] = now_iso()
+        self.finished[import_id] = state
+        while len(self.finished) > self.keep_finished:
+            self.finished.popitem(last=False)
+
+    def get(self, import_id: str) -> Optional[Dict[str, Any]]:
+        return self.running.get(import_id) or self.finished.get(import_id)
+
+    def list_running(self) -> List[Dict[str, Any]]:
+        return list(self.running.values())
@@ -0,0 +1,116 @@
+"""
+Login burst benchmark for the auth app (backend/noexcel.py).
+
+Fires a burst of /login requests while a probe client keeps calling an unrelated,
+cheap endpoint (/me, a token check) and reports login throughput plus the probe's
+latency percentiles. With bcrypt on the event loop the probe's p99 grows to
+roughly the whole burst; with hashing off-loaded it stays near its idle value.
+
+    python -m uvicorn noexcel:app --app-dir backend --port 8001   # from the repo root
+    python bench/auth_login.py --url http://127.0.0.1:8001 --logins 400 --concurrency 32
+
+Each concurrent worker logs in as its own user (benchuser<n>), because the
+server runs only one verification per user at a time.
+"""
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+import httpx
+
+PASSWORD = "bench12345"
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values):
+    ms = [v * 1000 for v in values]
+    return {"n": len(ms), "p50_ms": percentile(ms, 50), "p99_ms": percentile(ms, 99), "max_ms": max(ms, default=None)}
+
+
+async def setup(client, users):
+    for n in range(users):
+        await client.post("/register", json={"username": f"benchuser{n}", "password": PASSWORD})
+    r = await client.post("/login", json={"username": "benchuser0", "password": PASSWORD})
+    r.raise_for_status()
+    return r.json()["access_token"]
+
+
+async def probe(client, token, path, interval, stop, latencies):
+    headers = {"Authorization": f"Bearer {token}"}
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await client.get(path, headers=headers)
+        latencies.append(time.perf_counter() - t0)
+        await asyncio.sleep(interval)
+
+
+async def login_worker(client, n, count, latencies, statuses):
+    body = {"username": f"benchuser{n}", "password": PASSWORD}
+    for _ in range(count):
+        t0 = time.perf_counter()
+        r = await client.post("/login", json=body)
+        latencies.append(time.perf_counter() - t0)
+        statuses[r.status_code] += 1
+
+
+async def run(client, logins=400, concurrency=32, probe_path="/me", probe_interval=0.005):
+    token = await setup(client, concurrency)
+
+    idle = []
+    stop = asyncio.Event()
+    task = asyncio.create_task(probe(client, token, probe_path, probe_interval, stop, idle))
+    await asyncio.sleep(1.0)
+    stop.set()
+    await task
+
+    busy, login_latencies, statuses = [], [], Counter()
+    stop = asyncio.Event()
+    task = asyncio.create_task(probe(client, token, probe_path, probe_interval, stop, busy))
+    t0 = time.perf_counter()
+    per_worker = max(1, logins // concurrency)
+    await asyncio.gather(*(login_worker(client, n, per_worker, login_latencies, statuses)
+                           for n in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    await task
+
+    return {
+        "logins": len(login_latencies),
+        "seconds": elapsed,
+        "logins_per_s": len(login_latencies) / elapsed if elapsed else None,
+        "login": summary(login_latencies),
+        "statuses": dict(statuses),
+        "probe_idle": summary(idle),
+        "probe_during_burst": summary(busy),
+    }
+
+
+def report(result):
+    print(f"logins: {result['logins']} in {result['seconds']:.2f}s = {result['logins_per_s']:.1f}/s "
+          f"statuses={result['statuses']}")
+    for name in ("login", "probe_idle", "probe_during_burst"):
+        s = result[name]
+        print(f"{name:>20}: n={s['n']} p50={s['p50_ms']:.1f}ms p99={s['p99_ms']:.1f}ms max={s['max_ms']:.1f}ms")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", default="http://127.0.0.1:8001")
+    ap.add_argument("--logins", type=int, default=400)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--probe", default="/me")
+    args = ap.parse_args()
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        report(await run(client, args.logins, args.concurrency, args.probe))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,335 @@
+"""
+Benchmark suite for the spreadsheet backend (backend/main.py).
+
+Runs the app in process (ASGI, no HTTP server) against either a MongoDB server
+(--uri; the scratch database --db is dropped before and after) or, with --fake,
+an in-memory mongomock-motor database. Scenarios:
+
+- import_export: xlsx import and export throughput per sheet size;
+- get_rows:      latency of random --window row windows, row cache cold and warm;
+- patch_row:     throughput and latency of concurrent single-cell patches, all
+                 writers on one row and each writer on its own rows;
+- ws_fanout:     time from broadcast() until each of N in-memory subscribers
+                 has the frame written to its socket.
+
+Inputs are synthetic and seeded, so two runs with the same arguments do the same
+work. Results are printed as a table and, with --out, written as JSON (with the
+git commit, Python and Mongo versions); --compare old.json prints the change of
+every numeric result against an earlier run.
+
+    python bench/backend_suite.py --fake --sizes 1000 10000 --out before.json
+    python bench/backend_suite.py --uri mongodb://localhost:27017 --out after.json --compare before.json
+
+Fake results are only comparable with other fake runs: mongomock is pure Python
+and far slower than a real server.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+import openpyxl
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+sys.path.insert(0, ROOT)
+
+XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values):
+    ms = [v * 1000 for v in values]
+    return {"n": len(ms), "p50_ms": percentile(ms, 50), "p99_ms": percentile(ms, 99), "max_ms": max(ms, default=None)}
+
+
+def synthetic_xlsx(rows, cols, seed=1):
+    # numbers, short text and dates, like a typical imported sheet
+    rnd = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for i in range(1, rows + 1):
+        row = []
+        for j in range(cols):
+            k = j % 3
+            row.append(round(rnd.random() * 1000, 2) if k == 0 else f"item {i}-{j}" if k == 1
+                       else datetime(2024, 1 + i % 12, 1 + j % 28))
+        ws.append(row)
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+# ---------- database ----------
+def use_fake_database(main):
+    """Point the app at an in-memory mongomock-motor database."""
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError as e:
+        raise SystemExit("--fake requires the 'mongomock-motor' package") from e
+    from database.models import UsersTable, SpreadsheetsTable, RowsTable
+    db = AsyncMongoMockClient()["noexcel_bench"]
+    main.db = main.database.db = db
+    main.database.users, main.database.spreadsheets, main.database.rows = (
+        UsersTable(db), SpreadsheetsTable(db), RowsTable(db))
+
+
+async def mongo_version(main):
+    try:
+        return (await main.db.command("buildInfo")).get("version")
+    except Exception:
+        return None
+
+
+# ---------- scenarios ----------
+async def bench_import_export(client, sizes, cols):
+    results, sheets = {}, {}
+    for rows in sizes:
+        data = synthetic_xlsx(rows, cols)
+        t0 = time.perf_counter()
+        r = await client.post("/api/spreadsheets/import_xlsx", params={"title": f"bench {rows}"},
+                              files={"file": ("bench.xlsx", data, XLSX)})
+        r.raise_for_status()
+        import_s = time.perf_counter() - t0
+        sheet_id = r.json()["spreadsheet_id"]
+        t0 = time.perf_counter()
+        r = await client.get(f"/api/spreadsheets/{sheet_id}/export_xlsx")
+        r.raise_for_status()
+        export_s = time.perf_counter() - t0
+        sheets[rows] = sheet_id
+        results[f"rows={rows}"] = {
+            "rows": rows, "cols": cols, "xlsx_bytes": len(data),
+            "import_s": import_s, "import_rows_per_s": rows / import_s,
+            "export_s": export_s, "export_rows_per_s": rows / export_s, "export_bytes": len(r.content),
+        }
+    return results, sheets
+
+
+async def bench_get_rows(client, main, sheet_id, rows, window, reads):
+    rnd = random.Random(2)
+    starts = [rnd.randint(1, max(1, rows - window + 1)) for _ in range(reads)]
+    out = {}
+    main.row_cache.invalidate_sheet(sheet_id)
+    for name in ("cold", "warm"):
+        latencies = []
+        for start in starts:
+            t0 = time.perf_counter()
+            r = await client.get(f"/api/spreadsheets/{sheet_id}/rows", params={"start": start, "end": start + window - 1})
+            latencies.append(time.perf_counter() - t0)
+            r.raise_for_status()
+        out[name] = summary(latencies)
+    out["window"] = window
+    return out
+
+
+async def bench_patches(client, sheet_id, rows, cols, writers, per_writer):
+    from columns import COLUMN_LETTERS
+    out = {}
+    for mode in ("one_row", "many_rows"):
+        latencies, statuses = [], Counter()
+
+        async def writer(w):
+            rnd = random.Random(w)
+            for i in range(per_writer):
+                # one_row: every writer edits its own column of row 1, so edits never conflict
+                row_index = 1 if mode == "one_row" else 1 + (w * per_writer + i) % rows
+                col = COLUMN_LETTERS[w % cols if mode == "one_row" else rnd.randrange(cols)]
+                t0 = time.perf_counter()
+                r = await client.patch(f"/api/spreadsheets/{sheet_id}/rows/{row_index}",
+                                       json={"changes": {col: {"new": rnd.random()}}})
+                latencies.append(time.perf_counter() - t0)
+                statuses[r.status_code] += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(writer(w) for w in range(writers)))
+        elapsed = time.perf_counter() - t0
+        out[mode] = {"writers": writers, "patches": len(latencies), "seconds": elapsed,
+                     "patches_per_s": len(latencies) / elapsed, "latency": summary(latencies),
+                     "statuses": {str(k): v for k, v in statuses.items()}}
+    return out
+
+
+class BenchSocket:
+    """Stands in for a WebSocket: records when each seq was written to it."""
+
+    def __init__(self, delivered):
+        self.delivered = delivered
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame):
+        self.delivered(frame)
+
+    async def send_bytes(self, frame):
+        self.delivered(frame)
+
+
+async def bench_ws_fanout(main, subscriber_counts, broadcasts):
+    from realtime import frame_seq
+    from wire import row_updated
+    out = {}
+    message = row_updated(1, {"B": {"type": "number", "value": 1.5}}, ["B"], 2)
+    for n in subscriber_counts:
+        sheet_id = f"bench-ws-{n}"
+        per_delivery, last = [], []
+        pending, started, done = {}, {}, asyncio.Event()
+
+        def delivered(frame):
+            seq = frame_seq(frame)
+            if seq not in pending:
+                return
+            per_delivery.append(time.perf_counter() - started[seq])
+            pending[seq] -= 1
+            if pending[seq] == 0:
+                last.append(time.perf_counter() - started[seq])
+                done.set()
+
+        sockets = [BenchSocket(delivered) for _ in range(n)]
+        for ws in sockets:
+            await main.manager.connect(sheet_id, ws)
+        try:
+            for seq in range(1, broadcasts + 1):
+                pending[seq] = n
+                done.clear()
+                started[seq] = time.perf_counter()
+                await main.manager.broadcast(sheet_id, message, seq=seq)
+                await asyncio.wait_for(done.wait(), timeout=30)
+        finally:
+            for ws in sockets:
+                await main.manager.disconnect(sheet_id, ws)
+        out[f"subscribers={n}"] = {"subscribers": n, "broadcasts": broadcasts,
+                                   "delivery": summary(per_delivery), "all_delivered": summary(last)}
+    return out
+
+
+# ---------- run / report ----------
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(main, sizes=(1000, 10000), cols=10, window=100, reads=200, writers=16, per_writer=50,
+              subscribers=(1, 100, 1000), broadcasts=200, fake=False):
+    # ASGITransport doesn't send lifespan events; run the startup/shutdown hooks ourselves
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600) as client:
+            import_export, sheets = await bench_import_export(client, sizes, cols)
+            rows = max(sizes)
+            sheet_id = sheets[rows]
+            get_rows = await bench_get_rows(client, main, sheet_id, rows, window, reads)
+            patches = await bench_patches(client, sheet_id, rows, cols, writers, per_writer)
+        ws_fanout = await bench_ws_fanout(main, subscribers, broadcasts)
+        mongo = "fake" if fake else await mongo_version(main)
+    return {
+        "meta": {"commit": git_commit(), "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                 "python": platform.python_version(), "platform": platform.platform(), "mongo": mongo},
+        "params": {"sizes": list(sizes), "cols": cols, "window": window, "reads": reads, "writers": writers,
+                   "per_writer": per_writer, "subscribers": list(subscribers), "broadcasts": broadcasts},
+        "import_export": import_export,
+        "get_rows": get_rows,
+        "patch_row": patches,
+        "ws_fanout": ws_fanout,
+    }
+
+
+def flatten(result, prefix=""):
+    out = {}
+    for key, value in result.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[path] = value
+    return out
+
+
+def report(result):
+    m = result["meta"]
+    print(f"commit {m['commit']}  python {m['python']}  mongo {m['mongo']}")
+    for name, r in result["import_export"].items():
+        print(f"import/export {name:>12}: import {r['import_rows_per_s']:>9.0f} rows/s  "
+              f"export {r['export_rows_per_s']:>9.0f} rows/s  ({r['xlsx_bytes']} bytes in, {r['export_bytes']} out)")
+    g = result["get_rows"]
+    for name in ("cold", "warm"):
+        print(f"get_rows {g['window']} rows {name:>5}: p50 {g[name]['p50_ms']:.2f}ms  p99 {g[name]['p99_ms']:.2f}ms")
+    for name, r in result["patch_row"].items():
+        print(f"patch_row {name:>9}: {r['patches_per_s']:>8.0f}/s with {r['writers']} writers  "
+              f"p50 {r['latency']['p50_ms']:.2f}ms  p99 {r['latency']['p99_ms']:.2f}ms  statuses {r['statuses']}")
+    for name, r in result["ws_fanout"].items():
+        print(f"ws_fanout {name:>16}: delivery p50 {r['delivery']['p50_ms']:.3f}ms p99 {r['delivery']['p99_ms']:.3f}ms  "
+              f"all delivered p50 {r['all_delivered']['p50_ms']:.3f}ms p99 {r['all_delivered']['p99_ms']:.3f}ms")
+
+
+def compare(result, baseline):
+    old, new = flatten(baseline), flatten(result)
+    print(f"\nvs {baseline['meta'].get('commit')} ({baseline['meta'].get('at')}):")
+    if baseline.get("params") != result["params"] or baseline["meta"].get("mongo") != result["meta"]["mongo"]:
+        print("  warning: the runs used different parameters or databases")
+    for path, value in new.items():
+        if path.startswith("params.") or path not in old or not old[path]:
+            continue
+        print(f"  {path:<55} {old[path]:>12.3f} -> {value:>12.3f}  {(value / old[path] - 1) * 100:+7.1f}%")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--uri", default=os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    ap.add_argument("--db", default="noexcel_bench_suite")
+    ap.add_argument("--fake", action="store_true", help="in-memory mongomock-motor database instead of --uri")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    ap.add_argument("--cols", type=int, default=10)
+    ap.add_argument("--window", type=int, default=100)
+    ap.add_argument("--reads", type=int, default=200)
+    ap.add_argument("--writers", type=int, default=16)
+    ap.add_argument("--per-writer", type=int, default=50)
+    ap.add_argument("--subscribers", type=int, nargs="+", default=[1, 100, 1000])
+    ap.add_argument("--broadcasts", type=int, default=200)
+    ap.add_argument("--out", help="write the results as JSON to this file")
+    ap.add_argument("--compare", help="JSON results of an earlier run")
+    args = ap.parse_args()
+
+    # must be set before main.py creates its client
+    os.environ["MONGODB_URI"] = args.uri
+    os.environ["MONGODB_DB"] = args.db
+    import main as app_module
+    if args.fake:
+        use_fake_database(app_module)
+    else:
+        await app_module.database.client.drop_database(args.db)
+    try:
+        result = await run(app_module, args.sizes, args.cols, args.window, args.reads, args.writers, args.per_writer,
+                           args.subscribers, args.broadcasts, args.fake)
+    finally:
+        if not args.fake:
+            await app_module.database.client.drop_database(args.db)
+    report(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+"""
+Event-loop lag during xlsx import/export work: in-loop/thread vs the job pool (backend/jobs.py).
+
+A ticker coroutine sleeps --tick ms in a loop and records how late it wakes up,
+which is what every other request and WebSocket on the worker sees as extra
+latency. That lag is measured while a synthetic workbook of --rows rows is
+
+- import/thread: parsed by xlsx_stream.thread_row_batches (xlsx_import.iter_row_batches
+  in a worker thread, which still holds the GIL for the parse);
+- import/pool:   parsed by JobRunner.import_batches (openpyxl in a pool process);
+- export/loop:   built by xlsx_export.stream_xlsx (the streaming endpoint);
+- export/pool:   built by JobRunner.export_file (BSON spool + write_xlsx in the pool).
+
+No database is involved: batches are consumed and dropped, exported rows come
+from a generator.
+
+    python bench/import_jobs.py --rows 100000 --cols 10
+"""
+import io
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+import openpyxl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import jobs  # noqa: E402
+import xlsx_import  # noqa: E402
+import xlsx_export  # noqa: E402
+from xlsx_stream import thread_row_batches  # noqa: E402
+from columns import COLUMN_LETTERS  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values):
+    ms = [v * 1000 for v in values]
+    return {"n": len(ms), "p50_ms": percentile(ms, 50), "p99_ms": percentile(ms, 99), "max_ms": max(ms, default=None)}
+
+
+def synthetic_xlsx(path, rows, cols):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for i in range(1, rows + 1):
+        ws.append([i * 1.5 + j if j % 3 == 0 else f"item {i}-{j}" if j % 3 == 1 else datetime(2024, 1 + i % 12, 1)
+                   for j in range(cols)])
+    wb.save(path)
+
+
+async def synthetic_rows(rows, cols):
+    for i in range(1, rows + 1):
+        yield {"row_index": i, "cells": {COLUMN_LETTERS[j]: {"type": "number", "value": i * 1.5 + j} if j % 2 == 0
+                                         else {"type": "string", "value": f"item {i}-{j}"} for j in range(cols)}}
+        if i % 1000 == 0:
+            # a Mongo cursor yields to the loop between batches
+            await asyncio.sleep(0)
+
+
+async def ticker(tick, stop, lags):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(tick)
+        lags.append(time.perf_counter() - t0 - tick)
+
+
+async def measure(work, tick):
+    lags, stop = [], asyncio.Event()
+    task = asyncio.create_task(ticker(tick, stop, lags))
+    t0 = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    await task
+    return {"seconds": elapsed, "loop_lag": summary(lags)}
+
+
+async def run(rows=100000, cols=10, tick=0.005):
+    runner = jobs.JobRunner(workers=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.xlsx")
+        synthetic_xlsx(path, rows, cols)
+        # start the pool process before measuring
+        await runner.call(len, "")
+
+        async def import_thread():
+            async for _ in thread_row_batches(path, "bench"):
+                await asyncio.sleep(0)
+
+        async def import_pool():
+            async for _ in runner.import_batches("import", path, "bench", xlsx_import.IMPORT_BATCH_SIZE):
+                await asyncio.sleep(0)
+
+        async def export_loop():
+            out = io.BytesIO()
+            async for chunk in xlsx_export.stream_xlsx(synthetic_rows(rows, cols)):
+                out.write(chunk)
+                await asyncio.sleep(0)
+
+        async def export_pool():
+            await runner.export_file("export", synthetic_rows(rows, cols), "bench")
+
+        idle = await measure(lambda: asyncio.sleep(1.0), tick)
+        result = {"params": {"rows": rows, "cols": cols, "tick_ms": tick * 1000}, "idle": idle}
+        for name, work in (("import/thread", import_thread), ("import/pool", import_pool),
+                           ("export/loop", export_loop), ("export/pool", export_pool)):
+            result[name] = await measure(work, tick)
+    runner.shutdown()
+    return result
+
+
+def report(result):
+    p = result["params"]
+    print(f"{p['rows']} rows x {p['cols']} cols, ticker every {p['tick_ms']:.1f}ms")
+    print(f"{'':>14} {'seconds':>8} {'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11}")
+    for name in ("idle", "import/thread", "import/pool", "export/loop", "export/pool"):
+        r = result[name]
+        lag = r["loop_lag"]
+        print(f"{name:>14} {r['seconds']:>8.2f} {lag['p50_ms']:>11.2f} {lag['p99_ms']:>11.2f} {lag['max_ms']:>11.2f}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=100000)
+    ap.add_argument("--cols", type=int, default=10)
+    ap.add_argument("--tick", type=float, default=5.0, help="ticker interval in ms")
+    args = ap.parse_args()
+    report(await run(args.rows, args.cols, args.tick / 1000))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
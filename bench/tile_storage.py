@@ -0,0 +1,170 @@
+"""
+Per-row vs tiled storage (backend/tiles.py) on a synthetic sheet.
+
+Loads the same rows x cols sheet in both layouts into a scratch database
+(dropped first) and reports:
+
+- storage: documents, data size, storage size and index size (collStats);
+- range reads: latency of reading random windows of --window rows, as get_rows does;
+- writes: latency of random single-cell patches, as patch_row does, and the
+  document bytes rewritten per patch (WiredTiger rewrites the whole document,
+  so this is the write amplification of one cell edit).
+
+    python bench/tile_storage.py --uri mongodb://localhost:27017 --rows 200000 --cols 10
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+import bson
+import motor.motor_asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import tiles  # noqa: E402
+from columns import COLUMN_LETTERS  # noqa: E402
+from xlsx_import import build_row_docs  # noqa: E402
+
+BATCH_ROWS = 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values):
+    ms = [v * 1000 for v in values]
+    return {"n": len(ms), "p50_ms": percentile(ms, 50), "p99_ms": percentile(ms, 99)}
+
+
+def synthetic_rows(first, count, cols):
+    # a mix of numbers, short text and dates, like a typical imported sheet
+    out = []
+    for i in range(first, first + count):
+        row = []
+        for j in range(cols):
+            k = j % 3
+            row.append(i * 1.5 + j if k == 0 else f"item {i}-{j}" if k == 1 else f"2024-{1 + i % 12:02d}-{1 + j % 28:02d}")
+        out.append(tuple(row))
+    return out
+
+
+async def load(db, rows, cols, tile_rows):
+    ts = "2024-01-01T00:00:00"
+    await db.rows.create_index([("spreadsheet_id", 1), ("row_index", 1)], unique=True)
+    await tiles.ensure_indexes(db)
+    batch = tiles.aligned_batch_size(BATCH_ROWS, tile_rows)
+    for first in range(1, rows + 1, batch):
+        docs = build_row_docs("rows", first, synthetic_rows(first, min(batch, rows - first + 1), cols), ts)
+        await db.rows.insert_many(docs)
+        for d in docs:
+            d["spreadsheet_id"] = "tiled"
+        await db.tiles.insert_many(tiles.pack_rows("tiled", tile_rows, docs, ts))
+
+
+async def storage(db, name):
+    try:
+        s = await db.command("collStats", name)
+        return {k: s.get(k) for k in ("count", "size", "avgObjSize", "storageSize", "totalIndexSize")}
+    except Exception:
+        # servers/mocks without collStats: logical BSON size only
+        sizes = [len(bson.encode(d)) async for d in db[name].find()]
+        return {"count": len(sizes), "size": sum(sizes), "avgObjSize": sum(sizes) // max(1, len(sizes))}
+
+
+async def read_rows(db, start, end):
+    cursor = db.rows.find({"spreadsheet_id": "rows", "row_index": {"$gte": start, "$lte": end}},
+                          {"row_index": 1, "version": 1, "cells": 1}).sort("row_index", 1)
+    return [r async for r in cursor]
+
+
+async def bench_reads(db, rows, window, reads, tile_rows):
+    rnd = random.Random(1)
+    starts = [rnd.randint(1, max(1, rows - window)) for _ in range(reads)]
+    per_row, tiled = [], []
+    for s in starts:
+        t0 = time.perf_counter()
+        await read_rows(db, s, s + window - 1)
+        per_row.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        await tiles.load_rows(db, "tiled", tile_rows, s, s + window - 1)
+        tiled.append(time.perf_counter() - t0)
+    return summary(per_row), summary(tiled)
+
+
+async def bench_writes(db, rows, cols, writes, tile_rows):
+    rnd = random.Random(2)
+    targets = [(rnd.randint(1, rows), COLUMN_LETTERS[rnd.randrange(cols)], rnd.random()) for _ in range(writes)]
+    per_row, tiled = [], []
+    for row_index, col, value in targets:
+        cell = {"type": "number", "value": value}
+        t0 = time.perf_counter()
+        await db.rows.find_one_and_update(
+            {"spreadsheet_id": "rows", "row_index": row_index},
+            {"$set": {f"cells.{col}": cell, "updated_by": None, "updated_at": "x"}, "$inc": {"version": 1}},
+            projection={"version": 1, f"cells.{col}": 1})
+        per_row.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        await tiles.patch_cells(db, "tiled", tile_rows, row_index, {col: cell}, None, None, "x")
+        tiled.append(time.perf_counter() - t0)
+    return summary(per_row), summary(tiled)
+
+
+async def run(db, rows=100000, cols=10, window=100, reads=200, writes=500, tile_rows=tiles.TILE_ROWS):
+    await load(db, rows, cols, tile_rows)
+    rows_storage, tiles_storage = await storage(db, "rows"), await storage(db, "tiles")
+    rows_reads, tiles_reads = await bench_reads(db, rows, window, reads, tile_rows)
+    rows_writes, tiles_writes = await bench_writes(db, rows, cols, writes, tile_rows)
+    return {
+        "params": {"rows": rows, "cols": cols, "window": window, "tile_rows": tile_rows},
+        "rows": {"storage": rows_storage, "reads": rows_reads, "writes": rows_writes,
+                 "bytes_rewritten_per_write": rows_storage["avgObjSize"]},
+        "tiled": {"storage": tiles_storage, "reads": tiles_reads, "writes": tiles_writes,
+                  "bytes_rewritten_per_write": tiles_storage["avgObjSize"]},
+    }
+
+
+def _mb(v):
+    return f"{v / 2 ** 20:9.1f}" if v is not None else f"{'-':>9}"
+
+
+def report(result):
+    p = result["params"]
+    print(f"{p['rows']} rows x {p['cols']} cols, tile_rows={p['tile_rows']}, read window={p['window']}")
+    print(f"{'':>8} {'docs':>9} {'data MB':>9} {'disk MB':>9} {'index MB':>9} "
+          f"{'read p50/p99 ms':>17} {'write p50/p99 ms':>17} {'bytes/write':>12}")
+    for name in ("rows", "tiled"):
+        r = result[name]
+        s = r["storage"]
+        print(f"{name:>8} {s['count']:>9} {_mb(s['size'])} {_mb(s.get('storageSize'))} {_mb(s.get('totalIndexSize'))} "
+              f"{r['reads']['p50_ms']:>8.2f}/{r['reads']['p99_ms']:<8.2f} "
+              f"{r['writes']['p50_ms']:>8.2f}/{r['writes']['p99_ms']:<8.2f} {r['bytes_rewritten_per_write']:>12}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--uri", default=os.getenv("MONGODB_URI", "mongodb://localhost:27017"))
+    ap.add_argument("--db", default="noexcel_bench_tiles")
+    ap.add_argument("--rows", type=int, default=100000)
+    ap.add_argument("--cols", type=int, default=10)
+    ap.add_argument("--window", type=int, default=100)
+    ap.add_argument("--reads", type=int, default=200)
+    ap.add_argument("--writes", type=int, default=500)
+    ap.add_argument("--tile-rows", type=int, default=tiles.TILE_ROWS)
+    args = ap.parse_args()
+    client = motor.motor_asyncio.AsyncIOMotorClient(args.uri)
+    await client.drop_database(args.db)
+    try:
+        report(await run(client[args.db], args.rows, args.cols, args.window, args.reads, args.writes, args.tile_rows))
+    finally:
+        await client.drop_database(args.db)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
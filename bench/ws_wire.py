@@ -0,0 +1,115 @@
+"""
+Bytes per edit per subscriber for the WebSocket wire formats (backend/wire.py).
+
+Replays a synthetic stream of single-cell edits on a wide sheet through the same
+code the server uses (realtime.stamp/encode for the published frame, Wire.render
+and Wire.join for each socket) and reports, per wire format, the payload plus
+WebSocket frame header bytes one subscriber receives per edit, and the render
+cost per edit (paid once per wire in use, not per subscriber).
+
+--burst is how many events are already queued when a socket's writer wakes up:
+1 for an idle sheet, more for a busy one or a client on a slow link. Only v2
+wires batch them into one frame.
+
+Every edit is published once, as wire.row_updated builds it: v1 sockets get the
+whole row, v2 sockets only the edited cell.
+
+    python bench/ws_wire.py --cols 30 --edits 20000 --burst 1 8
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import wire  # noqa: E402
+from realtime import encode, stamp  # noqa: E402
+from columns import COLUMN_LETTERS  # noqa: E402
+
+
+def ws_header(n):
+    # server -> client frames are unmasked
+    return 2 if n < 126 else 4 if n < 65536 else 10
+
+
+def random_cell(rnd, i, j):
+    k = j % 4
+    if k == 0:
+        return {"type": "number", "value": round(rnd.random() * 1000, 2)}
+    if k == 1:
+        return {"type": "string", "value": f"item {i}-{j}"}
+    if k == 2:
+        return {"type": "date", "value": f"2024-{1 + i % 12:02d}-{1 + j % 28:02d}"}
+    return {"type": "number", "value": i * j}
+
+
+def edit_stream(rows, cols, edits, seed=1):
+    """One published frame per edit, as patch_row broadcasts it."""
+    rnd = random.Random(seed)
+    sheet = {i: {COLUMN_LETTERS[j]: random_cell(rnd, i, j) for j in range(cols)} for i in range(1, rows + 1)}
+    versions = {i: 1 for i in sheet}
+    for seq in range(1, edits + 1):
+        row_index = rnd.randint(1, rows)
+        j = rnd.randrange(cols)
+        col = COLUMN_LETTERS[j]
+        cell = random_cell(rnd, row_index + seq, j)
+        sheet[row_index][col] = cell
+        versions[row_index] += 1
+        version = versions[row_index]
+        yield encode(stamp(seq, wire.row_updated(row_index, dict(sheet[row_index]), [col], version)))
+
+
+def measure(frames, w, burst):
+    """Bytes on the wire, frames and render seconds for one subscriber of wire w."""
+    total, count, render = 0, 0, 0.0
+    for i in range(0, len(frames), burst):
+        t0 = time.perf_counter()
+        items = [w.render(f, {}) for f in frames[i:i + burst]]
+        render += time.perf_counter() - t0
+        if w.version == 1:
+            sizes = [len(f.encode()) for f in items]
+        else:
+            joined = w.join(items)
+            sizes = [len(joined) if w.binary else len(joined.encode())]
+        total += sum(n + ws_header(n) for n in sizes)
+        count += len(sizes)
+    return total, count, render
+
+
+def run(rows=1000, cols=30, edits=20000, bursts=(1, 8)):
+    frames = list(edit_stream(rows, cols, edits))
+    wires = [("v1 json", wire.Wire(1, "json")), ("v2 json", wire.Wire(2, "json"))]
+    if wire.msgpack is not None:
+        wires.append(("v2 msgpack", wire.Wire(2, "msgpack")))
+    results = []
+    for burst in bursts:
+        for name, w in wires:
+            total, count, render = measure(frames, w, burst)
+            results.append({"wire": name, "burst": burst, "bytes_per_edit": total / edits,
+                            "frames_per_edit": count / edits, "render_us_per_edit": render / edits * 1e6})
+    return {"params": {"rows": rows, "cols": cols, "edits": edits}, "results": results}
+
+
+def report(result):
+    p = result["params"]
+    print(f"{p['edits']} single-cell edits, {p['rows']} rows x {p['cols']} cols")
+    print(f"{'wire':>12} {'burst':>6} {'bytes/edit':>11} {'frames/edit':>12} {'render us/edit':>15}")
+    for r in result["results"]:
+        print(f"{r['wire']:>12} {r['burst']:>6} {r['bytes_per_edit']:>11.1f} {r['frames_per_edit']:>12.3f} "
+              f"{r['render_us_per_edit']:>15.2f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, default=1000)
+    ap.add_argument("--cols", type=int, default=30)
+    ap.add_argument("--edits", type=int, default=20000)
+    ap.add_argument("--burst", type=int, nargs="+", default=[1, 8])
+    args = ap.parse_args()
+    report(run(args.rows, args.cols, args.edits, args.burst))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Peak memory of the streaming xlsx import (backend/xlsx_import.py) against workbook size.
+
+Writes synthetic workbooks of each --rows size and parses them with
+thread_row_batches below, the in-process import path: iter_row_batches in a
+worker thread, batches of IMPORT_BATCH_SIZE row docs consumed and dropped. For
+each size it reports the file size, the parse time and the peak Python
+allocation (tracemalloc), which should stay flat as the file grows.
+
+No database is involved.
+
+    python bench/xlsx_stream.py --rows 10000 50000 200000 --cols 10
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+import openpyxl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import xlsx_import  # noqa: E402
+
+
+async def thread_row_batches(path, sheet_id, batch_size=xlsx_import.IMPORT_BATCH_SIZE):
+    """
+    iter_row_batches in a worker thread, prefetching the next batch while the
+    caller handles the current one, so at most two batches are alive at a time.
+    """
+    it = xlsx_import.iter_row_batches(path, sheet_id, batch_size)
+    pending = asyncio.ensure_future(asyncio.to_thread(next, it, None))
+    try:
+        while True:
+            batch = await pending
+            if batch is None:
+                break
+            pending = asyncio.ensure_future(asyncio.to_thread(next, it, None))
+            yield batch
+    finally:
+        # the generator can't be closed while a worker thread is inside it
+        if not pending.done():
+            try:
+                await pending
+            except Exception:
+                pass
+        it.close()
+
+
+def synthetic_xlsx(path, rows, cols):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    for i in range(1, rows + 1):
+        ws.append([i * 1.5 + j if j % 3 == 0 else f"item {i}-{j}" if j % 3 == 1 else datetime(2024, 1 + i % 12, 1)
+                   for j in range(cols)])
+    wb.save(path)
+
+
+async def measure(path):
+    docs = 0
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        async for batch in thread_row_batches(path, "bench"):
+            docs += len(batch)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"docs": docs, "seconds": time.perf_counter() - t0, "peak_mb": peak / 2 ** 20}
+
+
+async def run(sizes=(10000, 50000, 200000), cols=10):
+    result = {"params": {"cols": cols, "batch_size": xlsx_import.IMPORT_BATCH_SIZE}, "sizes": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            path = os.path.join(tmp, f"{rows}.xlsx")
+            synthetic_xlsx(path, rows, cols)
+            r = await measure(path)
+            r.update(rows=rows, file_mb=os.path.getsize(path) / 2 ** 20)
+            result["sizes"].append(r)
+    return result
+
+
+def report(result):
+    p = result["params"]
+    print(f"{p['cols']} cols, batches of {p['batch_size']} rows")
+    print(f"{'rows':>9} {'file MB':>8} {'seconds':>8} {'rows/s':>9} {'peak MB':>8}")
+    for r in result["sizes"]:
+        print(f"{r['rows']:>9} {r['file_mb']:>8.1f} {r['seconds']:>8.2f} {r['docs'] / r['seconds']:>9.0f} "
+              f"{r['peak_mb']:>8.1f}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--rows", type=int, nargs="+", default=[10000, 50000, 200000])
+    ap.add_argument("--cols", type=int, default=10)
+    args = ap.parse_args()
+    report(await run(args.rows, args.cols))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,6 +0,0 @@
-from .database import Database
-from .models.users import UsersTable
-from .models.spreadsheets import SpreadsheetsTable
-from .models.cells import CellsTable
-
-__all__ = ['Database', 'UsersTable', 'SpreadsheetsTable', 'CellsTable']
\ No newline at end of file
@@ -0,0 +1,6 @@
+from .database import Database, get_database
+from .models.users import UsersTable
+from .models.spreadsheets import SpreadsheetsTable
+from .models.rows import RowsTable
+
+__all__ = ['Database', 'get_database', 'UsersTable', 'SpreadsheetsTable', 'RowsTable']
@@ -1,38 +1,99 @@
 import os
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+import logging
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError
 from dotenv import load_dotenv
 
+from .models.users import UsersTable
+from .models.spreadsheets import SpreadsheetsTable
+from .models.rows import RowsTable
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+def _mongo_uri():
+    """MONGODB_URI, либо URI, собранный из MONGO_HOST/MONGO_PORT/MONGO_USERNAME/MONGO_PASSWORD"""
+    uri = os.getenv('MONGODB_URI')
+    if uri:
+        return uri
+    host = os.getenv('MONGO_HOST') or 'localhost'
+    port = os.getenv('MONGO_PORT') or '27017'
+    username = os.getenv('MONGO_USERNAME')
+    password = os.getenv('MONGO_PASSWORD')
+    if username:
+        from urllib.parse import quote_plus
+        return f"mongodb://{quote_plus(username)}:{quote_plus(password or '')}@{host}:{port}"
+    return f"mongodb://{host}:{port}"
+
+
+def pool_options():
+    """Параметры пула соединений из переменных окружения"""
+    return {
+        'maxPoolSize': int(os.getenv('MONGO_MAX_POOL_SIZE', '100')),
+        'minPoolSize': int(os.getenv('MONGO_MIN_POOL_SIZE', '0')),
+        'maxIdleTimeMS': int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '300000')),
+        'waitQueueTimeoutMS': int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '10000')),
+        'serverSelectionTimeoutMS': int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '10000')),
+        'connectTimeoutMS': int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '10000')),
+        'socketTimeoutMS': int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '30000')),
+        'readPreference': os.getenv('MONGO_READ_PREFERENCE', 'primary'),
+    }
+
 
 class Database:
-    def __init__(self):
-        self.client = None
-        self.db = None
-        self.connect()
+    """Один общий асинхронный клиент (пул соединений motor) и репозитории коллекций"""
+
+    def __init__(self, uri=None, name=None, event_listeners=None, **options):
+        settings = pool_options()
+        settings.update(options)
+        if event_listeners:
+            settings['event_listeners'] = event_listeners
+        # motor подключается лениво: конструктор не делает сетевых вызовов
+        self.client = AsyncIOMotorClient(uri or _mongo_uri(), **settings)
+        self.db = self.client[name or os.getenv('MONGODB_DB') or os.getenv('DATABASE_NAME', 'sheets_db')]
 
         self.users = UsersTable(self.db)
         self.spreadsheets = SpreadsheetsTable(self.db)
         self.rows = RowsTable(self.db)
 
-    def connect(self):
-        try:
-            self.client = MongoClient(
-                host=os.getenv('MONGO_HOST', 'localhost'),
-                port=int(os.getenv('MONGO_PORT', 27017)),
-                username=os.getenv('MONGO_USERNAME'),
-                password=os.getenv('MONGO_PASSWORD')
-            )
+    async def ping(self):
+        await self.client.admin.command('ping')
 
-            self.client.admin.command('ping')
-            self.db = self.client[os.getenv('DATABASE_NAME', 'spreadsheet_app')]
-            print("✅ Успешное подключение к MongoDB")
+    async def init_indexes(self):
+        """Создание индексов при старте; повторный вызов ничего не меняет"""
+        for table in (self.users, self.spreadsheets, self.rows):
+            try:
+                await table.ensure_indexes()
+            except PyMongoError as e:
+                # например, дубликаты в старых данных мешают построить уникальный индекс
+                logger.error("Не удалось создать индексы %s: %s", table.collection.name, e)
 
-        except ConnectionFailure as e:
-            print(f"❌ Ошибка подключения к MongoDB: {e}")
-            raise
+    async def migrate_legacy_users(self):
+        """Пользователи из старой базы LEGACY_USERS_DB (по умолчанию users_db); пустое значение отключает перенос"""
+        name = os.getenv('LEGACY_USERS_DB', 'users_db')
+        legacy = self.client[name]['users'] if name and name != self.db.name else None
+        try:
+            moved = await self.users.import_legacy(legacy)
+        except PyMongoError as e:
+            logger.error("Не удалось перенести пользователей из %s: %s", name, e)
+            return 0
+        if moved:
+            logger.info("Перенесено пользователей из %s: %d", name, moved)
+        return moved
 
     def close(self):
-        if self.client:
-            self.client.close()
\ No newline at end of file
+        self.client.close()
+
+
+_shared = None
+
+
+def get_database(**kwargs):
+    """Общий экземпляр Database на процесс (один пул соединений для всех приложений)"""
+    global _shared
+    if _shared is None:
+        _shared = Database(**kwargs)
+    return _shared
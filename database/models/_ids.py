@@ -0,0 +1,12 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+
+
+def object_id(value):
+    """ObjectId из строки; идентификаторы другого вида (например, uuid из backend) возвращаются как есть"""
+    if isinstance(value, ObjectId):
+        return value
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return value
@@ -1,14 +1,15 @@
 from datetime import datetime
 
+from pymongo import ReturnDocument
+
 
 class RowsTable:
     def __init__(self, db):
         self.collection = db['rows']
-        self._create_indexes()
 
-    def _create_indexes(self):
+    async def ensure_indexes(self):
         """Индексы для быстрого поиска строк"""
-        self.collection.create_index([
+        await self.collection.create_index([
             ('spreadsheet_id', 1),
             ('row_index', 1)
         ], unique=True)
@@ -19,12 +20,12 @@ class RowsTable:
             return True
         return all(value is None or value == '' for value in cells.values())
 
-    def create_or_update_row(self, spreadsheet_id, row_index, cells_data, user_id):
+    async def create_or_update_row(self, spreadsheet_id, row_index, cells_data, user_id):
         """Создать или обновить строку (храним только если не пустая)"""
         # Проверяем, пустая ли строка после обновления
         if self._is_row_empty(cells_data):
             # Если строка пустая - удаляем её из БД если она существует
-            self.collection.delete_one({
+            await self.collection.delete_one({
                 'spreadsheet_id': spreadsheet_id,
                 'row_index': row_index
             })
@@ -39,7 +40,7 @@ class RowsTable:
                 'updated_by': user_id
             }
 
-            result = self.collection.replace_one(
+            result = await self.collection.replace_one(
                 {
                     'spreadsheet_id': spreadsheet_id,
                     'row_index': row_index
@@ -50,43 +51,58 @@ class RowsTable:
 
             return "created" if result.upserted_id else "updated"
 
-    def update_cell_value(self, spreadsheet_id, row_index, column, value, user_id):
-        """Обновить значение одной ячейки"""
-        # Сначала получаем текущую строку
-        current_row = self.collection.find_one({
-            'spreadsheet_id': spreadsheet_id,
-            'row_index': row_index
-        })
+    async def update_cell_value(self, spreadsheet_id, row_index, column, value, user_id):
+        """Обновить значение одной ячейки (один атомарный запрос вместо чтения и замены всей строки)"""
+        key = {'spreadsheet_id': spreadsheet_id, 'row_index': row_index}
+        meta = {'updated_at': datetime.utcnow(), 'updated_by': user_id}
 
-        cells_data = current_row['cells'] if current_row else {}
-        cells_data[column] = value
+        if value is None or value == '':
+            # Пустое значение не храним: убираем ячейку, строку не создаём
+            row = await self.collection.find_one_and_update(
+                key,
+                {'$unset': {f'cells.{column}': ''}, '$set': meta},
+                return_document=ReturnDocument.AFTER
+            )
+            if row is None:
+                return "deleted"
+            if self._is_row_empty(row.get('cells')):
+                # Удаляем, только если с тех пор никто не записал в строку
+                await self.collection.delete_one(dict(key, cells=row.get('cells', {})))
+                return "deleted"
+            return "updated"
 
-        # Используем общий метод для создания/обновления
-        return self.create_or_update_row(spreadsheet_id, row_index, cells_data, user_id)
+        row = await self.collection.find_one_and_update(
+            key,
+            {'$set': dict(meta, **{f'cells.{column}': value})},
+            projection={'_id': 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        return "created" if row is None else "updated"
 
-    def get_spreadsheet_rows(self, spreadsheet_id, skip=0, limit=100):
+    async def get_spreadsheet_rows(self, spreadsheet_id, skip=0, limit=100):
         """Получить заполненные строки таблицы"""
-        return list(self.collection.find(
+        return await self.collection.find(
             {'spreadsheet_id': spreadsheet_id}
-        ).sort('row_index', 1).skip(skip).limit(limit))
+        ).sort('row_index', 1).skip(skip).limit(limit).to_list(limit)
 
-    def get_row(self, spreadsheet_id, row_index):
+    async def get_row(self, spreadsheet_id, row_index):
         """Получить конкретную строку (только если она существует)"""
-        return self.collection.find_one({
+        return await self.collection.find_one({
             'spreadsheet_id': spreadsheet_id,
             'row_index': row_index
         })
 
-    def delete_row(self, spreadsheet_id, row_index):
+    async def delete_row(self, spreadsheet_id, row_index):
         """Удалить строку (просто удаляем из БД)"""
-        result = self.collection.delete_one({
+        result = await self.collection.delete_one({
             'spreadsheet_id': spreadsheet_id,
             'row_index': row_index
         })
         return result.deleted_count > 0
 
-    def get_filled_rows_count(self, spreadsheet_id):
+    async def get_filled_rows_count(self, spreadsheet_id):
         """Получить количество заполненных строк"""
-        return self.collection.count_documents({
+        return await self.collection.count_documents({
             'spreadsheet_id': spreadsheet_id
-        })
\ No newline at end of file
+        })
@@ -1,14 +1,17 @@
 from datetime import datetime
 
+from pymongo import ReturnDocument
+
+from ._ids import object_id
+
 
 class SpreadsheetsTable:
     def __init__(self, db):
         self.collection = db['spreadsheets']
-        self._create_indexes()
 
-    def _create_indexes(self):
-        self.collection.create_index('owner_id')
-        self.collection.create_index([('name', 1), ('owner_id', 1)])
+    async def ensure_indexes(self):
+        await self.collection.create_index('owner_id')
+        await self.collection.create_index([('name', 1), ('owner_id', 1)])
 
     def _generate_columns(self, count=26):
         """Генерация названий колонок: A, B, C, ..., Z, AA, AB, ..."""
@@ -52,7 +55,7 @@ class SpreadsheetsTable:
         # Для более длинных названий (если понадобится)
         return f"{last_column}_1"
 
-    def create_spreadsheet(self, spreadsheet_data):
+    async def create_spreadsheet(self, spreadsheet_data):
         """Создать новую таблицу с 26 колонками по умолчанию"""
         spreadsheet = {
             'name': spreadsheet_data['name'],
@@ -71,33 +74,31 @@ class SpreadsheetsTable:
             'is_public': False
         }
 
-        result = self.collection.insert_one(spreadsheet)
+        result = await self.collection.insert_one(spreadsheet)
         return str(result.inserted_id)
 
-    def get_user_spreadsheets(self, user_id):
+    async def get_user_spreadsheets(self, user_id):
         """Получить все таблицы пользователя"""
-        return list(self.collection.find({
+        return await self.collection.find({
             '$or': [
                 {'owner_id': user_id},
                 {'shared_with': user_id}
             ]
-        }))
+        }).to_list(None)
 
-    def add_column(self, spreadsheet_id):
+    async def add_column(self, spreadsheet_id):
         """Добавить новую колонку с автоматическим названием"""
-        from bson import ObjectId
-
         # Сначала получаем текущие колонки
-        spreadsheet = self.collection.find_one({'_id': ObjectId(spreadsheet_id)})
+        spreadsheet = await self.collection.find_one({'_id': object_id(spreadsheet_id)}, {'columns': 1})
         if not spreadsheet:
             return None
 
         current_columns = spreadsheet.get('columns', [])
         next_column = self._get_next_column_name(current_columns)
 
-        # Добавляем новую колонку
-        result = self.collection.update_one(
-            {'_id': ObjectId(spreadsheet_id)},
+        # Добавляем колонку, только если список не изменился с момента чтения
+        result = await self.collection.update_one(
+            {'_id': object_id(spreadsheet_id), 'columns': current_columns},
             {
                 '$push': {'columns': next_column},
                 '$set': {'updated_at': datetime.utcnow()}
@@ -106,12 +107,10 @@ class SpreadsheetsTable:
 
         return next_column if result.modified_count > 0 else None
 
-    def add_rows(self, spreadsheet_id, count=1):
+    async def add_rows(self, spreadsheet_id, count=1):
         """Добавить новые пустые строки (увеличиваем счетчик)"""
-        from bson import ObjectId
-
-        result = self.collection.update_one(
-            {'_id': ObjectId(spreadsheet_id)},
+        result = await self.collection.update_one(
+            {'_id': object_id(spreadsheet_id)},
             {
                 '$inc': {'metadata.max_rows': count},
                 '$set': {'updated_at': datetime.utcnow()}
@@ -120,20 +119,28 @@ class SpreadsheetsTable:
 
         return result.modified_count > 0
 
-    def get_spreadsheet_info(self, spreadsheet_id):
-        """Получить информацию о таблице (без строк)"""
-        from bson import ObjectId
-        return self.collection.find_one({'_id': ObjectId(spreadsheet_id)})
+    async def insert_sheet(self, doc):
+        """Сохранить готовый документ таблицы (backend создаёт его сам, с uuid в _id)"""
+        await self.collection.insert_one(doc)
+        return doc['_id']
 
-    def update_metadata(self, spreadsheet_id, metadata_updates):
-        """Обновить метаданные таблицы"""
-        from bson import ObjectId
+    async def get_spreadsheet_info(self, spreadsheet_id, projection=None):
+        """Получить информацию о таблице (без строк); projection — только нужные поля"""
+        return await self.collection.find_one({'_id': object_id(spreadsheet_id)}, projection)
+
+    async def next_event_seq(self, spreadsheet_id, projection=None):
+        """Увеличить счётчик событий таблицы; возвращает документ после изменения или None"""
+        return await self.collection.find_one_and_update(
+            {'_id': object_id(spreadsheet_id)}, {'$inc': {'event_seq': 1}},
+            projection=projection, return_document=ReturnDocument.AFTER)
 
+    async def update_metadata(self, spreadsheet_id, metadata_updates):
+        """Обновить метаданные таблицы"""
         update_fields = {f'metadata.{k}': v for k, v in metadata_updates.items()}
         update_fields['updated_at'] = datetime.utcnow()
 
-        result = self.collection.update_one(
-            {'_id': ObjectId(spreadsheet_id)},
+        result = await self.collection.update_one(
+            {'_id': object_id(spreadsheet_id)},
             {'$set': update_fields}
         )
 
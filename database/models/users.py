@@ -1,45 +1,76 @@
 from datetime import datetime
 
+from pymongo.errors import PyMongoError
+
+from ._ids import object_id
+
 
 class UsersTable:
     def __init__(self, db):
         self.collection = db['users']
-        self._create_indexes()
 
-    def _create_indexes(self):
-        self.collection.create_index('email', unique=True)
-        self.collection.create_index('username', unique=True)
+    async def ensure_indexes(self):
+        # email необязателен, поэтому уникальность проверяем только у заполненных
+        await self.collection.create_index(
+            'email', unique=True, partialFilterExpression={'email': {'$type': 'string'}})
+        await self.collection.create_index('username', unique=True)
 
-    def create_user(self, user_data):
+    async def create_user(self, user_data):
         user = {
             'username': user_data['username'],
-            'email': user_data['email'],
             'password_hash': user_data['password_hash'],
             'created_at': datetime.utcnow(),
             'updated_at': datetime.utcnow(),
             'is_active': True
         }
+        if user_data.get('email'):
+            user['email'] = user_data['email']
 
         try:
-            result = self.collection.insert_one(user)
+            result = await self.collection.insert_one(user)
             return str(result.inserted_id)
-        except Exception as e:
+        except PyMongoError as e:
             print(f"Ошибка создания пользователя: {e}")
             return None
 
-    def get_user_by_email(self, email):
-        return self.collection.find_one({'email': email})
+    async def import_legacy(self, legacy=None):
+        """
+        Перенос пользователей, созданных до общей базы (коллекция legacy, пароль в поле password).
+        Логин, уже занятый в общей коллекции, не трогаем. Возвращает число перенесённых.
+        """
+        moved = 0
+        if legacy is not None:
+            async for old in legacy.find({}):
+                password_hash = old.get('password_hash') or old.get('password')
+                if not old.get('username') or not password_hash:
+                    continue
+                now = datetime.utcnow()
+                result = await self.collection.update_one(
+                    {'username': old['username']},
+                    {'$setOnInsert': {'_id': old['_id'], 'password_hash': password_hash, 'created_at': now,
+                                      'updated_at': now, 'is_active': True}},
+                    upsert=True)
+                if result.upserted_id is not None:
+                    moved += 1
+        # старые документы в самой общей коллекции (если база та же)
+        result = await self.collection.update_many(
+            {'password': {'$exists': True}, 'password_hash': {'$exists': False}}, {'$rename': {'password': 'password_hash'}})
+        return moved + result.modified_count
+
+    async def get_user_by_email(self, email):
+        return await self.collection.find_one({'email': email})
+
+    async def get_user_by_username(self, username):
+        return await self.collection.find_one({'username': username})
 
-    def get_user_by_id(self, user_id):
-        from bson import ObjectId
-        return self.collection.find_one({'_id': ObjectId(user_id)})
+    async def get_user_by_id(self, user_id):
+        return await self.collection.find_one({'_id': object_id(user_id)})
 
-    def update_user(self, user_id, update_data):
-        from bson import ObjectId
+    async def update_user(self, user_id, update_data):
         update_data['updated_at'] = datetime.utcnow()
 
-        result = self.collection.update_one(
-            {'_id': ObjectId(user_id)},
+        result = await self.collection.update_one(
+            {'_id': object_id(user_id)},
             {'$set': update_data}
         )
-        return result.modified_count > 0
\ No newline at end of file
+        return result.modified_count > 0
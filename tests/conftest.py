@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def db():
+    """Empty in-memory database (mongomock-motor)."""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import mongomock.collection
+    # pymongo >= 4.9 passes sort= (and friends) to bulk builders that mongomock doesn't know yet
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ("add_update", "add_replace", "add_delete", "add_insert"):
+        method = getattr(builder, name, None)
+        if method is not None and not getattr(method, "_drops_kwargs", False):
+            def wrapper(self, *args, _method=method, **kwargs):
+                for key in ("sort", "hint", "collation", "namespace"):
+                    kwargs.pop(key, None)
+                return _method(self, *args, **kwargs)
+            wrapper._drops_kwargs = True
+            setattr(builder, name, wrapper)
+    return mongomock_motor.AsyncMongoMockClient()["noexcel_test"]
+
+
+@pytest.fixture
+def app_db(db, monkeypatch):
+    """`db` behind main: its raw handle and the repositories it reads sheets through."""
+    import main
+    from database import UsersTable, SpreadsheetsTable, RowsTable
+    monkeypatch.setattr(main, "db", db)
+    for name, table in (("users", UsersTable), ("spreadsheets", SpreadsheetsTable), ("rows", RowsTable)):
+        monkeypatch.setattr(main.database, name, table(db))
+    return db
@@ -0,0 +1,72 @@
+import asyncio
+
+from aggregates import AggregateCache, run
+
+SUM_B = {"aggregates": [{"op": "sum", "column": "B"}]}
+COUNT_C = {"aggregates": [{"op": "count", "column": "C"}], "filters": [{"column": "A", "value": "x"}]}
+
+
+def num(value):
+    return {"type": "number", "value": value}
+
+
+def test_write_drops_only_entries_reading_the_column(db):
+    async def scenario():
+        await db.rows.insert_many([
+            {"_id": "r1", "spreadsheet_id": "s", "row_index": 1, "cells": {"A": {"type": "string", "value": "x"},
+                                                                           "B": num(2), "C": num(1)}},
+            {"_id": "r2", "spreadsheet_id": "s", "row_index": 2, "cells": {"B": num(3)}},
+        ])
+        cache = AggregateCache(max_entries=10, ttl=0)
+        assert (await run(db, cache, "s", SUM_B)) == {"result": {"sum_B": 5}, "cached": False}
+        assert (await run(db, cache, "s", COUNT_C))["result"] == {"count_C": 1}
+        assert (await run(db, cache, "s", SUM_B))["cached"]
+
+        cache.invalidate_columns("s", {"A"})
+        # the filter on A counts as a read
+        assert not (await run(db, cache, "s", COUNT_C))["cached"]
+        assert (await run(db, cache, "s", SUM_B))["cached"]
+
+        await db.rows.update_one({"_id": "r2"}, {"$set": {"cells.B": num(10)}})
+        cache.invalidate_columns("s", ["B"])
+        assert (await run(db, cache, "s", SUM_B)) == {"result": {"sum_B": 12}, "cached": False}
+        assert (await run(db, cache, "s", COUNT_C))["cached"]
+
+        cache.invalidate_sheet("s")
+        assert cache.stats()["entries"] == 0
+    asyncio.run(scenario())
+
+
+def test_result_read_before_a_write_is_not_stored():
+    cache = AggregateCache(max_entries=10, ttl=0)
+    generation = cache.generation("s")
+    cache.invalidate_columns("s", {"Z"})
+    cache.put("s", "k", {"result": {}}, {"B"}, generation)
+    assert cache.get("s", "k") is None
+    cache.put("s", "k", {"result": {}}, {"B"}, cache.generation("s"))
+    assert cache.get("s", "k") == {"result": {}}
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AggregateCache(max_entries=2, ttl=0)
+    cache.put("s", "a", 1, {"A"}, 0)
+    cache.put("s", "b", 2, {"B"}, 0)
+    assert cache.get("s", "a") == 1
+    cache.put("t", "c", 3, {"C"}, 0)
+    assert cache.get("s", "b") is None
+    assert cache.get("s", "a") == 1 and cache.get("t", "c") == 3
+    # the evicted key is gone from the sheet index too
+    cache.invalidate_sheet("s")
+    assert cache.invalidations == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    import aggregates
+    now = [100.0]
+    monkeypatch.setattr(aggregates.time, "monotonic", lambda: now[0])
+    cache = AggregateCache(max_entries=10, ttl=2)
+    cache.put("s", "k", 1, {"A"}, 0)
+    now[0] += 1
+    assert cache.get("s", "k") == 1
+    now[0] += 2
+    assert cache.get("s", "k") is None
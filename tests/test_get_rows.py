@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from columns import parse_column_spec
+from row_cache import RowCache
+
+
+def text(value):
+    return {"type": "string", "value": value}
+
+
+@pytest.fixture
+def sheet(db, app_db, monkeypatch):
+    """Sheet "s" with rows 1-5, cells A-E holding "<col><row>"."""
+    monkeypatch.setattr(main, "row_cache", RowCache())
+
+    async def setup():
+        await db.spreadsheets.insert_one({"_id": "s", "title": "t"})
+        await db.rows.insert_many([{"_id": f"r{i}", "spreadsheet_id": "s", "row_index": i, "version": 1,
+                                    "cells": {c: text(f"{c}{i}") for c in "ABCDE"}} for i in range(1, 6)])
+    asyncio.run(setup())
+    return db
+
+
+def test_parse_column_spec():
+    assert parse_column_spec("a, C,F:H,c") == ["A", "C", "F", "G", "H"]
+    for bad in ("H:F", "A,?"):
+        with pytest.raises(ValueError):
+            parse_column_spec(bad)
+
+
+def test_columns_are_projected_with_or_without_the_cache(sheet):
+    async def scenario():
+        loaded = await main.get_rows("s", 2, 3, columns="B,D")
+        assert [(r["row_index"], r["cells"]) for r in loaded] == [(2, {"B": text("B2"), "D": text("D2")}),
+                                                                   (3, {"B": text("B3"), "D": text("D3")})]
+        await main.get_rows("s", 1, 5)
+        # the window is cached now, so the projection filters the cached rows
+        assert await main.get_rows("s", 2, 3, columns="B,D") == loaded
+        with pytest.raises(HTTPException) as e:
+            await main.get_rows("s", 1, 5, columns="Q:A")
+        assert e.value.status_code == 400
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("stream", ["ndjson", "json"])
+def test_streamed_rows(sheet, stream, monkeypatch):
+    # small chunks, so three rows span several
+    monkeypatch.setattr(main, "STREAM_CHUNK_BYTES", 100)
+
+    async def scenario():
+        response = await main.get_rows("s", 2, 4, columns="A", stream=stream)
+        return [chunk async for chunk in response.body_iterator]
+    chunks = asyncio.run(scenario())
+    assert len(chunks) > 1
+    body = "".join(chunks)
+    rows = [json.loads(line) for line in body.splitlines()] if stream == "ndjson" else json.loads(body)
+    assert rows == [{"row_index": i, "cells": {"A": text(f"A{i}")}, "version": 1} for i in (2, 3, 4)]
@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import history
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def text(value):
+    return {"type": "string", "value": value}
+
+
+def update(seq, version, changes, created_at):
+    return {"_id": f"c{seq}", "spreadsheet_id": "s", "row_id": "r1", "row_index": 1, "op_type": "update_cells",
+            "payload": {"changes": changes, "prev_version": version - 1, "new_version": version},
+            "version": version, "seq": seq, "created_at": created_at}
+
+
+async def edited_row(db):
+    """r1: inserted at seq 1, A edited at seq 2, B set at seq 3, A cleared at seq 4."""
+    await db.rows.insert_one({"_id": "r1", "spreadsheet_id": "s", "row_index": 1, "version": 4,
+                              "cells": {"B": text("b")}, "updated_at": "2024-01-04T00:00:00"})
+    await db.changes.insert_many([
+        {"_id": "c1", "spreadsheet_id": "s", "row_id": "r1", "row_index": 1, "op_type": "insert_row",
+         "payload": {"row_index": 1, "cells": {"A": text("a1")}}, "version": 1, "seq": 1,
+         "created_at": "2024-01-01T00:00:00"},
+        update(2, 2, {"A": {"old": text("a1"), "new": text("a2")}}, "2024-01-02T00:00:00"),
+        update(3, 3, {"B": {"old": None, "new": text("b")}}, "2024-01-03T00:00:00"),
+        update(4, 4, {"A": {"old": text("a2"), "new": None}}, "2024-01-04T00:00:00"),
+    ])
+
+
+def test_replayed_row_updates_carry_the_full_row(db):
+    async def scenario():
+        await edited_row(db)
+        events = await history.events_since(db, "s", 1, 3, 100)
+        assert events == [
+            {"seq": 2, "type": "row_updated", "row": {"row_index": 1, "cells": {"A": text("a2")}, "version": 2},
+             "changed": ["A"]},
+            {"seq": 3, "type": "row_updated", "row": {"row_index": 1, "cells": {"A": text("a2"), "B": text("b")},
+                                                      "version": 3}, "changed": ["B"]},
+        ]
+        last = await history.events_since(db, "s", 3, 4, 100)
+        assert last[0]["row"]["cells"] == {"B": text("b")} and last[0]["changed"] == ["A"]
+    run(scenario())
+
+
+def test_row_state_at_walks_back_from_the_current_row(db):
+    async def scenario():
+        await edited_row(db)
+        assert await history.row_state_at(db, "s", "r1", "2023-12-31T00:00:00") is None
+        assert await history.row_state_at(db, "s", "r1", "2024-01-02T12:00:00") == {"cells": {"A": text("a2")},
+                                                                                  "version": 2}
+        assert await history.row_state_at(db, "s", "r1", "2024-01-05T00:00:00") == {"cells": {"B": text("b")},
+                                                                                  "version": 4}
+    run(scenario())
+
+
+def test_timestamps_with_an_offset_are_compared_in_utc(db):
+    async def scenario():
+        await edited_row(db)
+        # 2024-01-02T01:00:00+02:00 is 2024-01-01T23:00:00 UTC: before the A edit
+        state = await history.row_state_at(db, "s", "r1", "2024-01-02T01:00:00+02:00")
+        assert state == {"cells": {"A": text("a1")}, "version": 1}
+        state = await history.row_state_at(db, "s", "r1", "2024-01-02T00:00:00Z")
+        assert state == {"cells": {"A": text("a2")}, "version": 2}
+        with pytest.raises(ValueError):
+            await history.row_state_at(db, "s", "r1", "yesterday")
+    run(scenario())
+
+
+def test_compaction_keeps_the_creation_record(db):
+    async def scenario():
+        await edited_row(db)
+        assert await history.compact_row(db, "s", "r1", "2024-01-03T12:00:00") == 2
+        remaining = [c["_id"] async for c in db.changes.find({}).sort("seq", 1)]
+        assert remaining == ["c1", "c4"]
+        assert await history.row_state_at(db, "s", "r1", "2023-12-31T00:00:00") is None
+        assert (await history.row_state_at(db, "s", "r1", "2024-01-03T12:00:00"))["cells"] == {
+            "A": text("a2"), "B": text("b")}
+        assert (await history.row_state_at(db, "s", "r1", "2024-01-05T00:00:00"))["cells"] == {"B": text("b")}
+    run(scenario())
+
+
+def test_deleted_rows_are_compacted(db):
+    async def scenario():
+        await edited_row(db)
+        await db.rows.delete_one({"_id": "r1"})
+        await db.changes.insert_one({"_id": "c5", "spreadsheet_id": "s", "row_id": "r1", "row_index": 1,
+                                     "op_type": "delete_row", "payload": {"row_index": 1, "cells": {"B": text("b")}},
+                                     "version": 5, "seq": 5, "created_at": "2024-01-05T00:00:00"})
+        # history of a deleted row stays readable
+        assert (await history.row_state_at(db, "s", "r1", "2024-01-02T12:00:00"))["cells"] == {"A": text("a2")}
+        result = await history.compact_sheet(db, "s", 0)
+        assert result["rows"] == 1 and result["deleted_changes"] == 3
+        assert [c["_id"] async for c in db.changes.find({}).sort("seq", 1)] == ["c1", "c5"]
+        assert await history.row_state_at(db, "s", "r1", "2023-12-31T00:00:00") is None
+        assert await history.row_state_at(db, "s", "r1", "2024-01-04T12:00:00") == {"cells": {"B": text("b")},
+                                                                                  "version": 4}
+        assert await history.row_state_at(db, "s", "r1", "2024-01-06T00:00:00") is None
+    run(scenario())
@@ -0,0 +1,104 @@
+import asyncio
+import os
+
+import openpyxl
+import pytest
+from fastapi import HTTPException
+
+import jobs
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_jobs_queue_for_a_slot_and_are_bounded():
+    async def scenario():
+        runner = jobs.JobRunner(workers=1, max_pending=2, keep_finished=1)
+        gate = asyncio.Event()
+
+        async def blocked(state):
+            state["progress"]["rows"] = 1
+            await gate.wait()
+            return "first"
+
+        async def failing(state):
+            raise RuntimeError("boom")
+
+        first = runner.submit("export", blocked, spreadsheet_id="s")
+        second = runner.submit("export", failing)
+        with pytest.raises(HTTPException) as e:
+            runner.submit("export", blocked)
+        assert e.value.status_code == 429
+        await asyncio.sleep(0)
+        assert (first["status"], second["status"]) == ("running", "queued")
+        assert first["spreadsheet_id"] == "s" and first["progress"]["rows"] == 1
+        job_dir = runner.job_dir(first["job_id"])
+        gate.set()
+        await runner.wait(first["job_id"])
+        assert runner.get(second["job_id"]) is second
+        await runner.wait(second["job_id"])
+        assert (first["status"], first["result"]) == ("done", "first")
+        assert (second["status"], second["error"]) == ("failed", "boom")
+        # only the last finished job is kept; the evicted one's files are removed
+        assert runner.get(first["job_id"]) is None and not os.path.exists(job_dir)
+        assert runner.list_active() == []
+        runner.shutdown()
+    run(scenario())
+
+
+def test_import_batches_parse_in_the_pool(tmp_path):
+    path = str(tmp_path / "in.xlsx")
+    wb = openpyxl.Workbook()
+    for i in range(1, 8):
+        wb.active.append([i, f"r{i}"])
+    wb.save(path)
+
+    async def scenario():
+        runner = jobs.JobRunner(workers=1)
+        try:
+            rows = [len(b) async for b in runner.import_batches("rows", path, "s", 3)]
+            tiled = [d async for b in runner.import_batches("tiled", path, "t", 4, tile_rows=4) for d in b]
+            with pytest.raises(Exception):
+                async for _ in runner.import_batches("bad", str(tmp_path / "missing.xlsx"), "u", 3):
+                    pass
+        finally:
+            runner.shutdown()
+        return rows, tiled
+    rows, tiled = run(scenario())
+    assert rows == [3, 3, 1]
+    assert [(d["_id"], d["versions"]) for d in tiled] == [("t:0", [1, 1, 1, 1]), ("t:1", [1, 1, 1, 0])]
+    assert tiled[1]["cols"]["B"] == ["r5", "r6", "r7", None]
+
+
+def test_export_file_builds_the_workbook_in_the_pool():
+    async def rows():
+        for i in (1, 2, 4):
+            yield {"position": i, "cells": {"A": {"type": "number", "value": i}}}
+
+    async def scenario():
+        runner = jobs.JobRunner(workers=1)
+        try:
+            progress = {"rows": 0}
+            path = await runner.export_file("job", rows(), "Sheet", progress)
+            wb = openpyxl.load_workbook(path)
+            return progress, [[c.value for c in r] for r in wb.active.iter_rows()]
+        finally:
+            runner.shutdown()
+    progress, values = run(scenario())
+    assert progress == {"rows": 3, "phase": "writing"}
+    assert values == [[1], [2], [None], [4]]
+
+
+def test_gather_all_lets_every_task_finish():
+    finished = []
+
+    async def work(n):
+        await asyncio.sleep(0.01 * n)
+        if n == 0:
+            raise ValueError(n)
+        finished.append(n)
+
+    with pytest.raises(ValueError):
+        run(jobs.gather_all(*(work(n) for n in range(3))))
+    assert finished == [1, 2]
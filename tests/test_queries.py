@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import queries
+
+VALUES = {1: 5, 2: "b", 3: None, 4: True, 5: 2.5, 6: "a", 7: {"x": 1}, 8: 5, 9: False, 10: "MISSING", 11: "b"}
+# Mongo's type brackets: null/missing, numbers, strings, objects, booleans; ties by row_index
+ASCENDING = [3, 10, 5, 1, 8, 6, 2, 11, 7, 9, 4]
+
+
+async def sheet(db):
+    await db.rows.insert_many([
+        {"_id": f"r{i}", "spreadsheet_id": "s", "row_index": i, "version": 1,
+         "cells": {"B": {"type": "string", "value": str(i)}} if value == "MISSING"
+         else {"A": {"type": "json" if isinstance(value, dict) else "number", "value": value}}}
+        for i, value in VALUES.items()])
+
+
+async def pages(db, spec, limit):
+    order, cursor = [], None
+    while True:
+        result = await queries.run(db, queries.ColumnIndexes(mode="off"), "s", dict(spec, limit=limit, cursor=cursor))
+        order += [r["row_index"] for r in result["rows"]]
+        cursor = result["next_cursor"]
+        if cursor is None:
+            return order
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 20])
+def test_sorted_pages_cross_type_brackets(db, limit):
+    async def scenario():
+        await sheet(db)
+        assert await pages(db, {"sort": "A"}, limit) == ASCENDING
+        # descending: brackets reversed, ties still broken by row_index (descending too)
+        assert await pages(db, {"sort": "-A"}, limit) == [4, 9, 7, 11, 2, 6, 8, 1, 5, 10, 3]
+    asyncio.run(scenario())
+
+
+def test_filters_compare_within_the_value_bracket(db):
+    async def scenario():
+        await sheet(db)
+        assert await pages(db, {"where": [{"column": "A", "op": "gt", "value": 1}], "sort": "A"}, 2) == [5, 1, 8]
+        assert await pages(db, {"where": [{"column": "A", "op": "prefix", "value": "b"}]}, 1) == [2, 11]
+        assert await pages(db, {"where": [{"column": "A", "op": "exists", "value": False}]}, 5) == [3, 10]
+    asyncio.run(scenario())
+
+
+def test_cursor_belongs_to_its_query(db):
+    async def scenario():
+        await sheet(db)
+        first = await queries.run(db, queries.ColumnIndexes(mode="off"), "s", {"sort": "A", "limit": 1})
+        with pytest.raises(ValueError):
+            await queries.run(db, queries.ColumnIndexes(mode="off"), "s",
+                              {"sort": "-A", "limit": 1, "cursor": first["next_cursor"]})
+    asyncio.run(scenario())
+
+
+def test_hot_columns_get_an_index(db):
+    async def scenario():
+        await sheet(db)
+        indexes = queries.ColumnIndexes(mode="column", after=2, max_indexes=1)
+        for sort in ("A", "A", "B", "B"):
+            await queries.run(db, indexes, "s", {"sort": sort})
+            await asyncio.sleep(0)
+        assert indexes.stats()["indexed"] == ["A"] and indexes.uses["B"] == 2
+        names = [ix["name"] async for ix in db.rows.list_indexes()]
+        assert "query_A" in names and "query_B" not in names
+        # another instance picks it up
+        loaded = queries.ColumnIndexes(mode="column")
+        await loaded.load(db)
+        assert loaded.indexed == {"A"}
+    asyncio.run(scenario())
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def text(value):
+    return {"type": "string", "value": value}
+
+
+@pytest.fixture
+def sheet(db, app_db, monkeypatch):
+    """Sheet "s" with rows 1-3 at version 1, and a hook that runs right before the range's bulk_write."""
+    hooks = []
+    collection = type(db.rows)
+    bulk_write = collection.bulk_write
+
+    async def racing_bulk_write(self, *args, **kwargs):
+        while hooks:
+            await hooks.pop()()
+        return await bulk_write(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection, "bulk_write", racing_bulk_write)
+
+    async def setup():
+        await db.spreadsheets.insert_one({"_id": "s", "event_seq": 0})
+        await db.rows.insert_many([{"_id": f"r{i}", "spreadsheet_id": "s", "row_index": i, "order_key": f"k{i}",
+                                    "version": 1, "cells": {"A": text(f"a{i}")}} for i in (1, 2, 3)])
+    asyncio.run(setup())
+    return hooks
+
+
+def concurrent_edit(db):
+    async def edit():
+        await db.rows.update_one({"_id": "r2"}, {"$set": {"cells.A": text("other")}, "$inc": {"version": 1}})
+    return edit
+
+
+def write(values, expected=None):
+    req = main.RangeWriteReq(start_row=1, start_col="A", values=values, user_id="u", expected_versions=expected)
+
+    async def scenario():
+        # broadcasts go to the in-process bus
+        await main.manager.start()
+        return await main.write_range("s", req)
+    return asyncio.run(scenario())
+
+
+def test_row_changed_after_the_read_is_written_on_top(db, sheet):
+    sheet.append(concurrent_edit(db))
+    result = write([["x1"], ["x2"], ["x3"]])
+    assert result["rows"] == [{"row_index": 1, "version": 2}, {"row_index": 2, "version": 3},
+                              {"row_index": 3, "version": 2}]
+
+    async def check():
+        row = await db.rows.find_one({"_id": "r2"})
+        assert row["version"] == 3 and row["cells"]["A"] == text("x2")
+        change = await db.changes.find_one({"row_id": "r2"})
+        # the record describes what the range actually overwrote
+        assert change["payload"]["changes"]["A"]["old"] == text("other")
+        assert change["payload"]["prev_version"] == 2 and change["version"] == 3
+    asyncio.run(check())
+
+
+def test_stale_expected_version_is_a_conflict_after_the_read(db, sheet):
+    sheet.append(concurrent_edit(db))
+    with pytest.raises(HTTPException) as e:
+        write([["x1"], ["x2"], ["x3"]], expected={1: 1, 2: 1})
+    assert e.value.status_code == 409
+    assert e.value.detail["rows"] == {2: 2}
+    assert e.value.detail["written"] == [{"row_index": 1, "version": 2}, {"row_index": 3, "version": 2}]
+
+    async def check():
+        row = await db.rows.find_one({"_id": "r2"})
+        assert row["version"] == 2 and row["cells"]["A"] == text("other")
+        assert await db.changes.count_documents({"row_id": "r2"}) == 0
+        assert await db.changes.count_documents({}) == 2
+    asyncio.run(check())
+
+
+def test_expected_version_checked_against_the_read(db, sheet):
+    with pytest.raises(HTTPException) as e:
+        write([["x1"]], expected={1: 5})
+    assert e.value.status_code == 409 and e.value.detail["rows"] == {1: 1}
@@ -0,0 +1,160 @@
+import asyncio
+import json
+
+from broadcast_bus import InProcessBus
+from realtime import ConnectionManager, ReplayBuffer, encode, frame_seq, stamp
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FakeSocket:
+    def __init__(self, gate=None):
+        self.sent = []
+        # sends wait for the gate when it is set, like a client that stopped reading
+        self.gate = gate
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame):
+        if self.gate is not None:
+            await self.gate.wait()
+        self.sent.append(frame)
+
+
+class SlowBus(InProcessBus):
+    """(Un)subscribes wait for `gate` when it is set; tracks how many overlap."""
+
+    def __init__(self):
+        super().__init__()
+        self.subscribed = 0
+        self.gate = None
+        self.in_flight = self.max_in_flight = 0
+
+    async def _slow(self, delta):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.gate is not None:
+            await self.gate.wait()
+        self.subscribed += delta
+        self.in_flight -= 1
+
+    async def subscribe(self, sheet_id):
+        await self._slow(1)
+
+    async def unsubscribe(self, sheet_id):
+        await self._slow(-1)
+
+
+def test_sheet_lock_outlives_a_disconnect_with_waiters():
+    async def scenario():
+        bus = SlowBus()
+        manager = ConnectionManager(bus=bus)
+        await manager.start()
+        first = FakeSocket()
+        await manager.connect("s", first)
+        bus.gate = asyncio.Event()
+        # the last socket leaves while others join: their subscribe must wait for the unsubscribe
+        tasks = [asyncio.create_task(manager.disconnect("s", first))]
+        tasks += [asyncio.create_task(manager.connect("s", FakeSocket())) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        bus.gate.set()
+        await asyncio.gather(*tasks)
+        assert bus.max_in_flight == 1
+        assert bus.subscribed == 1 and len(manager.connections["s"]) == 2
+        for ws in list(manager.connections["s"]):
+            await manager.disconnect("s", ws)
+        assert bus.subscribed == 0 and manager._locks == {} and manager.connections == {}
+    run(scenario())
+
+
+async def stalled_client(policy):
+    """A manager with queue_size=3, a stalled socket and a reading one; 6 events broadcast."""
+    manager = ConnectionManager(queue_size=3, policy=policy)
+    await manager.start()
+    stalled, reading = FakeSocket(asyncio.Event()), FakeSocket()
+    await manager.connect("s", stalled)
+    await manager.connect("s", reading)
+    # the stalled writer takes the first event off the queue and blocks sending it
+    await manager.broadcast("s", {"type": "e", "n": 1})
+    await asyncio.sleep(0)
+    for n in range(2, 7):
+        await manager.broadcast("s", {"type": "e", "n": n})
+        await asyncio.sleep(0)
+    stalled.gate.set()
+    await asyncio.sleep(0.01)
+    return manager, [json.loads(f) for f in stalled.sent], [json.loads(f)["n"] for f in reading.sent]
+
+
+def test_full_queue_is_replaced_by_a_resync():
+    async def scenario():
+        manager, stalled, reading = await stalled_client("resync")
+        assert reading == [1, 2, 3, 4, 5, 6]
+        # events 2-4 filled the queue; 5 discards them for a resync, 6 fits behind it
+        assert stalled == [{"seq": 1, "type": "e", "n": 1}, {"type": "resync", "reason": "lagging"},
+                           {"seq": 6, "type": "e", "n": 6}]
+        assert manager.resyncs == 1 and manager.dropped == 4
+    run(scenario())
+
+
+def test_full_queue_drops_new_events():
+    async def scenario():
+        manager, stalled, reading = await stalled_client("drop")
+        assert reading == [1, 2, 3, 4, 5, 6]
+        assert [e["n"] for e in stalled] == [1, 2, 3, 4]
+        assert manager.resyncs == 0 and manager.dropped == 2
+    run(scenario())
+
+
+def frame(seq, size=0):
+    return encode(stamp(seq, {"type": "e", "pad": "x" * size}))
+
+
+def test_replay_buffer_answers_only_without_gaps():
+    replay = ReplayBuffer(size=3, max_bytes=10 ** 6, max_sheets=2)
+    for seq in range(1, 6):
+        replay.add("s", seq, frame(seq))
+    assert [frame_seq(f) for f in replay.since("s", 2, 5)] == [3, 4, 5]
+    assert replay.since("s", 5, 5) == []
+    # seq 2 fell out of the buffer
+    assert replay.since("s", 1, 5) is None
+    assert (replay.hits, replay.misses) == (2, 1)
+    replay.add("t", 1, frame(1))
+    replay.add("u", 1, frame(1))
+    # least recently written sheet is dropped first
+    assert replay.since("s", 4, 5) is None and replay.since("t", 0, 1) is not None
+
+
+def test_replay_buffer_byte_bound():
+    replay = ReplayBuffer(size=100, max_bytes=len(frame(1, 50)) * 2, max_sheets=10)
+    for seq in range(1, 4):
+        replay.add("s", seq, frame(seq, 50))
+    assert replay.since("s", 1, 3) is not None and replay.since("s", 0, 3) is None
+
+
+def test_resume_replays_missed_events_from_the_buffer(app_db, monkeypatch):
+    import main
+    # frames other tests broadcast to their sheet "s"
+    monkeypatch.setattr(main.manager, "replay", ReplayBuffer())
+
+    async def scenario():
+        await main.manager.start()
+        await app_db.spreadsheets.insert_one({"_id": "s", "title": "t"})
+        ws = FakeSocket()
+        sub = await main.manager.connect("s", ws)
+        try:
+            for n in range(1, 4):
+                await main.manager.broadcast("s", {"type": "e", "n": n})
+            assert await main.resume("s", sub, 1) == {"source": "buffer", "events": 2}
+            assert await main.resume("s", sub, 7) == {"source": "reload", "events": 0}
+            assert await main.resume("s", sub, "1") == {"source": "reload", "events": 0}
+            await asyncio.sleep(0.01)
+        finally:
+            await main.manager.disconnect("s", ws)
+        replay, reload, _ = [json.loads(f) for f in ws.sent[3:]]
+        assert replay["type"] == "replay" and replay["seq"] == 3 and replay["source"] == "buffer"
+        assert [(e["seq"], e["n"]) for e in replay["events"]] == [(2, 2), (3, 3)]
+        assert reload == {"type": "reload", "reason": "gap_too_large", "seq": 3}
+    run(scenario())
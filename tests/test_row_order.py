@@ -0,0 +1,92 @@
+import asyncio
+import io
+import uuid
+
+import openpyxl
+
+import main
+import row_order
+import xlsx_export
+from row_order import key_for_index, keys_between
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def make_sheet(db, row_indexes):
+    sheet = {"_id": str(uuid.uuid4())}
+    await db.spreadsheets.insert_one(sheet)
+    await db.rows.insert_many([{"_id": str(uuid.uuid4()), "spreadsheet_id": sheet["_id"], "row_index": i,
+                                "order_key": key_for_index(i)} for i in row_indexes])
+    return sheet
+
+
+async def insert_by_index(db, sheet, row_indexes):
+    keys = await row_order.keys_for_indexes(db, sheet, row_indexes)
+    await db.rows.insert_many([{"_id": str(uuid.uuid4()), "spreadsheet_id": sheet["_id"], "row_index": i,
+                                "order_key": keys[i]} for i in row_indexes])
+
+
+async def display(db, sheet):
+    return [(r["row_index"], r["order_key"])
+            async for r in row_order.ordered_cursor(db, sheet["_id"], {"row_index": 1, "order_key": 1})]
+
+
+def test_keys_between_orders_and_bisects():
+    keys = keys_between(key_for_index(1), key_for_index(2), 50)
+    assert keys == sorted(keys) and len(set(keys)) == 50
+    assert key_for_index(1) < keys[0] and keys[-1] < key_for_index(2)
+    assert keys_between(None, None, 1) == [key_for_index(1)]
+
+
+def test_keys_for_indexes_before_reorder_follow_row_index(db):
+    async def scenario():
+        sheet = await make_sheet(db, [1, 5, 10])
+        assert await row_order.keys_for_indexes(db, sheet, [3, 11]) == {3: key_for_index(3), 11: key_for_index(11)}
+    run(scenario())
+
+
+def test_rows_created_by_index_after_rebalance(db):
+    async def scenario():
+        sheet = await make_sheet(db, [1, 5, 10])
+        await row_order.rebalance(db, sheet["_id"])
+        sheet = await db.spreadsheets.find_one({"_id": sheet["_id"]})
+        assert sheet["reordered"]
+        await insert_by_index(db, sheet, [3])
+        await insert_by_index(db, sheet, [2])
+        await insert_by_index(db, sheet, [0, 11, 12])
+        await insert_by_index(db, sheet, [6, 7, 8])
+        rows = await display(db, sheet)
+        assert [i for i, _ in rows] == [0, 1, 2, 3, 5, 6, 7, 8, 10, 11, 12]
+        assert len({k for _, k in rows}) == len(rows)
+    run(scenario())
+
+
+def test_rows_created_by_index_go_below_moved_neighbour(db):
+    async def scenario():
+        sheet = await make_sheet(db, [1, 2, 3])
+        # move row 3 to the top
+        await db.rows.update_one({"row_index": 3}, {"$set": {"order_key": keys_between(None, key_for_index(1), 1)[0]}})
+        await row_order.mark_reordered(db, sheet["_id"])
+        await insert_by_index(db, sheet, [4])
+        rows = await display(db, sheet)
+        assert [i for i, _ in rows] == [3, 4, 1, 2]
+    run(scenario())
+
+
+def test_reordered_sheet_exports_display_order_with_formula_values(db, app_db):
+    async def scenario():
+        sheet = await make_sheet(db, [1, 2, 3])
+        for i in (1, 2):
+            await db.rows.update_one({"row_index": i}, {"$set": {"cells.A": {"type": "number", "value": i * 10}}})
+        await db.rows.update_one({"row_index": 3}, {"$set": {
+            "cells.A": {"type": "formula", "formula": "=A1+A2", "value": 30},
+            # moved to the top: exported as row 1, where "=A1+A2" would read itself
+            "order_key": keys_between(None, key_for_index(1), 1)[0]}})
+        await row_order.mark_reordered(db, sheet["_id"])
+        sheet = await db.spreadsheets.find_one({"_id": sheet["_id"]})
+        rows = await main.export_rows(sheet, sheet["_id"])
+        return b"".join([chunk async for chunk in xlsx_export.stream_xlsx(rows)])
+    ws = openpyxl.load_workbook(io.BytesIO(run(scenario()))).active
+    assert [ws.cell(r, 1).value for r in (1, 2, 3)] == [30, 10, 20]
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import search
+
+
+def text(value):
+    return {"type": "string", "value": value}
+
+
+ROWS = {
+    1: {"A": text("Red apple"), "B": {"type": "number", "value": 7}},
+    2: {"A": text("apple"), "B": text("green Apple pie")},
+    3: {"A": text("pineapple"), "B": text("Applesauce")},
+    4: {"A": text("apple red"), "C": text("apples, red")},
+}
+
+
+async def indexed(db):
+    await db.spreadsheets.insert_one({"_id": "s"})
+    await db.rows.insert_many([{"_id": f"r{i}", "spreadsheet_id": "s", "row_index": i, "cells": cells}
+                               for i, cells in ROWS.items()])
+    assert await search.rebuild(db, "s") == len(ROWS)
+
+
+def hits(result):
+    return [(h["row_index"], h["column"], h["match"]) for h in result["hits"]]
+
+
+def test_posting_indexes_string_cells_only():
+    doc = search.posting("s", 3, "B", text("Ünïcode  WORDS, words!"))
+    assert doc["terms"] == ["ünïcode", "words"] and doc["text"] == "ünïcode words words"
+    assert doc["_id"] == "s:3:B" and doc["col"] == 2
+    assert search.posting("s", 3, "B", {"type": "number", "value": 1}) is None
+    assert search.posting("s", 3, "B", text(" ,. ")) is None
+
+
+def test_hits_come_by_tier_then_sheet_order(db):
+    async def scenario():
+        await indexed(db)
+        result = await search.search(db, "s", "red apple")
+        assert hits(result) == [(1, "A", "exact"), (4, "A", "words"), (4, "C", "prefix")]
+        assert result["hits"][0]["value"] == "Red apple" and result["next_cursor"] is None
+        # pineapple is a word of its own, not a match for "apple"
+        assert hits(await search.search(db, "s", "APPLE")) == [
+            (2, "A", "exact"), (1, "A", "words"), (2, "B", "words"), (4, "A", "words"),
+            (3, "B", "prefix"), (4, "C", "prefix")]
+        assert hits(await search.search(db, "s", "zebra")) == []
+    asyncio.run(scenario())
+
+
+def test_pages_continue_across_tiers(db):
+    async def scenario():
+        await indexed(db)
+        pages, cursor = [], None
+        while True:
+            result = await search.search(db, "s", "apple", limit=4, cursor=cursor)
+            pages.append(hits(result))
+            cursor = result["next_cursor"]
+            if cursor is None:
+                break
+        assert [len(p) for p in pages] == [4, 2]
+        assert pages[1] == [(3, "B", "prefix"), (4, "C", "prefix")]
+        with pytest.raises(ValueError):
+            # a cursor belongs to its query
+            await search.search(db, "s", "red", cursor=search.encode_cursor("apple", 0, 1, 1))
+        with pytest.raises(ValueError):
+            await search.search(db, "s", "apple", limit=0)
+    asyncio.run(scenario())
+
+
+def test_cell_writes_update_postings_and_vocabulary(db):
+    async def scenario():
+        await indexed(db)
+        await db.rows.update_one({"_id": "r2"}, {"$set": {"cells.A": text("pear")}})
+        await search.update(db, "s", [(2, {"A": {"old": text("apple"), "new": text("pear")},
+                                           "B": {"old": text("green Apple pie"), "new": None}})])
+        assert hits(await search.search(db, "s", "pear")) == [(2, "A", "exact")]
+        assert hits(await search.search(db, "s", "pie")) == []
+        vocab = {d["term"]: d["cells"] async for d in db.search_terms.find({"spreadsheet_id": "s"})}
+        assert vocab["apple"] == 2 and vocab["pie"] == 0 and vocab["pear"] == 1
+        await search.add_rows(db, "s", [{"row_index": 9, "cells": {"D": text("pie")}}])
+        assert hits(await search.search(db, "s", "pie")) == [(9, "D", "exact")]
+    asyncio.run(scenario())
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+import tiles
+from tiles import VersionMismatch
+
+SIZE = 4
+TS = "2024-01-01T00:00:00"
+
+
+def text(value):
+    return {"type": "string", "value": value}
+
+
+def test_cells_are_stored_compactly():
+    cells = [None, text("a"), {"type": "number", "value": 2.5}, {"type": "number", "value": True},
+             {"type": "date", "value": "2024-01-02"}, {"type": "string", "value": "x", "meta": {"bold": True}}]
+    encoded = [tiles.encode_cell(c) for c in cells]
+    assert encoded[:3] == [None, "a", 2.5]
+    # anything that would not decode back to the same cell stays a dict
+    assert encoded[3:] == cells[3:]
+    assert [tiles.decode_cell(v) for v in encoded] == cells
+
+
+def test_pack_rows_fills_whole_tiles():
+    rows = [{"row_index": i, "cells": {"A": text(f"a{i}")}, "version": 1} for i in (1, 2, 5)]
+    docs = tiles.pack_rows("s", SIZE, rows, TS)
+    assert [(d["_id"], d["versions"], d["cols"]["A"]) for d in docs] == [
+        ("s:0", [1, 1, 0, 0], ["a1", "a2", None, None]), ("s:1", [1, 0, 0, 0], ["a5", None, None, None])]
+    assert tiles.aligned_batch_size(10, SIZE) == 8 and tiles.aligned_batch_size(2, SIZE) == SIZE
+
+
+def test_rows_are_written_and_read_through_tiles(db):
+    async def scenario():
+        assert await tiles.insert_row(db, "s", SIZE, 3, {"A": text("a3")}, "u", TS)
+        assert not await tiles.insert_row(db, "s", SIZE, 3, {"A": text("again")}, "u", TS)
+        assert await tiles.insert_row(db, "s", SIZE, 6, {"B": text("b6")}, "u", TS)
+        assert await db.tiles.count_documents({}) == 2
+
+        # B has no array in tile 0 yet; the patch creates it
+        old, version = await tiles.patch_cells(db, "s", SIZE, 3, {"B": text("b3"), "A": None}, 1, "u", TS)
+        assert old == {"A": text("a3")} and version == 1
+        with pytest.raises(VersionMismatch) as e:
+            await tiles.patch_cells(db, "s", SIZE, 3, {"A": text("x")}, 1, "u", TS)
+        assert e.value.current_version == 2
+        assert await tiles.patch_cells(db, "s", SIZE, 2, {"A": text("x")}, None, "u", TS) is None
+
+        assert await tiles.load_rows(db, "s", SIZE, 1, 10) == [
+            {"row_index": 3, "cells": {"B": text("b3")}, "version": 2},
+            {"row_index": 6, "cells": {"B": text("b6")}, "version": 1}]
+        assert [r["row_index"] async for r in tiles.iter_rows(db, "s", SIZE, 4, 6, ["A"])] == [6]
+    asyncio.run(scenario())
+
+
+def test_layout_is_read_once_per_sheet(db, monkeypatch):
+    monkeypatch.setattr(tiles, "_layouts", {})
+
+    async def scenario():
+        await db.spreadsheets.insert_many([{"_id": "tiled", "storage": "tiled", "tile_rows": SIZE},
+                                           {"_id": "rows"}])
+        assert await tiles.layout(db, "tiled") == SIZE
+        assert await tiles.layout(db, "rows") is None
+        assert await tiles.layout(db, "missing") is None
+        await db.spreadsheets.delete_many({})
+        assert await tiles.layout(db, "tiled") == SIZE
+    asyncio.run(scenario())
+    with pytest.raises(ValueError):
+        tiles.sheet_fields("columns")
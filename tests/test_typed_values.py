@@ -0,0 +1,96 @@
+"""
+typed_values.parse_typed_value must classify exactly like the dateutil-only
+implementation it replaced (reference_parse below, as it was in main.py), on
+the corpus in data/typed_values_corpus.jsonl: hand-picked edge cases plus
+seeded random text and date-like strings, one JSON string per line.
+"""
+import asyncio
+import json
+import os
+from datetime import date, datetime, time, timezone
+
+import pytest
+from dateutil import parser as dateparser
+
+import typed_values
+from columns import COLUMN_LETTERS
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "typed_values_corpus.jsonl")
+
+NATIVE = [None, 0, 1, -7, 2.5, True, False, {"a": 1}, datetime(2020, 1, 2), datetime(2020, 1, 2, 3, 4, 5, 678),
+          datetime(5, 1, 1), datetime(2020, 1, 2, tzinfo=timezone.utc), date(2020, 3, 4), time(10, 30)]
+
+
+def reference_parse(value):
+    """parse_typed_value before typed_values.py."""
+    if value is None:
+        return {"type": "string", "value": None}
+    if isinstance(value, (int, float, bool)):
+        return {"type": "number", "value": value}
+    if isinstance(value, dict):
+        return {"type": "json", "value": value}
+    s = str(value).strip()
+    try:
+        if '.' in s:
+            return {"type": "number", "value": float(s)}
+        return {"type": "number", "value": int(s)}
+    except Exception:
+        pass
+    try:
+        dt = dateparser.parse(s)
+        if dt.hour == 0 and dt.minute == 0 and dt.second == 0 and ':' not in s:
+            return {"type": "date", "value": dt.date().isoformat()}
+        return {"type": "datetime", "value": dt.isoformat()}
+    except Exception:
+        pass
+    return {"type": "string", "value": s}
+
+
+def load_corpus():
+    with open(CORPUS, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def same(a, b):
+    # nan != nan, but both sides classified it the same way
+    return a == b or (a["type"] == b["type"] and a["value"] != a["value"] and b["value"] != b["value"])
+
+
+@pytest.mark.parametrize("values", [NATIVE, load_corpus()], ids=["native", "corpus"])
+def test_matches_reference(values):
+    mismatches = [(v, reference_parse(v), typed_values.parse_typed_value(v)) for v in values
+                  if not same(reference_parse(v), typed_values.parse_typed_value(v))]
+    assert not mismatches, mismatches[:10]
+
+
+def test_parse_rows_matches_per_cell_reference():
+    corpus = load_corpus()
+    rows = [tuple(corpus[i:i + 5]) for i in range(0, 500, 5)]
+    rows += [(1, "a", datetime(2020, 1, 1), None, "2020-01-01"), (2.5, None, datetime(2021, 1, 1, 5), True, "x"),
+             (True,), tuple(range(5)), (datetime(2020, 1, 1),) * 5]
+    expected = [{COLUMN_LETTERS[j]: reference_parse(v) for j, v in enumerate(r) if v is not None} for r in rows]
+    assert typed_values.parse_rows(rows, COLUMN_LETTERS) == expected
+
+
+def test_import_parse_counts_reach_the_parent(tmp_path):
+    import openpyxl
+    import jobs
+    import metrics
+
+    path = str(tmp_path / "in.xlsx")
+    wb = openpyxl.Workbook()
+    for row in [(1, "a", None), (2, "2020-01-01", "x"), (None, None, None)]:
+        wb.active.append(row)
+    wb.save(path)
+    before = metrics.IMPORT_PARSE_CELLS.value()
+
+    async def scenario():
+        runner = jobs.JobRunner(workers=1)
+        try:
+            return [d async for batch in runner.import_batches("job", path, "s", 100) for d in batch]
+        finally:
+            runner.shutdown()
+    docs = asyncio.run(scenario())
+    assert len(docs) == 3
+    # parsed in the pool process, counted in this one
+    assert metrics.IMPORT_PARSE_CELLS.value() - before == 5
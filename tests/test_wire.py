@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+import pytest
+
+import wire
+from realtime import ConnectionManager, encode, stamp
+
+
+def cell(value):
+    return {"type": "number", "value": value} if isinstance(value, (int, float)) else {"type": "string", "value": value}
+
+
+def published_update():
+    row = {"A": cell("kept"), "B": cell(2.5), "C": {"type": "date", "value": "2024-01-02"}}
+    return encode(stamp(7, wire.row_updated(3, row, ["B", "D"], 5)))
+
+
+def test_v1_gets_the_full_row():
+    frame = published_update()
+    assert wire.negotiate(1).render(frame, {}) == frame
+    message = json.loads(frame)
+    assert message["seq"] == 7 and message["type"] == "row_updated" and "partial" not in message
+    assert message["row"] == {"row_index": 3, "version": 5, "cells": {
+        "A": cell("kept"), "B": cell(2.5), "C": {"type": "date", "value": "2024-01-02"}}}
+
+
+def test_v2_gets_the_changed_cells_compacted():
+    message = json.loads(wire.negotiate(2).render(published_update(), {}))
+    # D was cleared by the edit: null
+    assert message == {"seq": 7, "type": "row_updated", "row": {"row_index": 3, "version": 5,
+                                                               "cells": {"B": 2.5, "D": None}}}
+
+
+def test_negotiate_falls_back_to_what_the_server_has(monkeypatch):
+    assert wire.negotiate(1, "msgpack") is wire.V1
+    assert wire.negotiate(2, "xml").key == (2, "json")
+    assert wire.negotiate(3).version == 2
+    monkeypatch.setattr(wire, "msgpack", None)
+    assert wire.negotiate(2, "msgpack").key == (2, "json")
+
+
+def test_rows_and_replayed_events_are_compacted():
+    message = {"type": "replay", "events": [json.loads(published_update())],
+               "rows": [{"row_index": 1, "cells": {"A": cell("x"), "B": {"type": "bool", "value": True}}}]}
+    out = wire.compact(message)
+    assert out["rows"] == [{"row_index": 1, "cells": {"A": "x", "B": {"type": "bool", "value": True}}}]
+    assert out["events"][0]["row"]["cells"] == {"B": 2.5, "D": None} and "changed" not in out["events"][0]
+    # the published message is left as it was
+    assert "changed" in message["events"][0]
+
+
+def test_render_decodes_once_per_delivery():
+    cache = {}
+    first = wire.negotiate(2).render(published_update(), cache)
+    # a second socket on the same wire reuses the rendered frame without decoding again
+    cache["message"] = None
+    assert wire.negotiate(2).render(published_update(), cache) is first
+
+
+class Socket:
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, frame):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+    async def send_bytes(self, frame):
+        await self.gate.wait()
+        self.sent.append(frame)
+
+
+def burst(negotiated):
+    """Five events broadcast while the socket's first send is blocked: the rest leave as one frame."""
+    async def scenario():
+        manager = ConnectionManager()
+        await manager.start()
+        ws = Socket()
+        await manager.connect("s", ws, negotiated)
+        for n in range(5):
+            await manager.broadcast("s", {"type": "e", "n": n})
+            await asyncio.sleep(0)
+        ws.gate.set()
+        await asyncio.sleep(0.01)
+        return ws.sent, manager
+    return asyncio.run(scenario())
+
+
+def test_v2_batches_queued_events_into_one_frame():
+    sent, manager = burst(wire.negotiate(2))
+    frames = [json.loads(f) for f in sent]
+    assert [[e["n"] for e in f] for f in frames] == [[0], [1, 2, 3, 4]]
+    assert manager.messages_out == 2 and manager.bytes_out == sum(len(f) for f in sent)
+
+
+def test_msgpack_frames():
+    msgpack = pytest.importorskip("msgpack")
+    sent, _ = burst(wire.negotiate(2, "msgpack"))
+    assert all(isinstance(f, bytes) for f in sent)
+    assert [[e["n"] for e in msgpack.unpackb(f, raw=False)] for f in sent] == [[0], [1, 2, 3, 4]]
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+import write_behind
+from write_behind import WriteBehind, VersionMismatch
+
+CONFIG = {"window_ms": 10000, "max_delay_ms": 10000}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def text(value):
+    return {"type": "string", "value": value}
+
+
+async def setup(db):
+    seqs = iter(range(1, 1000))
+
+    async def sequencer(sheet_id):
+        return next(seqs)
+
+    flushed = []
+
+    async def on_flush(sheet_id, rows):
+        flushed.extend(rows)
+
+    writes = WriteBehind(sequencer=sequencer, on_flush=on_flush)
+    writes.db = db
+    await db.rows.insert_one({"_id": "r1", "spreadsheet_id": "s", "row_index": 1, "version": 1,
+                              "cells": {"A": text("a0"), "B": text("b0")}})
+    return writes, flushed
+
+
+async def row(db):
+    return await db.rows.find_one({"_id": "r1"})
+
+
+def test_edits_are_merged_into_one_write(db):
+    async def scenario():
+        writes, flushed = await setup(db)
+        for i, value in enumerate(["h", "he", "hello"]):
+            ack = await writes.apply("s", 1, {"A": text(value)}, "u", None, CONFIG)
+            assert ack == {"version": 2 + i, "seq": 1 + i, "cells": {"A": text(value), "B": text("b0")}}
+        assert (await row(db))["version"] == 1
+        assert await writes.flush_sheet("s") == 1
+        doc = await row(db)
+        assert doc["version"] == 4 and doc["cells"]["A"] == text("hello") and doc["cells"]["B"] == text("b0")
+        records = await db.changes.find({"row_id": "r1"}).to_list(None)
+        assert len(records) == 1
+        assert records[0]["payload"]["changes"] == {"A": {"old": text("a0"), "new": text("hello")}}
+        assert records[0]["payload"]["edits"] == 3 and records[0]["seq"] == 3
+        assert flushed[0]["version"] == 4 and not flushed[0]["conflict"]
+        assert writes.pending_rows() == 0
+    run(scenario())
+
+
+def test_edits_that_cancel_out_still_write_the_acked_version(db):
+    async def scenario():
+        writes, _ = await setup(db)
+        assert (await writes.apply("s", 1, {"A": text("x")}, "u", None, CONFIG))["version"] == 2
+        assert (await writes.apply("s", 1, {"A": text("a0")}, "u", None, CONFIG))["version"] == 3
+        await writes.flush_sheet("s")
+        doc = await row(db)
+        assert doc["version"] == 3 and doc["cells"]["A"] == text("a0")
+        # the client holds v3 and keeps editing against it
+        assert (await writes.apply("s", 1, {"B": text("b1")}, "u", 3, CONFIG))["version"] == 4
+    run(scenario())
+
+
+def test_expected_version_is_checked_against_buffered_state(db):
+    async def scenario():
+        writes, _ = await setup(db)
+        await writes.apply("s", 1, {"A": text("x")}, "u", 1, CONFIG)
+        with pytest.raises(VersionMismatch) as e:
+            await writes.apply("s", 1, {"A": text("y")}, "u", 1, CONFIG)
+        assert e.value.current_version == 2
+        with pytest.raises(LookupError):
+            await writes.apply("s", 9, {"A": text("y")}, "u", None, CONFIG)
+    run(scenario())
+
+
+def test_row_moved_by_another_writer_is_a_conflict(db):
+    async def scenario():
+        writes, flushed = await setup(db)
+        await writes.apply("s", 1, {"A": text("a1")}, "u", None, CONFIG)
+        await writes.apply("s", 1, {"A": text("a2")}, "u", None, CONFIG)
+        # two outside writes: the row reaches the buffered version by another path
+        for value in ("b1", "b2"):
+            await db.rows.update_one({"_id": "r1"}, {"$set": {"cells.B": text(value)}, "$inc": {"version": 1}})
+        await writes.flush_sheet("s")
+        doc = await row(db)
+        assert doc["cells"]["A"] == text("a2") and doc["cells"]["B"] == text("b2") and doc["version"] == 4
+        assert writes.conflicts == 1 and flushed[0]["conflict"] and flushed[0]["version"] == 4
+        # the re-broadcast carries the row as written, including the other writer's cells
+        assert flushed[0]["cells"] == {"A": text("a2"), "B": text("b2")}
+    run(scenario())
+
+
+def test_deleted_row_loses_its_buffered_edits(db):
+    async def scenario():
+        writes, flushed = await setup(db)
+        await writes.apply("s", 1, {"A": text("a1")}, "u", None, CONFIG)
+        await db.rows.delete_one({"_id": "r1"})
+        assert await writes.flush_sheet("s") == 0
+        assert writes.lost == 1 and flushed == []
+        assert await db.changes.count_documents({}) == 0
+    run(scenario())
+
+
+def test_normalize_config_bounds():
+    assert write_behind.normalize_config(100, 500) == {"window_ms": 100, "max_delay_ms": 500}
+    with pytest.raises(ValueError):
+        write_behind.normalize_config(600, 500)
+    with pytest.raises(ValueError):
+        write_behind.normalize_config(0, write_behind.WRITE_BEHIND_MAX_DELAY_CAP_MS + 1)
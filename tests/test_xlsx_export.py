@@ -0,0 +1,65 @@
+import asyncio
+import io
+
+import openpyxl
+import pytest
+
+import jobs
+import main
+import xlsx_export
+import xlsx_import
+from row_order import key_for_index
+
+
+def number(value):
+    return {"type": "number", "value": value}
+
+
+@pytest.fixture
+def sheet(db, app_db):
+    """Rows 1, 3 and 4 (row 2 was deleted); C3 and C4 are formulas over column A."""
+    rows = {1: {"A": number(1)}, 3: {"A": number(2), "C": {"type": "formula", "formula": "=A1+A3", "value": 3}},
+            4: {"A": number(4), "C": {"type": "formula", "formula": "=SUM(A1:A4)", "value": 7}}}
+
+    async def setup():
+        await db.spreadsheets.insert_one({"_id": "s", "title": "t"})
+        await db.rows.insert_many([{"_id": f"r{i}", "spreadsheet_id": "s", "row_index": i,
+                                    "order_key": key_for_index(i), "version": 1, "cells": cells}
+                                   for i, cells in rows.items()])
+    asyncio.run(setup())
+    return db
+
+
+def export(sheet_id="s"):
+    async def scenario():
+        sheet = await main.db.spreadsheets.find_one({"_id": sheet_id})
+        rows = await main.export_rows(sheet, sheet_id)
+        return b"".join([chunk async for chunk in xlsx_export.stream_xlsx(rows)])
+    return asyncio.run(scenario())
+
+
+def reimport(data, tmp_path):
+    path = tmp_path / "export.xlsx"
+    path.write_bytes(data)
+    return {d["row_index"]: d["cells"] for batch in xlsx_import.iter_row_batches(str(path), "copy") for d in batch}
+
+
+def test_formulas_keep_their_references_across_gaps(sheet, tmp_path):
+    data = export()
+    ws = openpyxl.load_workbook(io.BytesIO(data)).active
+    assert [ws.cell(r, 1).value for r in (1, 2, 3, 4)] == [1, None, 2, 4]
+    assert ws["C3"].value == "=A1+A3" and ws["C4"].value == "=SUM(A1:A4)"
+    cells = reimport(data, tmp_path)
+    assert cells[2] == {} and cells[3]["A"] == number(2) and cells[3]["C"]["value"] == "=A1+A3"
+
+
+def test_job_export_keeps_row_positions(sheet, tmp_path):
+    spool, out = str(tmp_path / "rows.bson"), str(tmp_path / "export.xlsx")
+
+    async def scenario():
+        rows = await main.export_rows(await main.db.spreadsheets.find_one({"_id": "s"}), "s")
+        await jobs.JobRunner()._spool_rows(rows, spool, None)
+    asyncio.run(scenario())
+    assert jobs.build_export(spool, out, "t") == 3
+    ws = openpyxl.load_workbook(out).active
+    assert ws["A3"].value == 2 and ws["C3"].value == "=A1+A3"